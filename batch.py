@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+batch.py runs ehfheatwaves.py for every job of a manifest in a pool of worker
+processes, such as the members of an ensemble that share a base period.
+
+The manifest is a JSON list of jobs. Each job is an object of ehfheatwaves.py
+long options and their values, with true for flags, and optionally a name and
+a list of further command line arguments in args, for example:
+
+[{"name": "r1", "tmax": "tasmax_r1.nc", "tmin": "tasmin_r1.nc",
+  "bpfx": "tasmax_hist.nc", "bpfn": "tasmin_hist.nc", "base": "1961-1990"},
+ {"name": "r2", "tmax": "tasmax_r2.nc", "tmin": "tasmin_r2.nc",
+  "bpfx": "tasmax_hist.nc", "bpfn": "tasmin_hist.nc", "base": "1961-1990"}]
+
+Options given after the manifest apply to every job, unless the job gives
+them too. Jobs whose thresholds are the same, because they have the same base
+period inputs, mask and threshold options, are grouped. The thresholds of a group are calculated by
+its first job and saved in the threshold cache, which is a temporary directory
+unless --cache is given, and the rest of the group loads them from the cache.
+A summary of the time and throughput of each job is printed at the end.
+
+Usage: batch.py [--jobs N] MANIFEST [ehfheatwaves.py options]
+"""
+import sys
+import os
+import time
+import json
+import shutil
+import tempfile
+import warnings
+import concurrent.futures
+try:
+    modulename = 'optparse'
+    from optparse import OptionParser
+except ImportError:
+    print(modulename, " is missing. Please install missing packages.")
+    sys.exit(2)
+import getoptions
+import ncio
+import tcache
+import ehfheatwaves
+
+
+def job_arguments(job, common=[]):
+    """job_arguments returns the common arguments followed by the command
+    line arguments of a manifest job, so that those of the job take
+    precedence."""
+    arguments = []
+    for key, value in job.items():
+        if key in ('name', 'args'): continue
+        if value is True: arguments.append('--%s'%(key))
+        elif value not in (False, None): arguments.append('--%s=%s'%(key, value))
+    return list(common)+arguments+list(job.get('args', []))
+
+
+def job_name(job):
+    """job_name returns the name of a job, or the name of its input file."""
+    if 'name' in job: return str(job['name'])
+    return os.path.basename(str(job.get('tmax') or job.get('tmin') or job.get('from-store') or '?'))
+
+
+def threshold_key(options):
+    """threshold_key returns what identifies the thresholds of a job, the
+    threshold cache keys of its definitions, or None if it needs none."""
+    if options.fromstore: return None
+    timedata = ncio.get_time_data(options)
+    if options.maskfile: mask = ncio.get_mask(options)
+    else: mask = None
+    variables = []
+    if options.keeptave: variables.append('tave')
+    if options.keeptmax: variables.append('tmax')
+    if options.keeptmin: variables.append('tmin')
+    return tuple([tcache.cache_key(options, timedata, variable, mask) for variable in variables])
+
+
+def group_jobs(jobs, common=[]):
+    """group_jobs parses the arguments of each job and groups the jobs that
+    have the same thresholds. Jobs with invalid arguments fail instead of
+    stopping the batch.
+
+    Returns the list of groups, each a list of (name, arguments) in manifest
+    order, and a list of (name, error) of the jobs that could not be parsed.
+    """
+    groups = {}
+    order = []
+    failed = []
+    for index, job in enumerate(jobs):
+        arguments = job_arguments(job, common)
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                options = getoptions.parse_arguments(arguments)
+            key = threshold_key(options)
+        except (Exception, SystemExit) as error:
+            failed.append((job_name(job), repr(error)))
+            continue
+        if key is None: key = ('job', index)
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append((job_name(job), arguments))
+    return [groups[key] for key in order], failed
+
+
+def run_job(arguments):
+    """run_job runs the heatwave calculation of one job and returns the
+    seconds it took, the number of gridcell days it calculated and the error
+    that stopped it, if any."""
+    start = time.time()
+    try:
+        options = getoptions.parse_arguments(arguments)
+        pipeline = ehfheatwaves.HeatwavePipeline(options)
+        pipeline.run()
+        ntime, nlat, nlon = pipeline.gridshape()
+    except (Exception, SystemExit) as error:
+        return time.time()-start, 0, repr(error)
+    return time.time()-start, ntime*nlat*nlon, None
+
+
+def run_batch(groups, njobs=1):
+    """run_batch runs the groups of jobs of group_jobs with njobs worker
+    processes. The first job of each group runs before the rest of the group,
+    which can then share its cached thresholds.
+
+    Returns a list of (name, group number, seconds, gridcell days, error) for
+    the jobs in the order they finished.
+    """
+    summary = []
+    if njobs<=1:
+        for number, group in enumerate(groups):
+            for name, arguments in group:
+                summary.append((name, number)+run_job(arguments))
+        return summary
+    with concurrent.futures.ProcessPoolExecutor(max_workers=njobs) as pool:
+        pending = {}
+        for number, group in enumerate(groups):
+            pending[pool.submit(run_job, group[0][1])] = (number, 0)
+        while pending:
+            done, waiting = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                number, index = pending.pop(future)
+                summary.append((groups[number][index][0], number)+future.result())
+                if index==0:
+                    for index, (name, arguments) in enumerate(groups[number][1:], 1):
+                        pending[pool.submit(run_job, arguments)] = (number, index)
+    return summary
+
+
+def print_summary(summary, elapsed):
+    """print_summary prints the time and throughput of each job and of the
+    whole batch."""
+    print("%-30s %5s %9s %16s  %s"%('job', 'group', 'seconds', 'gridcell days/s', 'status'))
+    for name, number, seconds, size, error in summary:
+        print("%-30s %5d %9.1f %16.0f  %s"%(name, number, seconds, size/max(seconds, 1e-9), error or 'ok'))
+    finished = [entry for entry in summary if entry[4] is None]
+    size = sum([entry[3] for entry in finished])
+    print("%d of %d jobs finished in %.1fs, %.1f jobs per hour, %.0f gridcell days/s"%(len(finished),
+            len(summary), elapsed, len(finished)*3600./max(elapsed, 1e-9), size/max(elapsed, 1e-9)))
+
+
+if __name__=='__main__':
+    parser = OptionParser(usage="usage: %prog [--jobs N] MANIFEST [ehfheatwaves.py options]")
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1, help='number of jobs to run at a time. Default 1', metavar='N')
+    parser.disable_interspersed_args()
+    batchoptions, args = parser.parse_args(sys.argv[1:])
+    if not args: parser.error("Please specify a manifest.")
+    with open(args[0], 'r') as manifest:
+        jobs = json.load(manifest)
+    common = args[1:]
+
+    # Share the thresholds of a group through a temporary cache unless one is given
+    cachedir = None
+    if not any([argument=='--cache' or argument.startswith('--cache=') for argument in common]):
+        cachedir = tempfile.mkdtemp(prefix='ehfheatwaves_batch_')
+        common = common+['--cache=%s'%(cachedir)]
+    start = time.time()
+    try:
+        groups, failed = group_jobs(jobs, common)
+        print("%d jobs in %d groups of shared thresholds"%(sum([len(group) for group in groups]), len(groups)))
+        summary = run_batch(groups, batchoptions.jobs)
+    finally:
+        if cachedir: shutil.rmtree(cachedir, ignore_errors=True)
+    summary += [(name, -1, 0., 0, error) for name, error in failed]
+    print_summary(summary, time.time()-start)
+    if any([entry[4] for entry in summary]): sys.exit(1)
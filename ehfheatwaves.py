@@ -8,11 +8,15 @@ temperature data.
 """
 
 import sys
+import time
+import functools
+import concurrent.futures
 import warnings
 warnings.simplefilter('ignore',category=RuntimeWarning)
 try:
     modulename = 'numpy'
     import numpy as np
+    from numpy.lib.stride_tricks import as_strided
     modulename = 'distutils.version'
     from distutils.version import LooseVersion
 except ImportError:
@@ -24,83 +28,222 @@ if LooseVersion(np.__version__) < LooseVersion('1.8.0'):
 import qtiler
 import getoptions
 import ncio
+import tcache
+import scratch
 
 
 # define vales for missing values, invalid values and fill values.
 missingval = -999.99
 fillval = -888.88
 invalidval = -777.77
+# Approximate memory used per gridcell per day of data for --max-memory.
+bytesperday = 200
 
 
-def window_percentile(temp, options, daysinyear=365, wsize=15):
-    """window_percentile calculates a day-of-year moving window percentile."""
+def compute_type(options):
+    """compute_type returns the float type that temperatures, thresholds and
+    heat indices are kept in for --precision."""
+    if options.precision=='single': return np.float32
+    return np.float64
+
+
+def window_percentile(temp, options, daysinyear=365, wsize=15, blocksize=2**22):
+    """window_percentile calculates a day-of-year moving window percentile.
+
+    The base period is viewed as (year, day of year, space) and the windows
+    of all days of the year are strided views of that array, so no per-day
+    boolean copies are made. Days are processed in blocks of roughly
+    blocksize sample values and every block is one quantile call for the
+    whole grid. Masked days are ignored, and windows without data give
+    missingval.
+    """
     # Initialise array.
-    pctl = np.ones(((daysinyear,)+temp.shape[1:]))*fillval
+    pctl = np.ones(((daysinyear,)+temp.shape[1:]), dtype=compute_type(options))*fillval
 
-    # Construct the window.
-    window = np.zeros(daysinyear,dtype=np.bool)
-    window[-np.int(np.floor(wsize/2.)):] = 1
-    window[:np.int(np.ceil(wsize/2.))] = 1
-    window = np.tile(window,options.bpend+1-options.bpstart)
+    # Reshape the base period to (year, doy, space) and wrap the day of year
+    # axis around so that every window is a contiguous slice. Masked days are
+    # nan, so their fill values are not sorted into the sample.
+    nyears = options.bpend + 1 - options.bpstart
+    temp = np.ma.filled(temp, np.nan).reshape((nyears, daysinyear, -1))
+    before = int(np.floor(wsize/2.))
+    after = int(np.ceil(wsize/2.)) - 1
+    padded = np.concatenate((temp[:,daysinyear-before:,:], temp, temp[:,:after,:]), axis=1)
+    strides = (padded.strides[0], padded.strides[1], padded.strides[1], padded.strides[2])
+    windows = as_strided(padded, shape=(nyears, daysinyear, wsize, padded.shape[2]),
+            strides=strides, writeable=False)
 
-    # Select the interpolation method.
+    # Select the interpolation method, and the same method without the nans
+    # of missing days for the columns that have them.
     if options.qtilemethod=='python':
-        percentile = np.percentile
-        parameter = 0
+        percentile = functools.partial(np.percentile, axis=0)
+        nanpercentile = functools.partial(qtiler.quantile_R, itype=7, rmnans=True, axis=0)
     elif options.qtilemethod=='zhang':
         percentile = qtiler.quantile_zhang_fast
-        parameter = False
+        nanpercentile = functools.partial(qtiler.quantile_zhang, rmnans=True, axis=0)
     elif options.qtilemethod=='matlab':
-        percentile = qtiler.quantile_R
-        parameter = 5
+        percentile = functools.partial(qtiler.quantile_R, itype=5, axis=0)
+        nanpercentile = functools.partial(qtiler.quantile_R, itype=5, rmnans=True, axis=0)
     elif options.qtilemethod=='climpact':
-        percentile = qtiler.quantile_climpact
-        parameter = False
-
-    # Set the percentile for each day of year.
-    for day in range(daysinyear):
-        #sys.stdout.write("\r")
-        #sys.stdout.write(str(day))
-        #sys.stdout.flush()
-        pctl[day,...] = percentile(temp[window,...], options.pcntl, parameter)
-        window = np.roll(window,1)
-    
+        percentile = nanpercentile = qtiler.quantile_climpact
+
+    # Set the percentile for blocks of days of year.
+    ndays = max(1, blocksize//max(1, nyears*wsize*padded.shape[2]))
+    shape = pctl.shape
+    pctl = pctl.reshape((daysinyear, -1))
+    anymissing = np.isnan(temp).any()
+    for day in range(0, daysinyear, ndays):
+        block = windows[:,day:day+ndays,...]
+        # Sample is (year and window day, day of year and space)
+        sample = block.transpose(0,2,1,3).reshape(nyears*wsize, -1)
+        if anymissing: missing = np.isnan(sample).any(axis=0)
+        if anymissing and missing.any():
+            result = np.empty(sample.shape[1])
+            if not missing.all(): result[~missing] = percentile(sample[:,~missing], options.pcntl)
+            result[missing] = nanpercentile(sample[:,missing], options.pcntl)
+        else:
+            result = percentile(sample, options.pcntl)
+        pctl[day:day+ndays,...] = result.reshape(block.shape[1], -1)
+    pctl = pctl.reshape(shape)
+
     # Remaining nans are missing data.
     pctl[np.isnan(pctl)] = missingval
-    
+
     return pctl
 
 
+def heat_indices(tave, tpct, daysinyear=365, dtype=np.float64, blocksize=2**22):
+    """heat_indices calculates the excess heat indices EHIsig and EHIaccl and
+    the excess heat factor EHF from daily mean temperature.
+
+    The 3 and 30 day sums are differences of a cumulative sum along time in
+    double precision. Days are calculated in blocks of about blocksize
+    values, and each block of the cumulative sum continues from the last, so
+    it is the same as one sum along time. The arrays are allocated with
+    scratch. Missing values of tave are nan or masked.
+
+    As with masked sums, missing days count as zero in the window sums, and
+    an index is missing only if all the days of its windows are missing or
+    its threshold in tpct is missing.
+
+    Returns EHIsig, EHIaccl and EHF as plain arrays of type dtype shaped like
+    tave and the missing indicator of the days whose EHF is missing. The
+    indices are nan where they are missing and on the first 32 days, which
+    have no index.
+    """
+    ndays = tave.shape[0]
+    space = tave.shape[1:]
+    ndaysblock = max(1, blocksize//max(1, int(np.prod(space))))
+    values = np.ma.getdata(tave)
+    mask = np.ma.getmask(tave)
+    # Cumulative sums with a leading zero, so a window sum is a difference.
+    # Missing days are only counted once there is missing data.
+    tsum = scratch.empty((ndays+1,)+space)
+    tsum[0] = 0.
+    nmissing = None
+    for start in range(0, ndays, ndaysblock):
+        stop = min(start+ndaysblock, ndays)
+        temp = values[start:stop].astype(np.float64)
+        if mask is not np.ma.nomask: temp[mask[start:stop]] = np.nan
+        missing = np.isnan(temp)
+        if (nmissing is None) and missing.any():
+            nmissing = scratch.zeros((ndays+1,)+space, dtype=np.int32)
+        if nmissing is not None:
+            np.cumsum(missing, axis=0, out=nmissing[start+1:stop+1])
+            nmissing[start+1:stop+1] += nmissing[start]
+        temp[missing] = 0.
+        if start: temp[0] += tsum[start]
+        np.cumsum(temp, axis=0, out=tsum[start+1:stop+1])
+    missing = scratch.zeros(tave.shape, dtype=bool)
+    EHIaccl = scratch.full(tave.shape, np.nan, dtype)
+    EHIsig = scratch.full(tave.shape, np.nan, dtype)
+    EHF = scratch.full(tave.shape, np.nan, dtype)
+    for start in range(32, ndays, ndaysblock):
+        stop = min(start+ndaysblock, ndays)
+        # For day i the 3 day window is i-2..i and the 30 day window i-32..i-3.
+        t3 = (tsum[start+1:stop+1] - tsum[start-2:stop-2])/3.
+        t30 = (tsum[start-2:stop-2] - tsum[start-32:stop-32])/30.
+        EHIaccl[start:stop] = t3 - t30
+        # Day of year of each day
+        doy = np.arange(start, stop)%daysinyear
+        threshold = np.take(tpct, doy, axis=0)
+        EHIsig[start:stop] = t3 - threshold
+        sigmissing = np.isnan(threshold)|(threshold==missingval)
+        del threshold
+        if nmissing is not None:
+            sigmissing |= (nmissing[start+1:stop+1] - nmissing[start-2:stop-2])==3
+            acclmissing = (nmissing[start-2:stop-2] - nmissing[start-32:stop-32])==30
+            acclmissing |= sigmissing
+        else:
+            acclmissing = sigmissing
+        EHIsig[start:stop][sigmissing] = np.nan
+        EHIaccl[start:stop][acclmissing] = np.nan
+        missing[start:stop] = acclmissing
+        ehf = np.maximum(EHIaccl[start:stop], 1.)*EHIsig[start:stop]
+        ehf[ehf<0] = 0
+        EHF[start:stop] = ehf
+    del tsum, nmissing
+    return EHIsig, EHIaccl, EHF, missing
+
+
+def excess_heat(tave, tpct, daysinyear=365, dtype=np.float64):
+    """excess_heat calculates the excess heat indices EHIsig and EHIaccl and
+    the excess heat factor EHF with heat_indices, and returns them as masked
+    arrays that are masked where they are missing. The first 32 days have no
+    index and are nan.
+    """
+    EHIsig, EHIaccl, EHF, missing = heat_indices(tave, tpct, daysinyear, dtype)
+    return (np.ma.array(EHIsig, mask=missing&np.isnan(EHIsig)), np.ma.array(EHIaccl, mask=missing),
+            np.ma.array(EHF, mask=missing))
+
+
+def find_runs(ehfs, minlength=1):
+    """find_runs locates runs of consecutive days with ehfs>0 along the first
+    axis and returns an event indicator and a duration indicator for runs of
+    at least minlength days.
+
+    Run starts and ends are found with one np.diff of the padded positive
+    indicator. Events are boolean and durations use the smallest integer
+    type that can hold the length of the series. Both are plain arrays.
+    """
+    positive = np.ma.filled(ehfs>0., False)
+    shape = positive.shape
+    positive = positive.reshape((shape[0], -1))
+    # Pad with a day without heat on either side, so every run has an end.
+    padding = np.zeros((1, positive.shape[1]), dtype=np.int8)
+    edges = np.diff(np.concatenate((padding, positive.astype(np.int8), padding)), axis=0)
+    # Runs are paired by column, so find the edges column by column.
+    space, start = np.nonzero(edges.T==1)
+    end = np.nonzero(edges.T==-1)[1]
+    del edges
+    duration = end - start
+    keep = duration>=minlength
+    space, start, end, duration = space[keep], start[keep], end[keep], duration[keep]
+    if shape[0]<np.iinfo(np.int16).max: dtype = np.int16
+    else: dtype = np.int32
+    ends = scratch.zeros(positive.shape, dtype=dtype)
+    ends[start,space] = duration
+    if minlength>1:
+        # Mark the start and the day after the end of each run and accumulate.
+        marks = scratch.zeros((shape[0]+1, positive.shape[1]), dtype=np.int8)
+        marks[start,space] = 1
+        marks[end,space] = -1
+        # The accumulated marks are 0 or 1, so they are also booleans.
+        events = np.cumsum(marks[:-1], axis=0, dtype=np.int8,
+                out=scratch.empty(positive.shape, dtype=np.int8)).view(bool)
+        del marks
+    else:
+        events = positive
+    return events.reshape(shape), ends.reshape(shape)
+
+
 def identify_hw(ehfs):
     """identify_hw locates heatwaves from EHF and returns an event indicator
     and a duration indicator.
     """
-    # Agregate consecutive days with EHF>0
-    # First day contains duration
-    events = (ehfs>0.).astype(np.int)
-    events[events.mask==True] = 0
-    for i in range(events.shape[0]-2,-1,-1):
-         events[i,events[i,...]>0] = events[i+1,events[i,...]>0]+1
-
-    # Identify when heatwaves start with duration
-    # Given that first day contains duration
-    diff = np.zeros(events.shape)
-    # Insert the first diff value as np.diff doesn't catch it because
-    # there is no pevious value to compare to.
-    diff[0,...] = events[0,...]
-    diff[1:,...] = np.diff(events, axis=0)
-    endss = np.ma.zeros(ehfs.shape,dtype=np.int)
-    endss[diff>2] = events[diff>2]
-
-    # Remove events less than 3 days
-    events[diff==2] = 0
-    events[np.roll(diff==2, 1, axis=0)] = 0
-    events[diff==1] = 0
-    del diff
-    events[events>0] = 1
-    events = events.astype(np.bool)
-    endss[endss<3] = 0
-    return events, endss
+    # Heatwaves are at least three consecutive days with EHF>0, and the
+    # first day contains the duration.
+    events, ends = find_runs(ehfs, minlength=3)
+    return np.ma.array(events), np.ma.array(ends)
 
 
 def identify_semi_hw(ehfs):
@@ -108,32 +251,113 @@ def identify_semi_hw(ehfs):
     and a duration indicator. This function does not exclude events less than
     three days in duration.
     """
-    # Agregate consecutive days with EHF>0
-    # First day contains duration
-    events = (ehfs>0.).astype(np.int)
-    events[events.mask==True] = 0
-    for i in range(events.shape[0]-2,-1,-1):
-         events[i,events[i,...]>0] = events[i+1,events[i,...]>0]+1
-
-    # Identify when heatwaves start with duration
-    # Given that first day contains duration
-    diff = np.zeros(events.shape)
-    # Insert the first diff value as np.diff doesn't catch it because
-    # there is no pevious value to compare to.
-    diff[0,...] = events[0,...]
-    diff[1:,...] = np.diff(events, axis=0)
-    endss = np.ma.zeros(ehfs.shape,dtype=np.int)
-    endss[diff>0] = events[diff>0]
-
-    del diff
-    events[events>0] = 1
-    events = events.astype(np.bool)
-    return events, endss
-
-
-def hw_aspects(EHF, season, hemisphere):
+    events, ends = find_runs(ehfs, minlength=1)
+    return np.ma.array(events), np.ma.array(ends)
+
+
+def pairwise_sum(x):
+    """pairwise_sum sums the rows of the 2D array x in the same order as
+    numpy's pairwise summation of a contiguous 1D array, so each row sum is
+    identical to np.sum of that row.
+    """
+    n = x.shape[1]
+    if n<8:
+        total = np.zeros(x.shape[0], dtype=x.dtype)
+        for i in range(n): total += x[:,i]
+        return total
+    elif n<=128:
+        # Eight partial sums that are combined pairwise
+        r = x[:,:8].copy()
+        m = n - n%8
+        for i in range(8, m, 8): r += x[:,i:i+8]
+        total = ((r[:,0]+r[:,1])+(r[:,2]+r[:,3]))+((r[:,4]+r[:,5])+(r[:,6]+r[:,7]))
+        for i in range(m, n): total += x[:,i]
+        return total
+    else:
+        n2 = n//2
+        n2 -= n2%8
+        return pairwise_sum(x[:,:n2]) + pairwise_sum(x[:,n2:])
+
+
+def grouped_mean(values, start, length):
+    """grouped_mean calculates the mean of the segments
+    values[start:start+length] of the 1D array values as np.nanmean would.
+
+    Segments of equal length are gathered into one 2D array and summed
+    together. Returns nan for segments without valid values.
+    """
+    means = np.ones(start.shape)*np.nan
+    for n in np.unique(length):
+        segments = np.nonzero(length==n)[0]
+        data = values[start[segments,None] + np.arange(n)]
+        valid = np.logical_not(np.isnan(data))
+        data[np.logical_not(valid)] = 0.
+        count = valid.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[segments] = pairwise_sum(data)/count
+    return means
+
+
+def hw_magnitude(EHF, duration):
+    """hw_magnitude calculates the mean heatwave magnitude (HWM) and the peak
+    EHF of the hottest heatwave (HWA) of every column of EHF.
+
+    Heatwaves start where duration>0. The columns are flattened into one
+    series, so the mean of each heatwave and the mean of each column's
+    heatwaves are reductions over segments of that series. The hottest
+    heatwave is the first with the largest mean. Columns without heatwaves
+    are nan.
+    """
+    ntime, nspace = EHF.shape
+    HWM = np.ones(nspace)*np.nan
+    HWA = HWM.copy()
+    # Heatwaves ordered by column and then by start day
+    space, start = np.nonzero(np.ma.filled(duration, 0).T>0)
+    if len(space)==0: return HWM, HWA
+    length = np.ma.filled(duration, 0)[start,space].astype(int)
+    length = np.minimum(start + length, ntime) - start
+    values = np.ma.filled(EHF.astype(np.float64), np.nan).T.ravel()
+    start = space*ntime + start
+    means = grouped_mean(values, start, length)
+    # Each column's heatwaves are a segment of means
+    columns, first, nevents = np.unique(space, return_index=True, return_counts=True)
+    HWM[columns] = grouped_mean(means, first, nevents)
+    # Sorting is stable, so ties go to the earliest heatwave.
+    hottest = np.lexsort((-means, space))[first]
+    # Peak of the hottest heatwaves. The padding keeps reduceat indices in bounds.
+    bounds = np.stack((start[hottest], start[hottest] + length[hottest]), axis=1).ravel()
+    values = np.append(np.where(np.isnan(values), -np.inf, values), -np.inf)
+    HWA[columns] = np.maximum.reduceat(values, bounds)[::2]
+    return HWM, HWA
+
+
+def season_stack(EHF, ifrom, length, nseasons, daysinyear=365):
+    """season_stack returns the seasons EHF[ifrom+daysinyear*iyear:][:length]
+    of nseasons consecutive years as a (length, nseasons, space) array, which
+    is masked if EHF is. The data and mask are strided views of EHF and are
+    not copied.
+    """
+    data = np.ma.getdata(EHF)[ifrom:]
+    shape = (length, nseasons) + data.shape[1:]
+    data = as_strided(data, shape=shape,
+            strides=(data.strides[0], data.strides[0]*daysinyear) + data.strides[1:],
+            writeable=False)
+    if not np.ma.isMaskedArray(EHF): return data
+    mask = np.ma.getmaskarray(EHF)[ifrom:]
+    mask = as_strided(mask, shape=shape,
+            strides=(mask.strides[0], mask.strides[0]*daysinyear) + mask.strides[1:],
+            writeable=False)
+    return np.ma.array(data, mask=mask, copy=False)
+
+
+def hw_aspects(EHF, season, hemisphere, options, timedata, first_year):
     """hw_aspects takes EHF values or temp 90pct exceedences identifies
-    heatwaves and calculates seasonal aspects.
+    heatwaves and calculates seasonal aspects for the years from first_year.
+
+    The seasons of all years are stacked along a year axis and heatwaves
+    are identified for every year at once. A trailing season that runs past
+    the end of the data is calculated on its own. Missing values of EHF are
+    nan or masked, and are nan while calculating.
     """
     # Select indices depending on calendar season and hemisphere
     if season=='summer':
@@ -150,23 +374,36 @@ def hw_aspects(EHF, season, hemisphere):
         else:
             startday = timedata.SHS[0]
             endday = timedata.SHS[1]
+    EHF = np.ma.filled(EHF, np.nan)
     # Initialize arrays
+    nyears = len(range(first_year,timedata.daylast.year+1))
     HWA = np.ones(((nyears,)+(EHF.shape[1],)))*fillval
     HWM = HWA.copy()
     HWN = HWA.copy()
     HWF = HWA.copy()
     HWD = HWA.copy()
     HWT = HWA.copy()
-    # Loop over years
-    for iyear, year in enumerate(range(first_year,timedata.daylast.year)):
+    allowance = 14 # For including heawave days after the end of the season
+    if options.oldmethod:
+        ifrom = startday - 1 # -1 to include Oct 31st
+    else:
+        ifrom = startday - 2
+    ito = endday + allowance
+    # Every year except the last, which is incomplete
+    nseasons = len(range(first_year,timedata.daylast.year))
+    # Seasons that fit within the data are calculated together
+    ncomplete = min(nseasons, max(0, (EHF.shape[0] - ito)//timedata.daysinyear + 1))
+    groups = [(0, ncomplete)] + [(iyear, iyear+1) for iyear in range(ncomplete, nseasons)]
+    for first, last in groups:
+        if first==last: continue
+        if last - first>1:
+            EHF_i = season_stack(EHF, ifrom, ito - ifrom, last - first, timedata.daysinyear)
+        else:
+            # Take what is left of an incomplete season
+            EHF_i = EHF[ifrom + timedata.daysinyear*first:ito + timedata.daysinyear*first,...]
+            EHF_i = EHF_i.reshape((EHF_i.shape[0],1)+EHF_i.shape[1:])
         if options.oldmethod:
-            if (year==timedata.daylast.year): continue # Incomplete yr
-            # Select this years season
-            allowance = 14 # For including heawave days after the end of the season
-            ifrom = startday + timedata.daysinyear*iyear - 1 # -1 to include Oct 31st
-            ito = endday + timedata.daysinyear*iyear + allowance
-            EHF_i = EHF[ifrom:ito,...]
-            event_i, duration_i = identify_hw(EHF_i)
+            event_i, duration_i = find_runs(EHF_i, minlength=3)
             # Identify heatwaves that span the entire season
             perpetual = event_i[:-allowance,...].all(axis=0)
             perphw = duration_i[0,perpetual] - 1 # -1 to exclude Oct 31st
@@ -177,17 +414,12 @@ def hw_aspects(EHF, season, hemisphere):
             # Indicate perpetual heatwaves if they occur.
             if perpetual.any(): duration_i[0,perpetual] = perphw
         else:
-            # Select this years season
-            allowance = 14 # For including heawave days after the end of the season
-            ifrom = startday + timedata.daysinyear*iyear - 2
-            ito = endday + timedata.daysinyear*iyear + allowance
-            EHF_i = EHF[ifrom:ito,...]
-            event_i, duration_i = identify_hw(EHF_i)
+            event_i, duration_i = find_runs(EHF_i, minlength=3)
             # Remove EHF values in pre season
             EHF_i = EHF_i[2:,...]
             # Identify semi heatwaves that overlap the start of season only including days within the season.
             event_i = event_i[2:,...]
-            event_i, duration_i = identify_semi_hw(event_i)
+            event_i, duration_i = find_runs(event_i, minlength=1)
             # Identify heatwaves that span the entire season
             perpetual = event_i[:-allowance,...].all(axis=0)
             perphw = duration_i[0,perpetual] - 1 # -1 to exclude Oct 31st
@@ -196,252 +428,598 @@ def hw_aspects(EHF, season, hemisphere):
             # Remove events that start after the end of the season
             duration_i = duration_i[:-allowance,...]
         # Calculate metrics
-        HWN[iyear,...] = (duration_i>0).sum(axis=0)
-        HWF[iyear,...] = duration_i.sum(axis=0)
-        HWD[iyear,...] = duration_i.max(axis=0)
-        HWT[iyear,...] = np.argmax(event_i,axis=0)
-        # HWM and HWA must be done on each gridcell
-        for x in range(EHF_i.shape[1]):
-            hw_mag = []
-            # retrieve indices where heatwaves start.
-            i = np.where(duration_i[:,x]>0)[0] # time
-            d = duration_i[i,x] # duration
-            if (d==0).all(): continue
-            for hw in range(len(d)):
-                # retireve this heatwave's EHF values and mean magnitude
-                hwdat = EHF_i[i[hw]:i[hw]+d[hw],x]
-                hw_mag.append(np.nanmean(hwdat))
-            HWM[iyear,x] = np.nanmean(hw_mag)
-            # Find the hottest heatwave magnitude
-            idex = np.where(hw_mag==max(hw_mag))[0][0]
-            # Find that heatwave's hottest day as EHF value.
-            HWA[iyear,x] = EHF_i[i[idex]:i[idex]+d[idex],x].max()
+        HWN[first:last,...] = (duration_i>0).sum(axis=0)
+        HWF[first:last,...] = duration_i.sum(axis=0)
+        HWD[first:last,...] = duration_i.max(axis=0)
+        HWT[first:last,...] = np.argmax(event_i,axis=0)
+        # HWM and HWA from the heatwaves of every gridcell and year at once
+        hwm, hwa = hw_magnitude(EHF_i.reshape(EHF_i.shape[0],-1),
+                duration_i.reshape(duration_i.shape[0],-1))
+        hwm = hwm.reshape(HWM[first:last,...].shape)
+        hwa = hwa.reshape(HWA[first:last,...].shape)
+        events = np.logical_not(np.isnan(hwm))
+        HWM[first:last,...][events] = hwm[events]
+        HWA[first:last,...][events] = hwa[events]
         # Locate invalid values or misisng values
-        missing = EHF_i.mask.all(axis=0)
+        missing = np.isnan(EHF_i).all(axis=0)
         if missing.any():
-            HWT[iyear,missing] = missingval
-            HWN[iyear,missing] = missingval
-            HWF[iyear,missing] = missingval
-            HWD[iyear,missing] = missingval
-            HWA[iyear,missing] = missingval
-            HWM[iyear,missing] = missingval
-        invalid = HWN[iyear,...]==0
-        HWT[iyear,invalid] = invalidval
-        HWD[iyear,invalid] = invalidval
-        HWA[iyear,invalid] = invalidval
-        HWM[iyear,invalid] = invalidval
+            HWT[first:last,...][missing] = missingval
+            HWN[first:last,...][missing] = missingval
+            HWF[first:last,...][missing] = missingval
+            HWD[first:last,...][missing] = missingval
+            HWA[first:last,...][missing] = missingval
+            HWM[first:last,...][missing] = missingval
+        invalid = HWN[first:last,...]==0
+        HWT[first:last,...][invalid] = invalidval
+        HWD[first:last,...][invalid] = invalidval
+        HWA[first:last,...][invalid] = invalidval
+        HWM[first:last,...][invalid] = invalidval
     return HWA, HWM, HWN, HWF, HWD, HWT
 
 
 # Calculate metrics year by year
-def split_hemispheres(EHF):
+def split_hemispheres(EHF, south, options, timedata, first_year, blocksize=2**24):
     """split_hemispheres splits the input data by hemispheres, and glues them
     back together after heatwave calculations.
 
-    The EHF spatial axes are reshaped into a single dimension.
+    The EHF spatial axes are reshaped into a single dimension and south
+    indicates the columns in the southern hemisphere. Columns are calculated
+    in blocks of about blocksize values, so only a block of a memory mapped
+    EHF is read into memory at a time.
     The output arrays are 2D. When saving, data should be reshaped or indexed
     with a land-sea mask.
     """
-    if south:
-        if options.maskfile:
-            EHF_s = EHF[:,:(mask[lats<=0]>0).sum()]
+    EHF = EHF.reshape((EHF.shape[0], -1))
+    nyears = len(range(first_year,timedata.daylast.year+1))
+    aspects = tuple([np.ones((nyears, EHF.shape[1]))*fillval for i in range(6)])
+    ncolumns = max(1, blocksize//max(1, EHF.shape[0]))
+    for start in range(0, EHF.shape[1], ncolumns):
+        block = slice(start, start+ncolumns)
+        for hemisphere, columns in (('south', south[block]), ('north', np.logical_not(south[block]))):
+            if not columns.any(): continue
+            hemisphere_aspects = hw_aspects(EHF[:,block][:,columns], options.season, hemisphere,
+                    options, timedata, first_year)
+            for aspect, hemisphere_aspect in zip(aspects, hemisphere_aspects):
+                aspect[:,block][:,columns] = hemisphere_aspect
+    return aspects
+
+
+def exceedance(temp, pct, daysinyear=365, dtype=np.float64):
+    """exceedance returns temp where it exceeds the day-of-year threshold pct,
+    zero elsewhere and nan where temp is masked, as a plain array. Each year
+    is compared with the thresholds at once.
+    """
+    values = np.ma.getdata(temp)
+    mask = np.ma.getmask(temp)
+    exceed = scratch.zeros(temp.shape, dtype=dtype)
+    for start in range(0, temp.shape[0], daysinyear):
+        year = values[start:start+daysinyear,...]
+        above = year>pct[:year.shape[0],...]
+        exceed[start:start+daysinyear,...][above] = year[above]
+        if mask is not np.ma.nomask: exceed[start:start+daysinyear,...][mask[start:start+daysinyear,...]] = np.nan
+    return exceed
+
+
+def stream_daily(writer, exceed):
+    """stream_daily appends daily data to a DailyWriter in blocks of about
+    ncio.writeblocksize bytes and closes it."""
+    blocklen = max(1, ncio.writeblocksize//(exceed.itemsize*max(1, exceed[0].size)))
+    for start in range(0, exceed.shape[0], blocklen):
+        writer.append(exceed[start:start+blocklen])
+    writer.close()
+
+
+def calculate_thresholds(options, timedata, tmax_bp=None, tmin_bp=None, tpct=None, txpct=None, tnpct=None):
+    """calculate_thresholds returns the day of year thresholds of the
+    definitions in options in a dictionary. Thresholds that are None are
+    calculated from the (time, space) base period data tmax_bp and tmin_bp.
+    """
+    if options.keeptave and tpct is None:
+        tave_base = (tmax_bp + tmin_bp)/2.
+        tpct = window_percentile(tave_base, options, daysinyear=timedata.daysinyear)
+        del tave_base
+    if options.keeptmax and txpct is None:
+        txpct = window_percentile(tmax_bp, options, daysinyear=timedata.daysinyear)
+    if options.keeptmin and tnpct is None:
+        tnpct = window_percentile(tmin_bp, options, daysinyear=timedata.daysinyear)
+    return {'tpct': tpct, 'txpct': txpct, 'tnpct': tnpct}
+
+
+def daily_series(options, timedata, thresholds, tmax=None, tmin=None):
+    """daily_series calculates the daily series that heatwaves are defined
+    from the (time, space) tmax and tmin data and the thresholds of
+    calculate_thresholds.
+
+    Returns a dictionary of plain arrays with nan where data are missing:
+    EHF_series and missing, where EHF is missing, with EHIsig and EHIaccl
+    for --ehi, and the tmax and tmin exceedances tx_series and tn_series.
+    """
+    series = {}
+    dtype = compute_type(options)
+    # Calculate EHF
+    if not options.noehf:
+        tave = scratch.empty(tmax.shape, np.result_type(tmax.dtype, tmin.dtype, 2.))
+        np.add(np.ma.getdata(tmax), np.ma.getdata(tmin), out=tave)
+        tave /= 2.
+        tave[np.ma.getmaskarray(tmax)|np.ma.getmaskarray(tmin)] = np.nan
+        EHIsig, EHIaccl, series['EHF_series'], series['missing'] = heat_indices(tave,
+                thresholds['tpct'], timedata.daysinyear, dtype)
+        del tave
+        if options.ehi: series['EHIsig'], series['EHIaccl'] = EHIsig, EHIaccl
+        del EHIsig, EHIaccl
+
+    # Tx90pc exceedences
+    if options.keeptmax: series['tx_series'] = exceedance(tmax, thresholds['txpct'], timedata.daysinyear, dtype)
+    if options.keeptmin: series['tn_series'] = exceedance(tmin, thresholds['tnpct'], timedata.daysinyear, dtype)
+    return series
+
+
+def yearly_aspects(options, timedata, first_year, south, series):
+    """yearly_aspects calculates the yearly heatwave aspects of options.season
+    from the daily series of daily_series. south indicates the columns in the
+    southern hemisphere. Returns a dictionary of the aspects by definition.
+    """
+    aspects = {}
+    if not options.noehf:
+        aspects['EHF_aspects'] = split_hemispheres(series['EHF_series'], south, options, timedata, first_year)
+    if options.tx90pc:
+        aspects['tx_aspects'] = split_hemispheres(series['tx_series'], south, options, timedata, first_year)
+    if options.tn90pc:
+        aspects['tn_aspects'] = split_hemispheres(series['tn_series'], south, options, timedata, first_year)
+    return aspects
+
+
+def heatwave_chain(options, timedata, first_year, south, tmax=None, tmin=None,
+        tmax_bp=None, tmin_bp=None, tpct=None, txpct=None, tnpct=None, writers=None):
+    """heatwave_chain calculates the thresholds, heatwave definitions and the
+    daily and yearly heatwave aspects of columns of temperature data.
+
+    Data are (time, space) arrays and south indicates the columns in the
+    southern hemisphere. Thresholds that are None are calculated from the
+    base period data tmax_bp and tmin_bp. Columns are independent, so the
+    space axis can be split between processes. Daily output is streamed to
+    the DailyWriters of writers, by definition, instead of being returned.
+
+    Missing data are nan while calculating, and the daily output is masked
+    where it is missing. Returns a dictionary of the results.
+    """
+    # Caclulate percentile
+    results = calculate_thresholds(options, timedata, tmax_bp, tmin_bp, tpct, txpct, tnpct)
+    del tmax_bp, tmin_bp
+    series = daily_series(options, timedata, results, tmax, tmin)
+    if options.ehi:
+        # EHIsig can be present on days with a missing EHIaccl
+        EHIsig = series.pop('EHIsig')
+        results['EHIsig'] = np.ma.array(EHIsig, mask=series['missing']&np.isnan(EHIsig))
+        results['EHIaccl'] = np.ma.array(series.pop('EHIaccl'), mask=series['missing'])
+        del EHIsig
+
+    # Calculate daily output
+    if options.dailyout and options.keeptave:
+        EHF = np.ma.array(series['EHF_series'], mask=series['missing'])
+        if writers: stream_daily(writers['EHF'], EHF)
         else:
-            EHF_s = EHF[:,lats<=0,...]
-        # Reshape to 2D
-        space = EHF_s.shape[1:]
-        if len(space)>1:
-            EHF_s = EHF_s.reshape(EHF_s.shape[0],space[0]*space[1])
-        # Southern hemisphere aspects
-        HWA_s, HWM_s, HWN_s, HWF_s, HWD_s, HWT_s = \
-                hw_aspects(EHF_s, options.season, 'south')
-        del EHF_s
-    if north:
-        if options.maskfile:
-            EHF_n = EHF[:,(mask[lats<=0]>0).sum():]
+            results['EHF'] = EHF
+            results['event'], results['ends'] = identify_hw(series['EHF_series'])
+    if options.tx90pcd:
+        txexceed = np.ma.array(series['tx_series'], mask=np.ma.getmaskarray(tmax))
+        if writers: stream_daily(writers['tx90pct'], txexceed)
         else:
-            EHF_n = EHF[:,lats>0,...]
-        # Reshape to 2D
-        space = EHF_n.shape[1:]
-        if len(space)>1:
-            EHF_n = EHF_n.reshape(EHF_n.shape[0],space[0]*space[1])
-        # Northern hemisphere aspects
-        HWA_n, HWM_n, HWN_n, HWF_n, HWD_n, HWT_n = \
-                hw_aspects(EHF_n, options.season, 'north')
-        del EHF_n
-    # Glue hemispheres back together
-    if north and south:
-        HWA = np.append(HWA_s, HWA_n, axis=1)
-        HWM = np.append(HWM_s, HWM_n, axis=1)
-        HWN = np.append(HWN_s, HWN_n, axis=1)
-        HWF = np.append(HWF_s, HWF_n, axis=1)
-        HWD = np.append(HWD_s, HWD_n, axis=1)
-        HWT = np.append(HWT_s, HWT_n, axis=1)
-    elif north:
-        HWA = HWA_n
-        HWM = HWM_n
-        HWN = HWN_n
-        HWF = HWF_n
-        HWD = HWD_n
-        HWT = HWT_n
-    elif south:
-        HWA = HWA_s
-        HWM = HWM_s
-        HWN = HWN_s
-        HWF = HWF_s
-        HWD = HWD_s
-        HWT = HWT_s
-    return HWA, HWM, HWN, HWF, HWD, HWT
+            results['txexceed'] = txexceed
+            results['event_tx'], results['ends_tx'] = identify_hw(series['tx_series'])
+    if options.tn90pcd:
+        tnexceed = np.ma.array(series['tn_series'], mask=np.ma.getmaskarray(tmin))
+        if writers: stream_daily(writers['tn90pct'], tnexceed)
+        else:
+            results['tnexceed'] = tnexceed
+            results['event_tn'], results['ends_tn'] = identify_hw(series['tn_series'])
 
+    # Keep the series that the yearly aspects are calculated from for --store
+    if options.storefile:
+        for key in ('EHF_series', 'tx_series', 'tn_series'):
+            if key in series: results[key] = series[key]
 
-if __name__=='__main__':
+    # Calculate yearly output
+    if options.yearlyout:
+        results.update(yearly_aspects(options, timedata, first_year, south, series))
+    return results
 
-    # Get the options and variables
-    options = getoptions.parse_arguments(sys.argv[1:])
 
-    # Load time data
-    if options.verbose: print("Loading data")
-    timedata = ncio.get_time_data(options)
+def parallel_chain(options, timedata, first_year, south, **data):
+    """parallel_chain splits the columns of the data between options.workers
+    processes, runs heatwave_chain on each chunk and joins the results.
+    """
+    bounds = np.linspace(0, len(south), min(options.workers, len(south))+1).astype(int)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=options.workers) as pool:
+        futures = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            chunk = dict([(key, value[:,start:end]) for key, value in data.items() if value is not None])
+            futures.append(pool.submit(heatwave_chain, options, timedata, first_year,
+                    south[start:end], **chunk))
+        chunks = [future.result() for future in futures]
+    def join(arrays):
+        if arrays[0] is None: return None
+        if isinstance(arrays[0], np.ma.MaskedArray): return np.ma.concatenate(arrays, axis=1)
+        return np.concatenate(arrays, axis=1)
+    results = {}
+    for key, value in chunks[0].items():
+        if isinstance(value, tuple):
+            results[key] = tuple([join([chunk[key][i] for chunk in chunks]) for i in range(len(value))])
+        else:
+            results[key] = join([chunk[key] for chunk in chunks])
+    return results
 
-    # Load land-sea mask
-    if options.maskfile: mask = ncio.get_mask(options)
-    else: mask = None
 
-    # Load the temperature data over the base period
-    if options.keeptave or options.keeptmax:
-        tmax = ncio.load_bp_data(options, timedata, variable='tmax', mask=mask)
-    if options.keeptave or options.keeptmin:
-        tmin = ncio.load_bp_data(options, timedata, variable='tmin', mask=mask)
-    if options.keeptave:
-        tave_base = (tmax + tmin)/2.
+def load_region(options, timedata, mask=None, rows=slice(None)):
+    """load_region looks up the cached thresholds of a band of latitude rows
+    and reads the temperature data that calculate_region needs.
 
-    # Caclulate percentile
-    if options.verbose: print("Calculating percentiles")
-    if options.keeptave:
-        tpct = window_percentile(tave_base, options, daysinyear=timedata.daysinyear)
-    if options.keeptmax:
-        txpct = window_percentile(tmax, options, daysinyear=timedata.daysinyear)
-    if options.keeptmin:
-        tnpct = window_percentile(tmin, options, daysinyear=timedata.daysinyear)
-    if not options.noehf: del tave_base
+    Returns a dictionary of the thresholds found in the cache, the base period
+    data from separate base period files, the full tmax and tmin series and
+    the latitudes. It only reads input files, so bands can be loaded in a
+    Prefetcher while others are calculated.
+    """
+    if options.maskfile: bandmask = mask[rows]
+    else: bandmask = None
+    cacherows = rows
+    if rows==slice(None): cacherows = None
+
+    # Look up the thresholds in the cache
+    loaded = {'tpct': None, 'txpct': None, 'tnpct': None}
+    if options.cachedir:
+        if options.keeptave: loaded['tpct'] = tcache.load(options, timedata, 'tave', bandmask, cacherows)
+        if options.keeptmax: loaded['txpct'] = tcache.load(options, timedata, 'tmax', bandmask, cacherows)
+        if options.keeptmin: loaded['tnpct'] = tcache.load(options, timedata, 'tmin', bandmask, cacherows)
+
+    # Load the temperature data over the base period if it is in other files
+    loaded['tmax_bp'] = loaded['tmin_bp'] = None
+    loaded['needtmax'] = (options.keeptave and loaded['tpct'] is None) or (options.keeptmax and loaded['txpct'] is None)
+    loaded['needtmin'] = (options.keeptave and loaded['tpct'] is None) or (options.keeptmin and loaded['tnpct'] is None)
+    if loaded['needtmax'] and options.bpfx:
+        loaded['tmax_bp'] = ncio.load_bp_data(options, timedata, variable='tmax', mask=mask, rows=rows)
+    if loaded['needtmin'] and options.bpfn:
+        loaded['tmin_bp'] = ncio.load_bp_data(options, timedata, variable='tmin', mask=mask, rows=rows)
 
     # Load all data
     if options.verbose: print("Loading data")
+    loaded['tmax'] = loaded['tmin'] = None
     if options.keeptave or options.keeptmax:
-        tmax, lats = ncio.get_all_data(options.tmaxfile, options.tmaxvname, options)
-        original_shape = tmax.shape
+        loaded['tmax'], loaded['lats'] = ncio.get_all_data(options.tmaxfile, options.tmaxvname, options, rows, mask)
     if options.keeptave or options.keeptmin:
-        tmin, lats = ncio.get_all_data(options.tminfile, options.tminvname, options)
-        original_shape = tmin.shape
-    if options.keeptave:
-        tave = (tmax + tmin)/2.
+        loaded['tmin'], loaded['lats'] = ncio.get_all_data(options.tminfile, options.tminvname, options, rows, mask)
+    return loaded
+
+
+def calculate_region(options, timedata, mask=None, rows=slice(None), loaded=None, outputs=None, metadata=None):
+    """calculate_region loads a band of latitude rows and calculates its
+    thresholds, heatwave definitions and heatwave aspects.
+
+    The default band is the whole grid. loaded is the result of load_region
+    if the band has already been read. If outputs is given, the output files
+    are created in it from the InputMetadata metadata when it is empty, and
+    without --workers the daily output is written as it is calculated. Returns the results of
+    heatwave_chain with the spatial axes of the daily output and thresholds
+    restored, the first year and the shape of the band's daily data.
+    """
+    if options.maskfile: bandmask = mask[rows]
+    else: bandmask = None
+    cacherows = rows
+    if rows==slice(None): cacherows = None
+    if loaded is None: loaded = load_region(options, timedata, mask, rows)
+    tpct, txpct, tnpct = loaded['tpct'], loaded['txpct'], loaded['tnpct']
+    tmax_bp, tmin_bp = loaded['tmax_bp'], loaded['tmin_bp']
+    tmax, tmin, lats = loaded['tmax'], loaded['tmin'], loaded['lats']
+    needtmax, needtmin = loaded['needtmax'], loaded['needtmin']
+    # Let the data be freed as soon as it is replaced below
+    loaded.clear()
+    calculated = {'tave': options.keeptave and tpct is None,
+            'tmax': options.keeptmax and txpct is None,
+            'tmin': options.keeptmin and tnpct is None}
+    if tmax is not None: original_shape = tmax.shape
+    if tmin is not None: original_shape = tmin.shape
+    # Only land points are loaded with a mask.
+    if options.maskfile: original_shape = original_shape[:1]+bandmask.shape
 
     # Remove leap days from data
     if (timedata.calendar=='gregorian')|(timedata.calendar=='proleptic_gregorian')|(timedata.calendar=='standard'):
-        if options.keeptave:
-            tave = tave[(timedata.dates.month!=2)|(timedata.dates.day!=29),...]
-            original_shape = (tave.shape[0], original_shape[1], original_shape[2])
-        if options.keeptmax or options.keeptave:
+        if tmax is not None:
             tmax = tmax[(timedata.dates.month!=2)|(timedata.dates.day!=29),...]
             original_shape = (tmax.shape[0], original_shape[1], original_shape[2])
-        if options.keeptmin or options.keeptave:
+        if tmin is not None:
             tmin = tmin[(timedata.dates.month!=2)|(timedata.dates.day!=29),...]
             original_shape = (tmin.shape[0], original_shape[1], original_shape[2])
-        timedata.calendar = '365_day'
+
+    # Otherwise the base period is a view of the full series
+    if (needtmax and not options.bpfx) or (needtmin and not options.bpfn):
+        base = ncio.base_period_slice(options, timedata)
+        if needtmax and not options.bpfx: tmax_bp = tmax[base]
+        if needtmin and not options.bpfn: tmin_bp = tmin[base]
 
     # Remove incomplete starting year
     first_year = timedata.dayone.year
     if (timedata.dayone.month!=1)|(timedata.dayone.day!=1):
         first_year = timedata.dayone.year+1
         start = np.argmax(timedata.dates.year==first_year)
-        if options.keeptave:
-            tave = tave[start:,...]
-            original_shape = (tave.shape[0], original_shape[1], original_shape[2])
-        if options.keeptmax:
+        if tmax is not None:
             tmax = tmax[start:,...]
             original_shape = (tmax.shape[0], original_shape[1], original_shape[2])
-        if options.keeptmin:
+        if tmin is not None:
             tmin = tmin[start:,...]
             original_shape = (tmin.shape[0], original_shape[1], original_shape[2])
-    
-    # Apply mask
-    if options.maskfile:
-        if options.keeptave:
-            tave = tave[:,mask]
-        if options.keeptmax:
-            tmax = tmax[:,mask]
-        if options.keeptmin:
-            tmin = tmin[:,mask]
+
+    # Hemisphere of each column
+    south = south_columns(np.asarray(lats<=0)[rows], bandmask, original_shape[2])
+    if options.maskfile: space = (bandmask.sum(),)
+    else: space = original_shape[1:]
+
+    # Every gridcell is a column of the data
+    data = {'tmax': tmax, 'tmin': tmin, 'tmax_bp': tmax_bp, 'tmin_bp': tmin_bp,
+            'tpct': tpct, 'txpct': txpct, 'tnpct': tnpct}
+    del tmax, tmin, tmax_bp, tmin_bp
+    for key in data:
+        if data[key] is not None:
+            data[key] = data[key].reshape((data[key].shape[0], -1))
+
+    # The output files can be made once the length of the daily data is known
+    writers = None
+    if outputs is not None:
+        with ncio.iolock:
+            if not outputs: outputs.update(create_outputs(options, timedata, original_shape, metadata, first_year))
+        if options.workers<=1: writers = daily_writers(outputs, options, mask, rows)
 
     if options.verbose: print("Caclulating definition")
-    # Calculate EHF
-    if not options.noehf:
-        EHF = np.ma.ones(tave.shape)*np.nan
-        for i in range(32,tave.shape[0]):
-            EHIaccl = tave[i-2:i+1,...].sum(axis=0)/3. - tave[i-32:i-2,...].sum(axis=0)/30.
-            EHIsig = tave[i-2:i+1,...].sum(axis=0)/3. - tpct[i-timedata.daysinyear*int((i+1)/timedata.daysinyear),...]
-            EHF[i,...] = np.ma.maximum(EHIaccl,1.)*EHIsig
-        EHF[EHF<0] = 0
-    if options.ehi:
-        EHIaccl = np.ma.ones(tave.shape)*np.nan
-        EHIsig = np.ma.ones(tave.shape)*np.nan
-        for i in range(32,tave.shape[0]):
-            EHIaccl[i,...] = tave[i-2:i+1,...].sum(axis=0)/3. - tave[i-32:i-2,...].sum(axis=0)/30.
-            EHIsig[i,...] = tave[i-2:i+1,...].sum(axis=0)/3. - tpct[i-timedata.daysinyear*int((i+1)/timedata.daysinyear),...]
+    # A band without land has no columns to split between processes
+    if (options.workers>1) and len(south):
+        results = parallel_chain(options, timedata, first_year, south, **data)
+    else:
+        results = heatwave_chain(options, timedata, first_year, south, writers=writers, **data)
+    del data
+    # Restore the spatial axes of daily output and thresholds
+    for key in results:
+        if not isinstance(results[key], tuple) and results[key] is not None:
+            results[key] = results[key].reshape((results[key].shape[0],)+space)
+    if options.cachedir:
+        if calculated['tave']: tcache.store(options, timedata, 'tave', results['tpct'], bandmask, cacherows)
+        if calculated['tmax']: tcache.store(options, timedata, 'tmax', results['txpct'], bandmask, cacherows)
+        if calculated['tmin']: tcache.store(options, timedata, 'tmin', results['tnpct'], bandmask, cacherows)
+    return results, first_year, original_shape
 
-    # Tx90pc exceedences
-    if options.keeptmin or options.keeptmax:
-        if options.keeptmax:
-            txexceed = np.ma.ones(tmax.shape)*np.nan
-            for i in range(0,tmax.shape[0]):
-                idoy = i-timedata.daysinyear*int((i+1)/timedata.daysinyear)
-                txexceed[i,...] = tmax[i,...]>txpct[idoy,...]
-            txexceed[txexceed>0] = tmax[txexceed>0]
-        if options.keeptmin:
-            tnexceed = np.ma.ones(tmin.shape)*np.nan
-            for i in range(0,tmin.shape[0]):
-                idoy = i-timedata.daysinyear*int((i+1)/timedata.daysinyear)
-                tnexceed[i,...] = tmin[i,...]>tnpct[idoy,...]
-            tnexceed[tnexceed>0] = tmin[tnexceed>0]
 
-    # Calculate daily output
-    if options.dailyout or options.dailyout: event, ends = identify_hw(EHF)
-    if options.tx90pcd: event_tx, ends_tx = identify_hw(txexceed)
-    if options.tn90pcd: event_tn, ends_tn = identify_hw(tnexceed)
+def south_columns(southrows, bandmask, nlon):
+    """south_columns returns which columns of the (time, space) data of a
+    band of rows are in the southern hemisphere, given which of its rows are.
+    With a land-sea mask the columns are the land points of bandmask."""
+    if bandmask is not None: return np.broadcast_to(southrows[:,None], bandmask.shape)[bandmask]
+    return np.repeat(southrows, nlon)
 
-    nyears = len(range(first_year,timedata.daylast.year+1))
 
-    # Calculate yearly output
+def calculate_stored_region(options, timedata, first_year, mask=None, rows=slice(None), loaded=None):
+    """calculate_stored_region calculates the yearly heatwave aspects of a
+    band of latitude rows from the series of a --from-store file, as loaded
+    by ncio.read_store. Returns the results like calculate_region.
+    """
+    if options.maskfile: bandmask = mask[rows]
+    else: bandmask = None
+    if loaded is None: loaded = ncio.read_store(options, mask, rows)
+    nlon = len(ncio.get_fileset(options.fromstore).lons)
+    south = south_columns(loaded['south'], bandmask, nlon)
+    results = {'tpct': loaded.get('tpct'), 'txpct': loaded.get('txpct'), 'tnpct': loaded.get('tnpct')}
+    results.update(yearly_aspects(options, timedata, first_year, south, loaded))
+    return results
+
+
+def tile_rows(options, gridshape):
+    """tile_rows returns the number of latitude rows to calculate at a time.
+
+    With --max-memory the band is as large as fits in that many megabytes
+    given about bytesperday bytes per gridcell per day, counting the bands
+    read ahead with --prefetch.
+    """
+    ntime, nlat, nlon = gridshape
+    if options.tile: return min(options.tile, nlat)
+    if options.maxmemory:
+        # Prefetched bands share the memory with the band being calculated.
+        maxmemory = options.maxmemory/(1+options.prefetch)
+        return max(1, min(nlat, int(maxmemory*1024**2/(bytesperday*ntime*nlon))))
+    return nlat
+
+
+def latitude_bands(options, gridshape):
+    """latitude_bands splits the latitude rows of a (time, lat, lon) grid into
+    the slices of rows that are calculated at a time."""
+    nlat = gridshape[1]
+    nrows = tile_rows(options, gridshape)
+    if nrows<nlat: return [slice(start, min(start+nrows, nlat)) for start in range(0, nlat, nrows)]
+    return [slice(None)]
+
+
+def create_outputs(options, timedata, original_shape, metadata, first_year=None):
+    """create_outputs creates the output files and returns them in a
+    dictionary so that bands of rows can be written to them. first_year is
+    the first year of the series saved with --store."""
+    outputs = {}
     if options.yearlyout:
-        if options.verbose: print("Calculating yearly aspects")
-        # Split by latitude
-        north = (lats>0).any()
-        south = (lats<=0).any()
-        if not options.noehf:
-            HWA_EHF, HWM_EHF, HWN_EHF, HWF_EHF, HWD_EHF, HWT_EHF = split_hemispheres(EHF)
-        if options.tx90pc:
-            HWA_tx, HWM_tx, HWN_tx, HWF_tx, HWD_tx, HWT_tx = split_hemispheres(txexceed)
-        if options.tn90pc:
-            HWA_tn, HWM_tn, HWN_tn, HWF_tn, HWD_tn, HWT_tn = split_hemispheres(tnexceed)
-        
-    if options.verbose: print("Saving")
+        if not options.noehf: outputs['EHF_yearly'] = ncio.create_yearly("EHF", timedata, options, metadata)
+        if options.tx90pc: outputs['tx_yearly'] = ncio.create_yearly("tx90pct", timedata, options, metadata)
+        if options.tn90pc: outputs['tn_yearly'] = ncio.create_yearly("tn90pct", timedata, options, metadata)
+    if options.dailyout:
+        if options.keeptave: outputs['EHF_daily'] = ncio.create_daily(options, timedata, original_shape, 'EHF', metadata)
+        if options.tx90pcd: outputs['tx_daily'] = ncio.create_daily(options, timedata, original_shape, 'tx90pct', metadata)
+        if options.tn90pcd: outputs['tn_daily'] = ncio.create_daily(options, timedata, original_shape, 'tn90pct', metadata)
+    if options.ehi:
+        outputs['EHI'] = ncio.create_ehi(options, timedata, original_shape, metadata)
+    if options.storefile:
+        outputs['store'] = ncio.create_store(options, timedata, original_shape, first_year,
+                compute_type(options), metadata)
+    return outputs
+
+
+def daily_writers(outputs, options, mask, rows=slice(None)):
+    """daily_writers returns a DailyWriter for the band of rows of each daily
+    output file, by definition."""
+    writers = {}
+    for defn, key in (('EHF', 'EHF_daily'), ('tx90pct', 'tx_daily'), ('tn90pct', 'tn_daily')):
+        if key in outputs:
+            writers[defn] = ncio.DailyWriter(outputs[key], identify_hw, options, mask, defn, rows)
+    return writers
+
+
+def write_outputs(outputs, results, options, mask, rows=slice(None)):
+    """write_outputs writes the results of a band of rows to the output files."""
     # Save yearly data to netcdf
     if options.yearlyout:
         if not options.noehf:
-            ncio.save_yearly(HWA_EHF,HWM_EHF,HWN_EHF,HWF_EHF,HWD_EHF,HWT_EHF,tpct,"EHF",timedata,options,mask)
+            HWA_EHF, HWM_EHF, HWN_EHF, HWF_EHF, HWD_EHF, HWT_EHF = results['EHF_aspects']
+            ncio.write_yearly(outputs['EHF_yearly'],HWA_EHF,HWM_EHF,HWN_EHF,HWF_EHF,HWD_EHF,HWT_EHF,results['tpct'],"EHF",options,mask,rows)
         if options.tx90pc:
-            ncio.save_yearly(HWA_tx,HWM_tx,HWN_tx,HWF_tx,HWD_tx,HWT_tx,txpct,"tx90pct",timedata,options,mask)
+            HWA_tx, HWM_tx, HWN_tx, HWF_tx, HWD_tx, HWT_tx = results['tx_aspects']
+            ncio.write_yearly(outputs['tx_yearly'],HWA_tx,HWM_tx,HWN_tx,HWF_tx,HWD_tx,HWT_tx,results['txpct'],"tx90pct",options,mask,rows)
         if options.tn90pc:
-            ncio.save_yearly(HWA_tn,HWM_tn,HWN_tn,HWF_tn,HWD_tn,HWT_tn,tnpct,"tn90pct",timedata,options,mask)
+            HWA_tn, HWM_tn, HWN_tn, HWF_tn, HWD_tn, HWT_tn = results['tn_aspects']
+            ncio.write_yearly(outputs['tn_yearly'],HWA_tn,HWM_tn,HWN_tn,HWF_tn,HWD_tn,HWT_tn,results['tnpct'],"tn90pct",options,mask,rows)
 
-    # Save daily data to netcdf
+    # Save daily data to netcdf if it was not written as it was calculated
     if options.dailyout:
-        if options.keeptave:
-            ncio.save_daily(EHF, event, ends, options, timedata, original_shape, mask, defn='EHF')
-        if options.tx90pcd:
-            ncio.save_daily(txexceed, event_tx, ends_tx, options, timedata, original_shape, mask, defn='tx90pct')
-        if options.tn90pcd:
-            ncio.save_daily(tnexceed, event_tn, ends_tn, options, timedata, original_shape, mask, defn='tn90pct')
+        if 'EHF' in results:
+            ncio.write_daily(outputs['EHF_daily'], results['EHF'], results['event'], results['ends'], options, mask, 'EHF', rows)
+        if 'txexceed' in results:
+            ncio.write_daily(outputs['tx_daily'], results['txexceed'], results['event_tx'], results['ends_tx'], options, mask, 'tx90pct', rows)
+        if 'tnexceed' in results:
+            ncio.write_daily(outputs['tn_daily'], results['tnexceed'], results['event_tn'], results['ends_tn'], options, mask, 'tn90pct', rows)
 
     # save EHIs
     if options.ehi:
-        ncio.save_ehi(EHIsig, EHIaccl, options, timedata, original_shape, mask)
\ No newline at end of file
+        ncio.write_ehi(outputs['EHI'], results['EHIsig'], results['EHIaccl'], options, mask, rows)
+
+    # Save the series to recalculate yearly aspects from
+    if 'store' in outputs:
+        ncio.write_store(outputs['store'], results, options, mask, rows)
+
+
+class HeatwavePipeline(object):
+    """HeatwavePipeline calculates heatwaves in stages that can be called
+    from Python, so that many runs share one process, its imports and its
+    indexes of input files.
+
+    load reads a band of latitude rows of the input files. thresholds, index
+    and aspects calculate the thresholds, the daily series and the yearly
+    aspects from (time, space) arrays in memory, and save writes results to
+    the output files. calculate runs every stage on a band of rows and run
+    calculates and saves the whole grid, as the script does.
+
+    The time data, metadata and land-sea mask are read from the input files,
+    or the --from-store file, when they are not given. Setting up a pipeline
+    sets the write block size and scratch directory of the options for the
+    process, or their defaults if the options do not give them, so they do
+    not carry over from an earlier pipeline.
+    """
+
+    def __init__(self, options, timedata=None, metadata=None, mask=None, first_year=None):
+        self.options = options
+        if options.writeblock: ncio.writeblocksize = int(options.writeblock*1024**2)
+        else: ncio.writeblocksize = ncio.defaultwriteblocksize
+        scratch.directory = options.scratchdir
+        if options.fromstore and timedata is None:
+            timedata, metadata, mask, first_year = ncio.open_store(options)
+        if timedata is None: timedata = ncio.get_time_data(options)
+        if options.maskfile and mask is None: mask = ncio.get_mask(options)
+        self.timedata = timedata
+        self.metadata = metadata
+        self.mask = mask
+        self.first_year = first_year
+        self.outputs = {}
+
+    def gridshape(self):
+        """gridshape returns the number of days, latitudes and longitudes of
+        the input data."""
+        if self.options.fromstore:
+            return (ncio.get_fileset(self.options.fromstore).ntime, len(self.metadata.lats), len(self.metadata.lons))
+        if self.options.tmaxfile:
+            return ncio.get_grid_shape(self.options.tmaxfile, self.options.tmaxvname, self.options.timevname)
+        return ncio.get_grid_shape(self.options.tminfile, self.options.tminvname, self.options.timevname)
+
+    def load(self, rows=slice(None)):
+        """load reads a band of latitude rows, with load_region or from the
+        --from-store file with ncio.read_store."""
+        if self.options.fromstore: return ncio.read_store(self.options, self.mask, rows)
+        return load_region(self.options, self.timedata, self.mask, rows)
+
+    def thresholds(self, tmax_bp=None, tmin_bp=None, tpct=None, txpct=None, tnpct=None):
+        """thresholds returns the thresholds of calculate_thresholds."""
+        return calculate_thresholds(self.options, self.timedata, tmax_bp, tmin_bp, tpct, txpct, tnpct)
+
+    def index(self, thresholds, tmax=None, tmin=None):
+        """index returns the daily EHF and exceedance series of daily_series."""
+        return daily_series(self.options, self.timedata, thresholds, tmax, tmin)
+
+    def aspects(self, series, south, first_year=None):
+        """aspects returns the yearly aspects of yearly_aspects. first_year
+        defaults to that of the last band calculated."""
+        if first_year is None: first_year = self.first_year
+        return yearly_aspects(self.options, self.timedata, first_year, south, series)
+
+    def calculate(self, rows=slice(None), loaded=None):
+        """calculate runs every stage on a band of latitude rows of the input
+        files, as loaded by load if given, and returns the results. The output
+        files are created in outputs when the first band is calculated, and
+        without --workers the daily output is written as it is calculated."""
+        if self.metadata is None: self.metadata = ncio.InputMetadata(self.options)
+        if self.options.fromstore:
+            return calculate_stored_region(self.options, self.timedata, self.first_year, self.mask, rows, loaded)
+        results, self.first_year, original_shape = calculate_region(self.options, self.timedata,
+                self.mask, rows, loaded, self.outputs, self.metadata)
+        return results
+
+    def save(self, results, rows=slice(None), original_shape=None):
+        """save writes the results of a band of latitude rows to the output
+        files. If they have not been made yet they are created for daily
+        data of original_shape, which defaults to the shape of the input."""
+        if self.metadata is None: self.metadata = ncio.InputMetadata(self.options)
+        with ncio.iolock:
+            if not self.outputs:
+                if original_shape is None: original_shape = self.gridshape()
+                self.outputs.update(create_outputs(self.options, self.timedata, original_shape,
+                        self.metadata, self.first_year))
+            write_outputs(self.outputs, results, self.options, self.mask, rows)
+
+    def close(self):
+        """close closes the output files."""
+        with ncio.iolock:
+            for output in self.outputs.values():
+                output.close()
+        self.outputs = {}
+
+    def run(self):
+        """run calculates and saves the whole grid in bands of latitude rows,
+        reading the next bands in the background with --prefetch."""
+        options = self.options
+        if self.metadata is None: self.metadata = ncio.InputMetadata(self.options)
+        bands = latitude_bands(options, self.gridshape())
+        prefetcher = ncio.Prefetcher(self.load, bands, options.prefetch)
+        stagetime = {'calculate': 0., 'save': 0.}
+        for rows, loaded in prefetcher:
+            if (len(bands)>1) and options.verbose: print("Latitude rows %d to %d"%(rows.start, rows.stop-1))
+            start = time.time()
+            results = self.calculate(rows, loaded)
+            del loaded
+            stagetime['calculate'] += time.time()-start
+
+            if options.verbose: print("Saving")
+            start = time.time()
+            self.save(results, rows)
+            del results
+            stagetime['save'] += time.time()-start
+        self.close()
+        if options.verbose:
+            print("Reading %.1fs, of which %.1fs was not hidden by calculation"%(prefetcher.readtime, prefetcher.waittime))
+            print("Calculating %.1fs, saving %.1fs"%(stagetime['calculate'], stagetime['save']))
+
+
+if __name__=='__main__':
+
+    # Get the options and variables
+    options = getoptions.parse_arguments(sys.argv[1:])
+
+    # Load time data, the land-sea mask and the metadata copied to the outputs
+    if options.verbose: print("Loading data")
+    HeatwavePipeline(options).run()
@@ -30,12 +30,24 @@ class InvalidBPFormatError(Exception):
         print("The provided base period (", baseperiod, ")  must be formatted ????-????)")
 
 
+class InvalidChunksError(Exception):
+    """Exception to be raised when the chunks are not timeseries, map or three sizes."""
+    def __init__(self, chunks):
+        print("The provided chunks (", chunks, ") must be timeseries, map or formatted TIME,LAT,LON")
+
+
 class InvalidSeasonError(Exception):
     """Exception to be raised when the  given season is not summer or winter."""
     def __init__(self, season):
         print("The provided season much be either winter or summer. You specified ", season)
 
 
+class FromStoreOptionError(Exception):
+    """Exception to be raised when an option that needs the temperature data is used with --from-store."""
+    def __init__(self, option):
+        print("Only yearly heatwaves can be calculated from a store, so", option, "can not be used with --from-store.")
+
+
 def parse_arguments(arguments):
     """parse_arguments parses the arguments to an options object, and handles some errors."""
     # Construct the options for the parser
@@ -53,6 +65,21 @@ def parse_arguments(arguments):
     parser.add_option('-p', dest='pcntl', type='float', default=90, help='the percentile to use for thresholds. Defaults to 90', metavar='INT')
     parser.add_option('--base', dest='bp', default='1961-1990', help='base period to calculate thresholds. Default 1961-1990', metavar='YYYY-YYYY')
     parser.add_option('-q', '--qmethod', dest='qtilemethod', default='climpact', help='quantile interpolation method. Default is climpact', metavar='STR')
+    parser.add_option('--cache', dest='cachedir', help='directory to cache percentile thresholds in', metavar='DIR')
+    parser.add_option('--cache-size', dest='cachesize', type='float', default=10240, help='maximum size of the threshold cache. Default 10240', metavar='MB')
+    parser.add_option('--workers', dest='workers', type='int', default=1, help='number of processes to split the grid between. Default 1', metavar='N')
+    parser.add_option('--tile', dest='tile', type='int', help='calculate and save bands of this many latitude rows at a time', metavar='ROWS')
+    parser.add_option('--max-memory', dest='maxmemory', type='float', help='calculate bands of latitude rows that fit in this much memory', metavar='MB')
+    parser.add_option('--prefetch', dest='prefetch', type='int', default=0, help='number of bands of rows to read ahead in the background. Default 0', metavar='BANDS')
+    parser.add_option('--scratch', dest='scratchdir', help='directory to memory map large daily intermediate arrays in, so they need not fit in memory', metavar='DIR')
+    parser.add_option('--precision', dest='precision', type='choice', choices=['double','single'], default='double', help='precision of temperatures, thresholds and heat indices while calculating: double or single. Default double', metavar='STR')
+    parser.add_option('--store', dest='storefile', help='save the daily EHF and exceedance series to FILE, to calculate other seasons and methods from with --from-store', metavar='FILE')
+    parser.add_option('--from-store', dest='fromstore', help='calculate the yearly heatwaves from the series saved with --store instead of the temperature data', metavar='FILE')
+    parser.add_option('--output-dir', dest='outdir', help='directory to save the output files in. Default the current directory', metavar='DIR')
+    parser.add_option('--output-type', dest='outtype', type='choice', choices=['f8','f4','i2'], default='f8', help='type of output variables: f8, f4 or i2 packed with a scale_factor. Unless f8, event indicators are i1 and i2. Default f8', metavar='TYPE')
+    parser.add_option('--compress', dest='compress', type='int', default=0, help='zlib compression level of output variables from 1 to 9, with shuffling. Default 0 (off)', metavar='LEVEL')
+    parser.add_option('--chunks', dest='chunks', help='chunk output variables for timeseries or map access, or by TIME,LAT,LON chunk sizes. Default netcdf chunking', metavar='SHAPE')
+    parser.add_option('--write-block', dest='writeblock', type='float', help='megabytes of gridded output to write at a time. Default 64', metavar='MB')
     parser.add_option('-d', '--daily', action="store_true", dest='daily', default=False, help='output daily EHF values and heatwave indicators')
     parser.add_option('--ehi', dest='ehi', action='store_true', default=False, help='Save the EHI values')
     parser.add_option('--dailyonly', action="store_true", dest='dailyonly', help='output only daily EHF values and suppress yearly output')
@@ -71,7 +98,12 @@ def parse_arguments(arguments):
     options, args = parser.parse_args(arguments)
 
     # Handle errors and warnings
-    if not options.tmaxfile and not options.tminfile: raise NoTmaxTminFileError
+    if not options.tmaxfile and not options.tminfile and not options.fromstore: raise NoTmaxTminFileError
+    if options.fromstore:
+        for option, used in (('--daily', options.daily), ('--dailyonly', options.dailyonly),
+                ('--tx90pc-daily', options.tx90pcd), ('--tn90pc-daily', options.tn90pcd),
+                ('--ehi', options.ehi), ('--store', options.storefile)):
+            if used: raise FromStoreOptionError(option)
     if not '-' in options.bp: raise InvalidBPFormatError(options.bp)
     try:
         int(options.bp[:options.bp.index('-')])
@@ -80,8 +112,15 @@ def parse_arguments(arguments):
         print('Base period years are not numbers.')
     assert int(options.bp[:4])<int(options.bp[5:9]), "Base period start is after end year."
     if (options.season!='summer')&(options.season!='winter'): raise InvalidSeasonError(options.season)
+    if options.chunks and (options.chunks not in ('timeseries', 'map')):
+        try:
+            options.chunks = tuple([int(size) for size in options.chunks.split(',')])
+        except ValueError:
+            raise InvalidChunksError(options.chunks)
+        if len(options.chunks)!=3: raise InvalidChunksError(options.chunks)
+    assert 0<=options.compress<=9, "Compression level must be from 0 to 9."
     warnmsg = "You didn't specify a land-sea mask. It's faster if you do, so this might take a while."
-    if not options.maskfile: warnings.warn(warnmsg, UserWarning)
+    if not options.maskfile and not options.fromstore: warnings.warn(warnmsg, UserWarning)
 
     # Additional options
     options.bpstart = int(options.bp[:4])
@@ -7,11 +7,16 @@ Created on Sat Apr 14 12:56:42 2018
 @author: Tammas Loughran
 """
 import sys
+import os
+import glob
+import time
+import queue
+import threading
 import datetime as dt
 try:
     modulename = 'netCDF4'
     import netCDF4 as nc
-    from netCDF4 import MFDataset, MFTime, Dataset
+    from netCDF4 import Dataset
     modulename = 'pandas'
     import pandas as pd
 except ImportError:
@@ -23,6 +28,13 @@ import numpy as np
 # define fill value and missing values
 missingval = -999.99 # for missing data
 fillval = -888.88 # for land-sea masked gridpoints
+readblocksize = 2**26 # bytes read from a file at a time by read_masked
+maxchunkdays = 3650 # longest time chunk of --chunks=timeseries
+defaultwriteblocksize = 2**26 # default of writeblocksize
+writeblocksize = defaultwriteblocksize # bytes of gridded output written at a time by write_band
+# The netCDF and HDF5 libraries are not thread safe, so netcdf calls made while
+# a Prefetcher is reading hold this lock.
+iolock = threading.RLock()
 
 
 class DatesOrderError(Exception):
@@ -36,6 +48,14 @@ class DatesOrderError(Exception):
         print("end: ", self.end)
 
 
+class StoreVariableError(Exception):
+    """Exception to be raised when a --from-store file does not have a series
+    that the requested definitions need."""
+
+    def __init__(self, storefile, vname):
+        print("The store file", storefile, "does not have the", vname, "series. Save it with the same definitions.")
+
+
 class Calendar360():
     """Creates a basic calendar object with 360 days per year."""
 
@@ -61,10 +81,205 @@ class Calendar360():
         return dt.datetime(self.year[i], self.month[i], self.day[i])
 
 
+class FileSet(object):
+    """A set of netcdf files that hold consecutive parts of a time series.
+
+    The files are opened once to build an index of their time steps, sorted
+    by their first time, and to read the global attributes, coordinates and
+    variable shapes of the first file. Reads open only the files that
+    overlap the requested time steps.
+    """
+
+    def __init__(self, files, timevname='time'):
+        if any([(wildcard in files) for wildcard in ['*','?','[']]):
+            paths = glob.glob(files)
+        else:
+            paths = [files]
+        index = []
+        for path in paths:
+            ncfile = Dataset(path, 'r')
+            nctime = ncfile.variables[timevname]
+            calendar = getattr(nctime, 'calendar', None)
+            if nctime.units=='day as %Y%m%d.%f':
+                first = nctime[0]
+            else:
+                first = nc.num2date(nctime[0], nctime.units, calendar=calendar or 'standard')
+            index.append((first, path, len(nctime), (nctime[0], nctime.units), (nctime[-1], nctime.units)))
+            ncfile.close()
+        index.sort(key=lambda entry: entry[0])
+        self.paths = [entry[1] for entry in index]
+        self.lengths = [entry[2] for entry in index]
+        self.offsets = np.cumsum([0]+self.lengths[:-1])
+        self.ntime = sum(self.lengths)
+        self.firsttime = index[0][3]
+        self.lasttime = index[-1][4]
+        # Metadata and coordinates of the first file
+        ncfile = Dataset(self.paths[0], 'r')
+        self.attributes = dict([(name, ncfile.getncattr(name)) for name in ncfile.ncattrs()])
+        try:
+            self.calendar = ncfile.variables[timevname].calendar
+        except AttributeError:
+            self.calendar = None
+        latnames = ('lat', 'lats', 'latitude', 'latitudes')
+        latkey = [vrbl in latnames for vrbl in ncfile.variables.keys()].index(True)
+        self.latvname = list(ncfile.variables.keys())[latkey]
+        lonnames = ('lon', 'lons', 'longitude', 'longitudes')
+        lonkey = [vrbl in lonnames for vrbl in ncfile.variables.keys()].index(True)
+        self.lonvname = list(ncfile.variables.keys())[lonkey]
+        self.lats = ncfile.variables[self.latvname][:]
+        self.lons = ncfile.variables[self.lonvname][:]
+        self.shapes = {}
+        self.units = {}
+        for name, variable in ncfile.variables.items():
+            self.shapes[name] = variable.shape
+            self.units[name] = getattr(variable, 'units', None)
+        ncfile.close()
+
+    def shape(self, vname):
+        """shape returns the number of time steps, latitudes and longitudes
+        of a variable."""
+        return (self.ntime, self.shapes[vname][-2], self.shapes[vname][-1])
+
+    def read(self, vname, times=slice(None), rows=slice(None), mask=None):
+        """read streams time steps of a variable from each file that overlaps
+        them into one array.
+
+        rows selects a band of latitude rows and mask, the land-sea mask of
+        those rows, selects land points as in read_masked.
+
+        Returns a (time, lat, lon) or (time, land) masked array.
+        """
+        start, stop, step = times.indices(self.ntime)
+        data = None
+        for path, offset, length in zip(self.paths, self.offsets, self.lengths):
+            first, last = max(start, offset), min(stop, offset+length)
+            if first>=last: continue
+            with iolock:
+                ncfile = Dataset(path, 'r')
+                if mask is not None:
+                    block = read_masked(ncfile.variables[vname], mask, slice(first-offset, last-offset), rows)
+                else:
+                    block = ncfile.variables[vname][first-offset:last-offset,...,rows,:]
+                    if len(block.shape)==4: block = block.squeeze(axis=1)
+                ncfile.close()
+            if data is None:
+                data = np.empty((stop-start,)+block.shape[1:], dtype=block.dtype)
+                datamask = np.zeros(data.shape, dtype=bool)
+            data[first-start:last-start] = np.ma.getdata(block)
+            datamask[first-start:last-start] = np.ma.getmaskarray(block)
+        return np.ma.array(data, mask=datamask)
+
+
+# File sets that have been indexed, by file pattern and time variable name
+filesets = {}
+
+
+def get_fileset(files, timevname='time'):
+    """get_fileset returns the FileSet of files, indexing it on first use."""
+    with iolock:
+        if (files, timevname) not in filesets:
+            filesets[(files, timevname)] = FileSet(files, timevname)
+        return filesets[(files, timevname)]
+
+
+class InputMetadata(object):
+    """InputMetadata holds the attributes and coordinates of the input data
+    and the version of this code that are copied to every output file, so
+    output files are made without reading the inputs again. files are read
+    instead of the tmax or tmin files if given."""
+
+    def __init__(self, options, files=None):
+        if files is None:
+            if options.tmaxfile: files = options.tmaxfile
+            else: files = options.tminfile
+        fileset = get_fileset(files, options.timevname)
+        attributes = fileset.attributes
+        self.experiment = attributes.get('experiment', '')
+        self.model = attributes.get('model_id', '')
+        self.parent = attributes.get('parent_experiment_rip', '')
+        self.realization = attributes.get('realization', '')
+        self.initialization = attributes.get('initialization_method', '')
+        self.physics = attributes.get('physics_version', '')
+        if 'physics_version' in attributes:
+            self.rip = 'r'+str(self.realization)+'i'+str(self.initialization)+'p'+str(self.physics)
+        else:
+            self.rip = ''
+        self.lats = fileset.lats
+        self.lons = fileset.lons
+        try:
+            file = open('version', 'r')
+            self.commit = file.read()[:]
+            file.close()
+            if self.commit[-2:]==r'\n': self.commit = self.commit[:-2]
+        except IOError:
+            self.commit = "Unknown. Check date for latest version."
+
+
+class Prefetcher(object):
+    """Prefetcher calls load on each of items in a background thread so that
+    reading the next items overlaps with the calculation of the current one.
+
+    Up to depth loaded items wait in a queue. With a depth of 0 items are
+    loaded as they are iterated over without a thread. Iterating over the
+    Prefetcher gives (item, loaded) pairs in order and raises any error from
+    load. readtime is the time spent loading and waittime the time spent
+    waiting for loaded items, so readtime-waittime is the reading that was
+    hidden behind calculation.
+    """
+
+    def __init__(self, load, items, depth=1):
+        self.load = load
+        self.items = items
+        self.depth = depth
+        self.readtime = 0.
+        self.waittime = 0.
+        if depth>0:
+            self.queue = queue.Queue(maxsize=depth)
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        for item in self.items:
+            start = time.time()
+            try:
+                loaded = self.load(item)
+            except Exception as error:
+                self.queue.put((item, None, error))
+                return
+            self.readtime += time.time()-start
+            self.queue.put((item, loaded, None))
+
+    def __iter__(self):
+        for item in self.items:
+            start = time.time()
+            if self.depth>0:
+                item, loaded, error = self.queue.get()
+                if error is not None: raise error
+            else:
+                loaded = self.load(item)
+                self.readtime += time.time()-start
+            self.waittime += time.time()-start
+            yield item, loaded
+
+
 class TimeData(object):
     """A class to contain all of the time data from an netcdf file."""
 
 
+def fileset_dates(fileset, calendar):
+    """fileset_dates returns the first and last dates of a FileSet."""
+    if fileset.firsttime[1]=='day as %Y%m%d.%f':
+        st = str(int(fileset.firsttime[0]))
+        nd = str(int(fileset.lasttime[0]))
+        dayone = dt.datetime(int(st[:4]), int(st[4:6]), int(st[6:]))
+        daylast = dt.datetime(int(nd[:4]), int(nd[4:6]), int(nd[6:]))
+    else:
+        dayone = nc.num2date(*fileset.firsttime, calendar=calendar)
+        daylast = nc.num2date(*fileset.lasttime, calendar=calendar)
+    return dayone, daylast
+
+
 def get_time_data(options):
     """This function fetches the time and calendar data from the input netcdf files.
 
@@ -77,43 +292,42 @@ def get_time_data(options):
         filename = options.tmaxfile
     elif options.tminfile:
         filename = options.tminfile
-    if any([(wildcard in filename) for wildcard in ['*','?','[']]):
-        tempnc = MFDataset(filename, 'r')
-        nctime = tempnc.variables[options.timevname]
-        nctime = MFTime(nctime)
-    else:
-        tempnc = Dataset(filename, 'r')
-        nctime = tempnc.variables[options.timevname]
-    try:
-        timedata.calendar = nctime.calendar
-    except:
+    fileset = get_fileset(filename, options.timevname)
+    timedata.calendar = fileset.calendar
+    if timedata.calendar is None:
         timedata.calendar = 'proleptic_gregorian'
 
     if not timedata.calendar:
         print('Unrecognized calendar. Using gregorian.')
         timedata.calendar = 'gregorian'
 
+    if timedata.calendar=='360_day':
+        dayone = nc.num2date(*fileset.firsttime, calendar=timedata.calendar)
+        daylast = nc.num2date(*fileset.lasttime, calendar=timedata.calendar)
+    else:
+        dayone, daylast = fileset_dates(fileset, timedata.calendar)
+    return make_time_data(timedata.calendar, dayone, daylast)
+
+
+def make_time_data(calendar, dayone, daylast):
+    """make_time_data returns the TimeData of daily data from dayone to
+    daylast in calendar."""
+    timedata = TimeData()
+    timedata.calendar = calendar
     if timedata.calendar=='360_day':
         timedata.daysinyear = 360
         # 360 day season start and end indices
         timedata.SHS = (300,450)
         timedata.SHW = (120,270)
-        timedata.dayone = nc.num2date(nctime[0], nctime.units, calendar=timedata.calendar)
-        timedata.daylast = nc.num2date(nctime[-1], nctime.units, calendar=timedata.calendar)
+        timedata.dayone = dayone
+        timedata.daylast = daylast
         timedata.dates = Calendar360(timedata.dayone, timedata.daylast)
     else:
         timedata.daysinyear = 365
         # 365 day season start and end indices
         timedata.SHS = (304,455)
         timedata.SHW = (120,273)
-        if tempnc.variables[options.timevname].units=='day as %Y%m%d.%f':
-            st = str(int(nctime[0]))
-            nd = str(int(nctime[-1]))
-            timedata.dayone = dt.datetime(int(st[:4]), int(st[4:6]), int(st[6:]))
-            timedata.daylast = dt.datetime(int(nd[:4]), int(nd[4:6]), int(nd[6:]))
-        else:
-            timedata.dayone = nc.num2date(nctime[0], nctime.units, calendar=timedata.calendar)
-            timedata.daylast = nc.num2date(nctime[-1], nctime.units, calendar=timedata.calendar)
+        timedata.dayone, timedata.daylast = dayone, daylast
         timedata.dates = pd.period_range(str(timedata.dayone), str(timedata.daylast))
         # Remove leap days. Maybe this should be a separate function?
         timedata.noleapdates = timedata.dates[(timedata.dates.month!=2)|(timedata.dates.day!=29)]
@@ -134,8 +348,10 @@ def get_mask(options):
     return mask
 
 
-def load_bp_data(options, timedata, variable='tmax', mask=None):
-    """load_bp_data loads the tmax or tmin data for the baseperiod provided in options."""
+def load_bp_data(options, timedata, variable='tmax', mask=None, rows=slice(None)):
+    """load_bp_data loads the tmax or tmin data for the baseperiod provided in options.
+
+    rows selects a band of latitude rows to load."""
     # Determine if we need tmax or tmin and whether the data are in multiple files.
     if variable=='tmax':
         if options.bpfx:files = options.bpfx
@@ -146,24 +362,8 @@ def load_bp_data(options, timedata, variable='tmax', mask=None):
         else: files = options.tminfile
         varname = options.tminvname
 
-    # Load ncfile depending on multi or single-file
-    if any([(wildcard in files) for wildcard in ['*','?','[']]):
-        tempnc = MFDataset(files, 'r')
-        bptime = tempnc.variables[options.timevname]
-        bptime = MFTime(bptime)
-    else:
-        tempnc = Dataset(files,'r')
-        bptime = tempnc.variables[options.timevname]
-
-    # Define the base period
-    if tempnc.variables[options.timevname].units=='day as %Y%m%d.%f':
-        st = str(int(bptime[0]))
-        nd = str(int(bptime[-1]))
-        bpdayone = dt.datetime(int(st[:4]), int(st[4:6]), int(st[6:]))
-        bpdaylast = dt.datetime(int(nd[:4]), int(nd[4:6]), int(nd[6:]))
-    else:
-        bpdayone = nc.num2date(bptime[0], bptime.units, calendar=timedata.calendar)
-        bpdaylast = nc.num2date(bptime[-1], bptime.units, calendar=timedata.calendar)
+    fileset = get_fileset(files, options.timevname)
+    bpdayone, bpdaylast = fileset_dates(fileset, timedata.calendar)
 
     if timedata.calendar=='360_day': bpdates = Calendar360(bpdayone, bpdaylast)
     else:
@@ -171,99 +371,252 @@ def load_bp_data(options, timedata, variable='tmax', mask=None):
         if timedata.calendar=='365_day': bpdates = bpdates[(bpdates.month!=2)|(bpdates.day!=29)]
         dates_base = bpdates[(options.bpstart<=bpdates.year)&(bpdates.year<=options.bpend)]
 
-    temp = tempnc.variables[varname][(options.bpstart<=bpdates.year)&(bpdates.year<=options.bpend)]
-    if len(temp.shape)==4: temp = temp.squeeze()
-
+    # The base period is a contiguous range of time steps, so only the files
+    # that overlap it are read.
+    inbase = np.nonzero((options.bpstart<=bpdates.year)&(bpdates.year<=options.bpend))[0]
+    times = slice(inbase[0], inbase[-1]+1)
     if options.maskfile:
-        temp = temp[:,mask]
+        temp = fileset.read(varname, times, rows, mask[rows])
+    else:
+        temp = fileset.read(varname, times, rows)
 
-    if tempnc.variables[varname].units=='K': temp -= 273.15
+    if fileset.units[varname]=='K': temp -= 273.15
+    if options.precision=='single': temp = temp.astype(np.float32, copy=False)
 
     # Remove leap days in gregorian calendars
     if (timedata.calendar=='gregorian')|(timedata.calendar=='proleptic_gregorian')|(timedata.calendar=='standard'):
         temp = temp[(dates_base.month!=2)|(dates_base.day!=29),...]
 
-    tempnc.close()
     return temp
 
 
+def read_masked(variable, mask, times=slice(None), rows=slice(None)):
+    """read_masked reads the land points of a (time, lat, lon) variable.
+
+    Only the bounding box of the land in mask, the land-sea mask of the
+    latitude rows, is requested from the file. It is read in blocks of time
+    steps that line up with the file's chunks, so each chunk is decompressed
+    once and the memory used by a block is about readblocksize bytes.
+
+    Returns a (time, land) masked array.
+    """
+    start, stop, step = times.indices(variable.shape[0])
+    landrows = np.nonzero(mask.any(axis=1))[0]
+    landcols = np.nonzero(mask.any(axis=0))[0]
+    if len(landrows)==0:
+        return np.ma.zeros((stop-start, 0), dtype=variable.dtype)
+    offset = rows.indices(variable.shape[-2])[0]
+    box = (slice(offset+landrows[0], offset+landrows[-1]+1), slice(landcols[0], landcols[-1]+1))
+    boxmask = mask[landrows[0]:landrows[-1]+1,landcols[0]:landcols[-1]+1]
+    # Number of time steps per block, a multiple of the time chunk size
+    blocksize = max(1, readblocksize//(boxmask.size*variable.dtype.itemsize))
+    try: chunking = variable.chunking()
+    except AttributeError: chunking = 'contiguous'
+    if chunking!='contiguous':
+        blocksize = max(chunking[0], blocksize//chunking[0]*chunking[0])
+    data = None
+    blockstart = start
+    while blockstart<stop:
+        blockend = min(stop, (blockstart//blocksize+1)*blocksize)
+        block = variable[blockstart:blockend,...,box[0],box[1]]
+        if len(block.shape)==4: block = block.squeeze(axis=1)
+        block = block[:,boxmask]
+        if data is None:
+            data = np.empty((stop-start, block.shape[1]), dtype=block.dtype)
+            landmask = np.zeros(data.shape, dtype=bool)
+        data[blockstart-start:blockend-start] = np.ma.getdata(block)
+        landmask[blockstart-start:blockend-start] = np.ma.getmaskarray(block)
+        blockstart = blockend
+    return np.ma.array(data, mask=landmask)
+
+
+def base_period_slice(options, timedata):
+    """base_period_slice returns the slice of the base period in data loaded
+    by get_all_data once leap days are removed from gregorian calendars."""
+    if timedata.calendar=='360_day': years = timedata.dates.year
+    else: years = timedata.noleapdates.year
+    inbase = np.nonzero((options.bpstart<=years)&(years<=options.bpend))[0]
+    if len(inbase)==0: return slice(0, 0)
+    return slice(inbase[0], inbase[-1]+1)
+
+
+def get_grid_shape(files, vname, timevname='time'):
+    """get_grid_shape returns the number of time steps, latitudes and
+    longitudes of a variable without loading it."""
+    return get_fileset(files, timevname).shape(vname)
+
+
 def remove_leap_days(data, dates):
     """remove_leap_days removes February 29th from a dataset"""
     return data[(dates.month!=2)|(dates.day!=29),...]
 
 
-def get_all_data(files, vname, options):
+def get_all_data(files, vname, options, rows=slice(None), mask=None):
     """get_all_data loads all temperature data from a netcdf file.
 
+    rows selects a band of latitude rows to load. If the land-sea mask is
+    given only the land points are read.
+
     Returns
-    temp - data in (time, x, y) coordinates.
-    lats - latitudes"""
-    if any([(wildcard in files) for wildcard in ['*','?','[']]):
-        tempnc = MFDataset(files, 'r')
+    temp - data in (time, x, y) coordinates, or (time, land) with a mask.
+    lats - latitudes of all rows"""
+    fileset = get_fileset(files, options.timevname)
+    if mask is not None:
+        temp = fileset.read(vname, rows=rows, mask=mask[rows])
     else:
-        tempnc = Dataset(files, 'r')
-    temp = tempnc.variables[vname][:]
-    if len(temp.shape)==4: temp = temp.squeeze()
+        temp = fileset.read(vname, rows=rows)
     # Test for increasing latitude and flip if decreasing
-    latnames = ('lat', 'lats', 'latitude', 'latitudes')
-    latkey = [vrbl in latnames for vrbl in tempnc.variables.keys()].index(True)
-    latvname = list(tempnc.variables.keys())[latkey]
-    lats = tempnc.variables[latvname][:]
+    lats = fileset.lats
     if (lats[-1]-lats[0])<0: lats = np.flipud(lats)
-    if tempnc.variables[vname].units=='K': temp -= 273.15
-    tempnc.close()
+    if fileset.units[vname]=='K': temp -= 273.15
+    if options.precision=='single': temp = temp.astype(np.float32, copy=False)
     return temp, lats
 
 
+def chunk_shape(options, shape):
+    """chunk_shape returns the chunk sizes of a (time, lat, lon) output
+    variable of the given shape for --chunks, or None for the default."""
+    if not options.chunks: return None
+    if options.chunks=='timeseries': chunks = (maxchunkdays, 8, 8)
+    elif options.chunks=='map': chunks = (1,)+tuple(shape[1:])
+    else: chunks = options.chunks
+    return tuple([max(1, min(size, length)) for size, length in zip(chunks, shape)])
+
+
+def create_output(ncfile, name, shape, options, scale=1., valid_range=None,
+        dimensions=('time','lat','lon'), indicator=None):
+    """create_output creates a (time, lat, lon) output variable with the type,
+    compression and chunking given in options.
+
+    Variables are f8 or f4, or i2 packed with scale_factor. indicator is the
+    integer type of an event indicator, which is used instead of f4 and i2.
+    Integer variables have their own fill and missing values, and their
+    valid_range is packed like the data.
+    """
+    dtype = np.dtype(options.outtype)
+    if indicator and options.outtype!='f8': dtype = np.dtype(indicator)
+    if dtype.kind=='f':
+        fill, missing = fillval, missingval
+    else:
+        fill, missing = np.iinfo(dtype).min, np.iinfo(dtype).min+1
+    variable = ncfile.createVariable(name, dtype, dimensions, fill_value=fill,
+            zlib=options.compress>0, complevel=options.compress or 4,
+            chunksizes=chunk_shape(options, shape))
+    if (dtype.kind=='i') and (scale!=1):
+        setattr(variable, 'scale_factor', np.float32(scale))
+        setattr(variable, 'add_offset', np.float32(0.))
+    setattr(variable, 'missing_value', dtype.type(missing))
+    if valid_range is not None:
+        if dtype.kind=='i':
+            valid_range = np.round(np.array(valid_range)/scale).clip(missing+1, np.iinfo(dtype).max).astype(dtype)
+        setattr(variable, 'valid_range', valid_range)
+    return variable
+
+
+def pack(variable, data):
+    """pack converts data to the integer type of variable, dividing by its
+    scale_factor. Masked and fill values become the variable's fill value and
+    nan and missing values its missing value."""
+    info = np.iinfo(variable.dtype)
+    values = np.ma.getdata(data)
+    packed = values/getattr(variable, 'scale_factor', 1.)
+    np.round(packed, out=packed)
+    np.clip(packed, info.min+2, info.max, out=packed)
+    packed = packed.astype(variable.dtype)
+    packed[np.isnan(values)|(values==missingval)] = variable.missing_value
+    packed[np.ma.getmaskarray(data)|(values==fillval)] = variable._FillValue
+    return packed
+
+
+def widen(data):
+    """widen returns single precision data in double precision with its fill
+    and missing values exact, so that they match those of f8 variables."""
+    if data.dtype!=np.float32: return data
+    wide = data.astype(np.float64)
+    wide[data==np.float32(missingval)] = missingval
+    wide[data==np.float32(fillval)] = fillval
+    return wide
+
+
+def write_band(variable, data, mask, rows=slice(None), offset=0):
+    """write_band writes the (time, space) data of a band of latitude rows to
+    variable from time step offset. With a land-sea mask the space axis holds
+    the land points of the band, otherwise it is reshaped to the rows of the
+    band.
+
+    Land points are scattered into a buffer of about writeblocksize bytes
+    that is reused for each block of time steps, so the gridded band is
+    never held in memory at once. Blocks are whole time chunks of variable.
+    Masked land points are written as missingval.
+    """
+    nlon = variable.shape[-1]
+    ntime = data.shape[0]
+    if ntime==0: return
+    if mask is not None:
+        mask = mask[rows]
+        space = mask.shape
+    else:
+        space = (int(np.prod(data.shape[1:]))//nlon, nlon)
+    blocklen = max(1, writeblocksize//(8*space[0]*space[1]))
+    chunking = variable.chunking()
+    if chunking!='contiguous':
+        blocklen = max(chunking[0], blocklen//chunking[0]*chunking[0])
+    blocklen = min(blocklen, ntime)
+    if mask is not None: gridded = np.full((blocklen,)+space, fillval)
+    if variable.dtype.kind=='i': variable.set_auto_maskandscale(False)
+    for start in range(0, ntime, blocklen):
+        stop = min(start+blocklen, ntime)
+        if mask is not None:
+            # Sea points are never written to so they keep the fill value.
+            # Scattering drops the mask, so missing land points are filled.
+            block = gridded[:stop-start]
+            block[:,mask] = widen(np.ma.filled(data[start:stop], missingval))
+        else:
+            block = widen(data[start:stop].reshape((stop-start,)+space))
+        if variable.dtype.kind=='i': block = pack(variable, block)
+        variable[offset+start:offset+stop,rows,:] = block
+
+
+def output_path(options, filename):
+    """output_path returns the path of an output file in the --output-dir
+    directory, which is made if it does not exist."""
+    if not options.outdir: return filename
+    os.makedirs(options.outdir, exist_ok=True)
+    return os.path.join(options.outdir, filename)
+
+
 def save_yearly(HWA,HWM,HWN,HWF,HWD,HWT,tpct,definition,timedata,options,mask):
     """Save yearly data to netcdf file.
     Input aspect arrays are 2D, timeXspace and are either reshaped or indexed
     with a land-sea mask"""
-    if any([(wildcard in options.tmaxfile) for wildcard in ['*','?','[']]):
-        tempnc = MFDataset(options.tmaxfile, 'r')
-    else:
-        tempnc = Dataset(options.tmaxfile, 'r')
-    nyears = HWA.shape[0]
-    try: experiment = tempnc.__getattribute__('experiment')
-    except AttributeError: experiment = ''
-    try: model = tempnc.__getattribute__('model_id')
-    except AttributeError: model = ''
-    try: parent = tempnc.__getattribute__('parent_experiment_rip')
-    except AttributeError: parent = ''
-    try: realization = tempnc.__getattribute__('realization')
-    except AttributeError: realization = ''
-    try: initialization = tempnc.__getattribute__('initialization_method')
-    except AttributeError: initialization = ''
-    try:
-        physics = tempnc.__getattribute__('physics_version')
-        rip = 'r'+str(realization)+'i'+str(initialization)+'p'+str(physics)
-    except AttributeError:
-        physics = ''
-        rip = ''
-    latnames = ('lat', 'lats', 'latitude', 'latitudes')
-    latkey = [vrbl in latnames for vrbl in tempnc.variables.keys()].index(True)
-    latvname = list(tempnc.variables.keys())[latkey]
-    lonnames = ('lon', 'lons', 'longitude', 'longitudes')
-    lonkey = [vrbl in lonnames for vrbl in tempnc.variables.keys()].index(True)
-    lonvname = list(tempnc.variables.keys())[lonkey]
-    space = (tempnc.dimensions[latvname].__len__(), tempnc.dimensions[lonvname].__len__())
-    yearlyout = Dataset('%s_heatwaves_%s_%s_%s_yearly_%s.nc'%(definition, model, experiment, rip, options.season), 'w')
+    yearlyout = create_yearly(definition, timedata, options)
+    write_yearly(yearlyout, HWA,HWM,HWN,HWF,HWD,HWT,tpct,definition,options,mask)
+    yearlyout.close()
+
+
+def create_yearly(definition, timedata, options, metadata=None):
+    """create_yearly creates the yearly netcdf file and its variables, and
+    returns it open for writing with write_yearly. metadata is the
+    InputMetadata of the inputs."""
+    if metadata is None: metadata = InputMetadata(options)
+    space = (len(metadata.lats), len(metadata.lons))
+    yearlyout = Dataset(output_path(options, '%s_heatwaves_%s_%s_%s_yearly_%s.nc'%(definition, metadata.model, metadata.experiment, metadata.rip, options.season)), 'w')
     yearlyout.createDimension('time', size=None)
-    yearlyout.createDimension('lon', tempnc.dimensions[lonvname].__len__())
-    yearlyout.createDimension('lat', tempnc.dimensions[latvname].__len__())
+    yearlyout.createDimension('lon', len(metadata.lons))
+    yearlyout.createDimension('lat', len(metadata.lats))
     yearlyout.createDimension('day', timedata.daysinyear)
     setattr(yearlyout, "author", "Tammas Loughran")
     setattr(yearlyout, "contact", "t.loughran@unsw.edu.au")
     setattr(yearlyout, "source", "https://github.com/tammasloughran/ehfheatwaves")
     setattr(yearlyout, "date", dt.datetime.today().strftime('%Y-%m-%d'))
     setattr(yearlyout, "script", sys.argv[0])
-    if model:
-        setattr(yearlyout, "model_id", model)
-        setattr(yearlyout, "experiment", experiment)
-        setattr(yearlyout, "parent_experiment_rip", parent)
-        setattr(yearlyout, "realization", realization)
-        setattr(yearlyout, "initialization_method", initialization)
-        setattr(yearlyout, "physics_version", physics)
+    if metadata.model:
+        setattr(yearlyout, "model_id", metadata.model)
+        setattr(yearlyout, "experiment", metadata.experiment)
+        setattr(yearlyout, "parent_experiment_rip", metadata.parent)
+        setattr(yearlyout, "realization", metadata.realization)
+        setattr(yearlyout, "initialization_method", metadata.initialization)
+        setattr(yearlyout, "physics_version", metadata.physics)
     setattr(yearlyout, "period", "%s-%s"%(str(timedata.dayone.year),str(timedata.daylast.year)))
     setattr(yearlyout, "base_period", "%s-%s"%(str(options.bpstart),str(options.bpend)))
     setattr(yearlyout, "percentile", "%sth"%(str(options.pcntl)))
@@ -271,13 +624,7 @@ def save_yearly(HWA,HWM,HWN,HWF,HWD,HWT,tpct,definition,timedata,options,mask):
     setattr(yearlyout, "frequency", "yearly")
     setattr(yearlyout, "season", options.season)
     setattr(yearlyout, "season_note", ("The year of a season is the year it starts in. SH summer: Nov-Mar. NH summer: May-Sep."))
-    try:
-        file = open('version', 'r')
-        commit = file.read()[:]
-        if commit[-2:]==r'\n': commit = commit[:-2]
-    except IOError:
-        commit = "Unknown. Check date for latest version."
-    setattr(yearlyout, "git_commit", commit)
+    setattr(yearlyout, "git_commit", metadata.commit)
     setattr(yearlyout, "tmax_file", options.tmaxfile)
     setattr(yearlyout, "tmin_file", options.tminfile)
     if options.maskfile:
@@ -298,13 +645,16 @@ def save_yearly(HWA,HWM,HWN,HWF,HWD,HWT,tpct,definition,timedata,options,mask):
     setattr(olon, 'long_name', 'Longitude')
     setattr(olon, 'units', 'degrees_east')
     setattr(olon, 'axis', 'X')
-    otpct = yearlyout.createVariable('t%spct'%(options.pcntl), 'f8', ('day','lat','lon'), fill_value=fillval)
+    nyears = timedata.daylast.year-timedata.dayone.year
+    otpct = create_output(yearlyout, 't%spct'%(options.pcntl), (timedata.daysinyear,)+space, options,
+            0.01, (-20,100), dimensions=('day','lat','lon'))
     setattr(otpct, 'long_name', '90th percentile')
     setattr(otpct, 'units', 'degC')
     setattr(otpct, 'description', '90th percentile of %s-%s'%(str(options.bpstart),str(options.bpend)))
-    setattr(otpct, 'missing_value', missingval)
-    setattr(otpct, 'valid_range', (-20,100))
-    HWAout = yearlyout.createVariable('HWA_%s'%(definition), 'f8', ('time','lat','lon'), fill_value=fillval)
+    # EHF aspects are in degC2, which are larger than temperatures
+    if definition=='EHF': scale = 0.1
+    else: scale = 0.01
+    HWAout = create_output(yearlyout, 'HWA_%s'%(definition), (nyears,)+space, options, scale, (-30, 400))
     setattr(HWAout, 'long_name', 'Heatwave Amplitude')
     if definition=='tx90pct':
         setattr(HWAout, 'units', 'degC')
@@ -313,9 +663,7 @@ def save_yearly(HWA,HWM,HWN,HWF,HWD,HWT,tpct,definition,timedata,options,mask):
     elif definition=='EHF':
         setattr(HWAout, 'units', 'degC2')
     setattr(HWAout, 'description', 'Peak of the hottest heatwave per year')
-    setattr(HWAout, 'missing_value', missingval)
-    setattr(HWAout, 'valid_range', (-30, 400))
-    HWMout = yearlyout.createVariable('HWM_%s'%(definition), 'f8', ('time','lat','lon'), fill_value=fillval)
+    HWMout = create_output(yearlyout, 'HWM_%s'%(definition), (nyears,)+space, options, scale, (-30, 400))
     setattr(HWMout, 'long_name', 'Heatwave Magnitude')
     if definition=='tx90pct':
         setattr(HWMout, 'units', 'degC')
@@ -324,110 +672,60 @@ def save_yearly(HWA,HWM,HWN,HWF,HWD,HWT,tpct,definition,timedata,options,mask):
     elif definition=='EHF':
         setattr(HWMout, 'units', 'degC2')
     setattr(HWMout, 'description', 'Average magnitude of the yearly heatwave')
-    setattr(HWMout, 'missing_value', missingval)
-    setattr(HWMout, 'valid_range' ,(-30, 400))
-    HWNout = yearlyout.createVariable('HWN_%s'%(definition), 'f8', ('time', 'lat', 'lon'), fill_value=fillval)
+    HWNout = create_output(yearlyout, 'HWN_%s'%(definition), (nyears,)+space, options, valid_range=(0, 40))
     setattr(HWNout, 'long_name', 'Heatwave Number')
     setattr(HWNout, 'units','count')
     setattr(HWNout, 'description', 'Number of heatwaves per year')
-    setattr(HWNout, 'missing_value', missingval)
-    setattr(HWNout, 'valid_range', (0, 40))
-    HWFout = yearlyout.createVariable('HWF_%s'%(definition), 'f8', ('time','lat','lon'), fill_value=fillval)
+    HWFout = create_output(yearlyout, 'HWF_%s'%(definition), (nyears,)+space, options, valid_range=(0, 165))
     setattr(HWFout, 'long_name','Heatwave Frequency')
     setattr(HWFout, 'units', 'days')
     setattr(HWFout, 'description', 'Proportion of heatwave days per season')
-    setattr(HWFout, 'missing_value', missingval)
-    setattr(HWFout, 'valid_range', (0, 165))
-    HWDout = yearlyout.createVariable('HWD_%s'%(definition), 'f8', ('time','lat','lon'), fill_value=fillval)
+    HWDout = create_output(yearlyout, 'HWD_%s'%(definition), (nyears,)+space, options, valid_range=(0,165))
     setattr(HWDout, 'long_name', 'Heatwave Duration')
     setattr(HWDout, 'units', 'days')
     setattr(HWDout, 'description', 'Duration of the longest heatwave per year')
-    setattr(HWDout, 'missing_value', missingval)
-    setattr(HWDout, 'valid_range', (0,165))
-    HWTout = yearlyout.createVariable('HWT_%s'%(definition), 'f8', ('time','lat','lon'), fill_value=fillval)
+    HWTout = create_output(yearlyout, 'HWT_%s'%(definition), (nyears,)+space, options, valid_range=(1,366))
     setattr(HWTout, 'long_name', 'Heatwave Timing')
     if options.season=='summer':
         setattr(HWTout, 'units', 'days since 0001-11-01 00:00:00')
     elif options.season=='winter':
         setattr(HWTout, 'units', 'days since 0001-05-01 00:00:00')
     setattr(HWTout, 'description', 'First heat wave day of the season')
-    setattr(HWTout, 'missing_value', missingval)
-    setattr(HWTout, 'valid_range', (1,366))
     otime[:] = range(timedata.dayone.year, timedata.daylast.year)
-    olat[:] = tempnc.variables[latvname][:]
-    olon[:] = tempnc.variables[lonvname][:]
-    if options.maskfile:
-        dummy_array = np.ones((timedata.daysinyear,)+(len(olat),)+(len(olon),))*fillval
-        dummy_array[:,mask] = tpct
-        otpct[:] = dummy_array.copy()
-        dummy_array = np.ones((nyears,)+(len(olat),)+(len(olon),))*fillval
-        dummy_array[:,mask] = HWA
-        HWAout[:] = dummy_array.copy()
-        dummy_array = np.ones((nyears,)+(len(olat),)+(len(olon),))*fillval
-        dummy_array[:,mask] = HWM
-        HWMout[:] = dummy_array.copy()
-        dummy_array = np.ones((nyears,)+(len(olat),)+(len(olon),))*fillval
-        dummy_array[:,mask] = HWN
-        HWNout[:] = dummy_array.copy()
-        dummy_array = np.ones((nyears,)+(len(olat),)+(len(olon),))*fillval
-        dummy_array[:,mask] = HWF
-        HWFout[:] = dummy_array.copy()
-        dummy_array = np.ones((nyears,)+(len(olat),)+(len(olon),))*fillval
-        dummy_array[:,mask] = HWD
-        HWDout[:] = dummy_array.copy()
-        dummy_array = np.ones((nyears,)+(len(olat),)+(len(olon),))*fillval
-        dummy_array[:,mask] = HWT
-        HWTout[:] = dummy_array.copy()
-    else:
-        otpct[:] = tpct
-        HWAout[:] = HWA.reshape((nyears,)+space)
-        HWMout[:] = HWM.reshape((nyears,)+space)
-        HWNout[:] = HWN.reshape((nyears,)+space)
-        HWFout[:] = HWF.reshape((nyears,)+space)
-        HWDout[:] = HWD.reshape((nyears,)+space)
-        HWTout[:] = HWT.reshape((nyears,)+space)
-    tempnc.close()
-    yearlyout.close()
+    olat[:] = metadata.lats
+    olon[:] = metadata.lons
+    return yearlyout
+
+
+def write_yearly(yearlyout,HWA,HWM,HWN,HWF,HWD,HWT,tpct,definition,options,mask,rows=slice(None)):
+    """write_yearly writes the aspects and thresholds of the latitude rows
+    to a file made by create_yearly.
+    Input aspect arrays are 2D, timeXspace and are either reshaped or indexed
+    with a land-sea mask"""
+    if not options.maskfile: mask = None
+    write_band(yearlyout.variables['t%spct'%(options.pcntl)], tpct, mask, rows)
+    for aspect, name in zip((HWA,HWM,HWN,HWF,HWD,HWT), ('HWA','HWM','HWN','HWF','HWD','HWT')):
+        write_band(yearlyout.variables['%s_%s'%(name, definition)], aspect, mask, rows)
 
 
 def save_daily(exceed, event, ends, options, timedata, original_shape, mask, defn='EHF'):
     """save_daily saves the daily data to netcdf file.
     Input arrays are 2D, timeXspace and are either reshaped or indexed
     with a land-sea mask"""
-    if options.tmaxfile:
-        filename = options.tmaxfile
-    elif options.tminfile:
-        filename = options.tminfile
-    if any([(wildcard in filename) for wildcard in ['*','?','[']]):
-        tempnc = MFDataset(filename, 'r')
-    else:
-        tempnc = Dataset(filename, 'r')
-    try: experiment = tempnc.__getattribute__('experiment')
-    except AttributeError: experiment = ''
-    try: model = tempnc.__getattribute__('model_id')
-    except AttributeError: model = ''
-    try: parent = tempnc.__getattribute__('parent_experiment_rip')
-    except AttributeError: parent = ''
-    try: realization = tempnc.__getattribute__('realization')
-    except AttributeError: realization = ''
-    try: initialization = tempnc.__getattribute__('initialization_method')
-    except AttributeError: initialization = ''
-    try:
-        physics = tempnc.__getattribute__('physics_version')
-        rip = 'r'+str(realization)+'i'+str(initialization)+'p'+str(physics)
-    except AttributeError:
-        physics = ''
-        rip = ''
-    latnames = ('lat', 'lats', 'latitude', 'latitudes')
-    latkey = [vrbl in latnames for vrbl in tempnc.variables.keys()].index(True)
-    latvname = list(tempnc.variables.keys())[latkey]
-    lonnames = ('lon', 'lons', 'longitude', 'longitudes')
-    lonkey = [vrbl in lonnames for vrbl in tempnc.variables.keys()].index(True)
-    lonvname = list(tempnc.variables.keys())[lonkey]
-    dailyout = Dataset('%s_heatwaves_%s_%s_%s_daily.nc'%(defn, model, experiment, rip), mode='w')
+    dailyout = create_daily(options, timedata, original_shape, defn)
+    write_daily(dailyout, exceed, event, ends, options, mask, defn)
+    dailyout.close()
+
+
+def create_daily(options, timedata, original_shape, defn='EHF', metadata=None):
+    """create_daily creates the daily netcdf file and its variables, and
+    returns it open for writing with write_daily. metadata is the
+    InputMetadata of the inputs."""
+    if metadata is None: metadata = InputMetadata(options)
+    dailyout = Dataset(output_path(options, '%s_heatwaves_%s_%s_%s_daily.nc'%(defn, metadata.model, metadata.experiment, metadata.rip)), mode='w')
     dailyout.createDimension('time', size=None)
-    dailyout.createDimension('lon', tempnc.dimensions[lonvname].__len__())
-    dailyout.createDimension('lat', tempnc.dimensions[latvname].__len__())
+    dailyout.createDimension('lon', len(metadata.lons))
+    dailyout.createDimension('lat', len(metadata.lats))
     setattr(dailyout, "author", "Tammas Loughran")
     setattr(dailyout, "contact", "t.loughran@unsw.edu.au")
     setattr(dailyout, "source", "https://github.com/tammasloughran/ehfheatwaves")
@@ -436,20 +734,14 @@ def save_daily(exceed, event, ends, options, timedata, original_shape, mask, def
     setattr(dailyout, "period", "%s-%s"%(str(timedata.dayone.year),str(timedata.daylast.year)))
     setattr(dailyout, "base_period", "%s-%s"%(str(options.bpstart),str(options.bpend)))
     setattr(dailyout, "percentile", "%sth"%(str(options.pcntl)))
-    if model:
-        setattr(dailyout, "model_id", model)
-        setattr(dailyout, "experiment", experiment)
-        setattr(dailyout, "parent_experiment_rip", parent)
-        setattr(dailyout, "realization", realization)
-        setattr(dailyout, "initialization_method", initialization)
-        setattr(dailyout, "physics_version", physics)
-    try:
-        file = open('version', 'r')
-        commit = file.read()[:]
-        if commit[-2:]==r'\n': commit = commit[:-2]
-    except IOError:
-        commit = "Unknown. Check date for latest version."
-    setattr(dailyout, "git_commit", commit)
+    if metadata.model:
+        setattr(dailyout, "model_id", metadata.model)
+        setattr(dailyout, "experiment", metadata.experiment)
+        setattr(dailyout, "parent_experiment_rip", metadata.parent)
+        setattr(dailyout, "realization", metadata.realization)
+        setattr(dailyout, "initialization_method", metadata.initialization)
+        setattr(dailyout, "physics_version", metadata.physics)
+    setattr(dailyout, "git_commit", metadata.commit)
     if options.tmaxfile:
         setattr(dailyout, "tmax_file", options.tmaxfile)
     if options.tminfile:
@@ -470,7 +762,10 @@ def save_daily(exceed, event, ends, options, timedata, original_shape, mask, def
     setattr(olon, 'standard_name', 'longitude')
     setattr(olon, 'long_name', 'Longitude')
     setattr(olon, 'units', 'degrees_east')
-    oehf = dailyout.createVariable(defn, 'f8', ('time','lat','lon'), fill_value=fillval)
+    space = (len(metadata.lats), len(metadata.lons))
+    if defn=='EHF': scale = 0.1
+    else: scale = 0.01
+    oehf = create_output(dailyout, defn, (original_shape[0],)+space, options, scale)
     if defn=='EHF':
         setattr(oehf, 'long_name', 'Excess Heat Factor')
         setattr(oehf, 'units', 'degC2')
@@ -480,76 +775,113 @@ def save_daily(exceed, event, ends, options, timedata, original_shape, mask, def
     elif defn=='tn90pct':
         setattr(oehf, 'long_name', 'Temperature Exceeding tn90pct')
         setattr(oehf, 'units', 'C')
-    setattr(oehf, 'missing_value', missingval)
-    oevent = dailyout.createVariable('event', 'f8', ('time','lat','lon'), fill_value=fillval)
+    oevent = create_output(dailyout, 'event', (original_shape[0],)+space, options, indicator='i1')
     setattr(oevent, 'long_name', 'Event indicator')
     setattr(oevent, 'description', 'Indicates whether a heatwave is happening on that day')
-    setattr(oevent, 'missing_value', missingval)
-    oends = dailyout.createVariable('ends', 'f8', ('time','lat','lon'), fill_value=fillval)
+    oends = create_output(dailyout, 'ends', (original_shape[0],)+space, options, indicator='i2')
     setattr(oends, 'long_name', 'Duration at start of heatwave')
     setattr(oends, 'units', 'days')
-    setattr(oends, 'missing_value', missingval)
     otime[:] = range(0,original_shape[0],1)
-    olat[:] = tempnc.variables[latvname][:]
-    olon[:] = tempnc.variables[lonvname][:]
+    olat[:] = metadata.lats
+    olon[:] = metadata.lons
+    return dailyout
+
+
+def write_daily(dailyout, exceed, event, ends, options, mask, defn='EHF', rows=slice(None)):
+    """write_daily writes the daily data of the latitude rows to a file made
+    by create_daily.
+    Input arrays are 2D, timeXspace and are either reshaped or indexed
+    with a land-sea mask"""
     exceed[exceed.mask==True] = missingval
-    if options.maskfile:
-        dummy_array = np.ones(original_shape)*fillval
-        dummy_array[:,mask] = exceed
-        oehf[:] = dummy_array.copy()
-        dummy_array = np.ones(original_shape)*fillval
-        dummy_array[:,mask] = event
-        oevent[:] = dummy_array.copy()
-        dummy_array = np.ones(original_shape)*fillval
-        dummy_array[:,mask] = ends
-        oends[:] = dummy_array.copy()
-    else:
-        oehf[:] = exceed
-        oevent[:] = event
-        oends[:] = ends
-    tempnc.close()
-    dailyout.close()
+    if not options.maskfile: mask = None
+    write_band(dailyout.variables[defn], exceed, mask, rows)
+    write_band(dailyout.variables['event'], event, mask, rows)
+    write_band(dailyout.variables['ends'], ends, mask, rows)
+
+
+class DailyWriter(object):
+    """DailyWriter appends blocks of the daily data of a band of latitude rows
+    to a file made by create_daily as they are calculated.
+
+    identify is the function that finds the event and ends indicators of a
+    (time, space) series. A heatwave's duration is only known once it ends,
+    so the indicators are written up to the start of the earliest heatwave
+    that is still running, and the days from the start of the runs that
+    cross that point are carried over to the next block. close writes the
+    rest.
+    """
+
+    def __init__(self, dailyout, identify, options, mask, defn='EHF', rows=slice(None)):
+        self.dailyout = dailyout
+        self.identify = identify
+        self.defn = defn
+        self.rows = rows
+        if options.maskfile: self.mask = mask
+        else: self.mask = None
+        self.ntime = 0 # time steps of daily data written
+        self.written = 0 # time steps of indicators written
+        self.offset = 0 # time step of the first carried over day
+        self.carried = None
+
+    def append(self, exceed):
+        """append writes a (time, space) block of daily data."""
+        with iolock:
+            write_band(self.dailyout.variables[self.defn], np.ma.filled(exceed, missingval),
+                    self.mask, self.rows, self.ntime)
+        self.ntime += exceed.shape[0]
+        positive = np.ma.filled(exceed>0., False).reshape((exceed.shape[0], -1))
+        if self.carried is not None: positive = np.concatenate((self.carried, positive))
+        # Days from the start of the last run of each column may be in a
+        # heatwave that has not ended yet.
+        trailing = np.argmin(positive[::-1], axis=0)
+        trailing[positive.all(axis=0)] = positive.shape[0]
+        self.write_indicators(positive, positive.shape[0] - trailing.max(initial=0))
+
+    def close(self):
+        """close writes the indicators of the remaining days."""
+        if (self.carried is not None) and len(self.carried):
+            self.write_indicators(self.carried, self.carried.shape[0])
+
+    def write_indicators(self, positive, cut):
+        """write_indicators writes the indicators of the days before cut, a
+        time step of positive, and carries the runs that cross it over."""
+        event, ends = self.identify(positive)
+        first = self.written - self.offset
+        with iolock:
+            write_band(self.dailyout.variables['event'], event[first:cut], self.mask, self.rows, self.written)
+            write_band(self.dailyout.variables['ends'], ends[first:cut], self.mask, self.rows, self.written)
+        self.written = self.offset + cut
+        # Runs that cross the cut have ended, but their first days are needed
+        # to find their indicators after the cut.
+        keep = cut
+        if cut>0:
+            before = positive[:cut]
+            leading = np.argmin(before[::-1], axis=0)
+            leading[before.all(axis=0)] = cut
+            keep = cut - leading.max(initial=0)
+        self.carried = positive[keep:]
+        self.offset += keep
 
 
 def save_ehi(EHIsig, EHIaccl, options, timedata, original_shape, mask):
     """save_ehi saves the daily data to netcdf file.
     Input arrays are 2D, timeXspace and are either reshaped or indexed
     with a land-sea mask"""
-    if options.tmaxfile:
-        filename = options.tmaxfile
-    elif options.tminfile:
-        filename = options.tminfile
-    if any([(wildcard in filename) for wildcard in ['*','?','[']]):
-        tempnc = MFDataset(filename, 'r')
-    else:
-        tempnc = Dataset(filename, 'r')
-    try: experiment = tempnc.__getattribute__('experiment')
-    except AttributeError: experiment = ''
-    try: model = tempnc.__getattribute__('model_id')
-    except AttributeError: model = ''
-    try: parent = tempnc.__getattribute__('parent_experiment_rip')
-    except AttributeError: parent = ''
-    try: realization = tempnc.__getattribute__('realization')
-    except AttributeError: realization = ''
-    try: initialization = tempnc.__getattribute__('initialization_method')
-    except AttributeError: initialization = ''
-    try:
-        physics = tempnc.__getattribute__('physics_version')
-        rip = 'r'+str(realization)+'i'+str(initialization)+'p'+str(physics)
-    except AttributeError:
-        physics = ''
-        rip = ''
-    latnames = ('lat', 'lats', 'latitude', 'latitudes')
-    latkey = [vrbl in latnames for vrbl in tempnc.variables.keys()].index(True)
-    latvname = list(tempnc.variables.keys())[latkey]
-    lonnames = ('lon', 'lons', 'longitude', 'longitudes')
-    lonkey = [vrbl in lonnames for vrbl in tempnc.variables.keys()].index(True)
-    lonvname = list(tempnc.variables.keys())[lonkey]
+    dailyout = create_ehi(options, timedata, original_shape)
+    write_ehi(dailyout, EHIsig, EHIaccl, options, mask)
+    dailyout.close()
+
+
+def create_ehi(options, timedata, original_shape, metadata=None):
+    """create_ehi creates the daily EHI netcdf file and its variables, and
+    returns it open for writing with write_ehi. metadata is the
+    InputMetadata of the inputs."""
+    if metadata is None: metadata = InputMetadata(options)
     defn = 'EHI'
-    dailyout = Dataset('%s_heatwaves_%s_%s_%s_daily.nc'%(defn, model, experiment, rip), mode='w')
+    dailyout = Dataset(output_path(options, '%s_heatwaves_%s_%s_%s_daily.nc'%(defn, metadata.model, metadata.experiment, metadata.rip)), mode='w')
     dailyout.createDimension('time', size=None)
-    dailyout.createDimension('lon', tempnc.dimensions[lonvname].__len__())
-    dailyout.createDimension('lat', tempnc.dimensions[latvname].__len__())
+    dailyout.createDimension('lon', len(metadata.lons))
+    dailyout.createDimension('lat', len(metadata.lats))
     setattr(dailyout, "author", "Tammas Loughran")
     setattr(dailyout, "contact", "t.loughran@unsw.edu.au")
     setattr(dailyout, "source", "https://github.com/tammasloughran/ehfheatwaves")
@@ -558,20 +890,14 @@ def save_ehi(EHIsig, EHIaccl, options, timedata, original_shape, mask):
     setattr(dailyout, "period", "%s-%s"%(str(timedata.dayone.year),str(timedata.daylast.year)))
     setattr(dailyout, "base_period", "%s-%s"%(str(options.bpstart),str(options.bpend)))
     setattr(dailyout, "percentile", "%sth"%(str(options.pcntl)))
-    if model:
-        setattr(dailyout, "model_id", model)
-        setattr(dailyout, "experiment", experiment)
-        setattr(dailyout, "parent_experiment_rip", parent)
-        setattr(dailyout, "realization", realization)
-        setattr(dailyout, "initialization_method", initialization)
-        setattr(dailyout, "physics_version", physics)
-    try:
-        file = open('version', 'r')
-        commit = file.read()[:]
-        if commit[-2:]==r'\n': commit = commit[:-2]
-    except IOError:
-        commit = "Unknown. Check date for latest version."
-    setattr(dailyout, "git_commit", commit)
+    if metadata.model:
+        setattr(dailyout, "model_id", metadata.model)
+        setattr(dailyout, "experiment", metadata.experiment)
+        setattr(dailyout, "parent_experiment_rip", metadata.parent)
+        setattr(dailyout, "realization", metadata.realization)
+        setattr(dailyout, "initialization_method", metadata.initialization)
+        setattr(dailyout, "physics_version", metadata.physics)
+    setattr(dailyout, "git_commit", metadata.commit)
     if options.tmaxfile:
         setattr(dailyout, "tmax_file", options.tmaxfile)
     if options.tminfile:
@@ -592,28 +918,166 @@ def save_ehi(EHIsig, EHIaccl, options, timedata, original_shape, mask):
     setattr(olon, 'standard_name', 'longitude')
     setattr(olon, 'long_name', 'Longitude')
     setattr(olon, 'units', 'degrees_east')
-    oehisig = dailyout.createVariable('EHIsig', 'f8', ('time','lat','lon'), fill_value=fillval)
+    space = (len(metadata.lats), len(metadata.lons))
+    oehisig = create_output(dailyout, 'EHIsig', (original_shape[0],)+space, options, 0.01, (0,100))
     setattr(oehisig, 'long_name', 'Excess Heat Index Significance')
     setattr(oehisig, 'units', 'C')
-    setattr(oehisig, 'missing_value', missingval)
-    setattr(oehisig, 'valid_range', (0,100))
-    oehiaccl = dailyout.createVariable('EHIaccl', 'f8', ('time','lat','lon'), fill_value=fillval)
+    oehiaccl = create_output(dailyout, 'EHIaccl', (original_shape[0],)+space, options, 0.01, (0,100))
     setattr(oehiaccl, 'long_name', 'Excess Heat Index Acclimatisation')
     setattr(oehiaccl, 'units', 'C')
-    setattr(oehiaccl, 'missing_value', missingval)
-    setattr(oehiaccl, 'valid_range', (0,100))
     otime[:] = range(0,original_shape[0],1)
-    olat[:] = tempnc.variables[latvname][:]
-    olon[:] = tempnc.variables[lonvname][:]
+    olat[:] = metadata.lats
+    olon[:] = metadata.lons
+    return dailyout
+
+
+def write_ehi(dailyout, EHIsig, EHIaccl, options, mask, rows=slice(None)):
+    """write_ehi writes the EHIs of the latitude rows to a file made by
+    create_ehi.
+    Input arrays are 2D, timeXspace and are either reshaped or indexed
+    with a land-sea mask"""
+    if not options.maskfile: mask = None
+    write_band(dailyout.variables['EHIsig'], EHIsig, mask, rows)
+    write_band(dailyout.variables['EHIaccl'], EHIaccl, mask, rows)
+
+
+# Series of the --store file, by definition, and the keys of their results
+storeseries = (('EHF', 'EHF_series', 'tpct'), ('txexceed', 'tx_series', 'txpct'), ('tnexceed', 'tn_series', 'tnpct'))
+
+
+def create_store(options, timedata, original_shape, first_year, dtype=np.float64, metadata=None):
+    """create_store creates the --store file that holds the daily EHF and
+    exceedance series, their thresholds and the time data that the yearly
+    aspects are calculated from, and returns it open for writing with
+    write_store. Series are saved as dtype, compressed and chunked by year.
+
+    The series have leap days and the incomplete first year removed, so
+    their time axis is in a 365_day or 360_day calendar from first_year.
+    """
+    if metadata is None: metadata = InputMetadata(options)
+    store = Dataset(options.storefile, 'w')
+    store.createDimension('time', size=original_shape[0])
+    store.createDimension('lon', len(metadata.lons))
+    store.createDimension('lat', len(metadata.lats))
+    store.createDimension('day', timedata.daysinyear)
+    for name, value in (('experiment', metadata.experiment), ('model_id', metadata.model),
+            ('parent_experiment_rip', metadata.parent), ('realization', metadata.realization),
+            ('initialization_method', metadata.initialization)):
+        if value!='': setattr(store, name, value)
+    if metadata.rip: setattr(store, 'physics_version', metadata.physics)
+    setattr(store, "date", dt.datetime.today().strftime('%Y-%m-%d'))
+    setattr(store, "git_commit", metadata.commit)
+    setattr(store, "calendar", timedata.calendar)
+    setattr(store, "first_day", "%04d-%02d-%02d"%(timedata.dayone.year, timedata.dayone.month, timedata.dayone.day))
+    setattr(store, "last_day", "%04d-%02d-%02d"%(timedata.daylast.year, timedata.daylast.month, timedata.daylast.day))
+    setattr(store, "first_year", first_year)
+    setattr(store, "tmax_file", options.tmaxfile or '')
+    setattr(store, "tmin_file", options.tminfile or '')
+    setattr(store, "mask_file", options.maskfile or '')
+    setattr(store, "base_period", "%s-%s"%(str(options.bpstart),str(options.bpend)))
+    setattr(store, "percentile", options.pcntl)
+    setattr(store, "quantile_method", options.qtilemethod)
+    setattr(store, "precision", options.precision)
+    otime = store.createVariable('time', 'f8', 'time')
+    setattr(otime, 'standard_name', 'time')
+    setattr(otime, 'units', 'days since %s-01-01'%(first_year))
+    setattr(otime, 'calendar', '%d_day'%(timedata.daysinyear))
+    olat = store.createVariable('lat', 'f8', 'lat')
+    setattr(olat, 'standard_name', 'latitude')
+    setattr(olat, 'units', 'degrees_north')
+    olon = store.createVariable('lon', 'f8', 'lon')
+    setattr(olon, 'standard_name', 'longitude')
+    setattr(olon, 'units', 'degrees_east')
+    # Hemisphere of each row, from the latitudes in the order get_all_data gives them
+    lats = metadata.lats
+    if (lats[-1]-lats[0])<0: lats = np.flipud(lats)
+    osouth = store.createVariable('south', 'i1', 'lat')
+    if options.maskfile: store.createVariable('mask', 'i1', ('lat','lon'))
+    keep = {'EHF': options.keeptave, 'txexceed': options.keeptmax, 'tnexceed': options.keeptmin}
+    for name, key, threshold in storeseries:
+        if not keep[name]: continue
+        for vname, dimensions, shape in ((name, ('time','lat','lon'), original_shape[:1]),
+                (threshold, ('day','lat','lon'), (timedata.daysinyear,))):
+            shape = shape+(len(metadata.lats), len(metadata.lons))
+            chunks = tuple([max(1, min(size, length)) for size, length in zip((timedata.daysinyear, 16, 16), shape)])
+            store.createVariable(vname, dtype, dimensions, fill_value=fillval, zlib=True,
+                    complevel=options.compress or 1, shuffle=True, chunksizes=chunks)
+    otime[:] = range(0,original_shape[0],1)
+    olat[:] = metadata.lats
+    olon[:] = metadata.lons
+    osouth[:] = lats<=0
+    return store
+
+
+def write_store(store, results, options, mask, rows=slice(None)):
+    """write_store writes the series and thresholds of the latitude rows in
+    results to a file made by create_store."""
+    if not options.maskfile: mask = None
+    for name, key, threshold in storeseries:
+        if name not in store.variables: continue
+        write_band(store.variables[name], results[key], mask, rows)
+        write_band(store.variables[threshold], results[threshold], mask, rows)
+    if mask is not None: store.variables['mask'][rows,:] = mask[rows]
+
+
+def open_store(options):
+    """open_store reads the time data and land-sea mask of the --from-store
+    file and sets the options that its series were calculated with, so the
+    yearly files made from it are described like those made from the
+    temperature data.
+
+    Returns the TimeData, the InputMetadata, the mask and the first year.
+    """
+    fileset = get_fileset(options.fromstore)
+    attributes = fileset.attributes
+    keep = {'EHF': not options.noehf, 'txexceed': options.tx90pc, 'tnexceed': options.tn90pc}
+    for name, key, threshold in storeseries:
+        if keep[name] and name not in fileset.shapes: raise StoreVariableError(options.fromstore, name)
+    options.tmaxfile = attributes['tmax_file'] or None
+    options.tminfile = attributes['tmin_file'] or None
+    options.maskfile = attributes['mask_file'] or None
+    options.bpstart, options.bpend = [int(year) for year in attributes['base_period'].split('-')]
+    options.pcntl = attributes['percentile']
+    options.qtilemethod = attributes['quantile_method']
+    options.precision = attributes['precision']
+    calendar = attributes['calendar']
+    dayone = nc.num2date(0, 'days since %s'%(attributes['first_day']), calendar=calendar)
+    daylast = nc.num2date(0, 'days since %s'%(attributes['last_day']), calendar=calendar)
+    timedata = make_time_data(calendar, dayone, daylast)
+    metadata = InputMetadata(options, options.fromstore)
+    mask = None
     if options.maskfile:
-        dummy_array = np.ones(original_shape)*fillval
-        dummy_array[:,mask] = EHIsig
-        oehisig[:] = dummy_array.copy()
-        dummy_array = np.ones(original_shape)*fillval
-        dummy_array[:,mask] = EHIaccl
-        oehiaccl[:] = dummy_array.copy()
-    else:
-        oehisig[:] = EHIsig
-        oehiaccl[:] = EHIaccl
-    tempnc.close()
-    dailyout.close()
+        with iolock:
+            store = Dataset(options.fromstore, 'r')
+            mask = store.variables['mask'][:].astype(bool)
+            store.close()
+    return timedata, metadata, mask, int(attributes['first_year'])
+
+
+def read_store(options, mask=None, rows=slice(None)):
+    """read_store reads a band of latitude rows of the series and thresholds
+    of the --from-store file that the requested definitions need.
+
+    Returns a dictionary of the (time, space) series, with nan where data
+    were missing, the thresholds and the hemisphere of each row of the band.
+    """
+    if options.maskfile: bandmask = mask[rows]
+    else: bandmask = None
+    fileset = get_fileset(options.fromstore)
+    keep = {'EHF': not options.noehf, 'txexceed': options.tx90pc, 'tnexceed': options.tn90pc}
+    loaded = {}
+    for name, key, threshold in storeseries:
+        if not keep[name]: continue
+        series = fileset.read(name, rows=rows, mask=bandmask)
+        loaded[key] = np.ma.filled(series, np.nan).reshape((series.shape[0], -1))
+    with iolock:
+        store = Dataset(options.fromstore, 'r')
+        for name, key, threshold in storeseries:
+            if not keep[name]: continue
+            if bandmask is not None:
+                loaded[threshold] = read_masked(store.variables[threshold], bandmask, rows=rows)
+            else:
+                loaded[threshold] = store.variables[threshold][:,rows,:]
+        loaded['south'] = store.variables['south'][rows].astype(bool)
+        store.close()
+    return loaded
@@ -16,7 +16,7 @@ class InvalidPercentileError(Exception):
         print(p, " is not a valid fraction value.")
 
 
-def quantile_R(x, p, itype=7, fraction=False, rmnans=False):
+def quantile_R(x, p, itype=7, fraction=False, rmnans=False, axis=None, presorted=False):
     """quantile function used in R
 
     Calculates quantiles in the same way as the quantile function in R.
@@ -26,12 +26,18 @@ def quantile_R(x, p, itype=7, fraction=False, rmnans=False):
     See: Hyndman, R. J. and Fan, Y. (1996) Sample quantiles in statistical
     packages, American Statistician, 50, 361-365.
 
+    With an axis, every column along that axis is sorted in one call and the
+    order statistics of all columns are gathered at once. When nans are
+    removed each column has its own number of samples.
+
     Arguments
     x -- array
     p -- percentile
     itype -- interpolation method
     fraction -- boolean indicates if percentile is a fraction 0<p<1.
     rmnans -- boolean indicates whether or not to remove nans
+    axis -- axis along which to calculate quantiles. The default flattens x.
+    presorted -- boolean indicates x is already sorted along axis
 
     Returns
     q -- quantile at pth percentile
@@ -41,91 +47,88 @@ def quantile_R(x, p, itype=7, fraction=False, rmnans=False):
     if not fraction:
         p = p/100.
     if (p>1) or (p<0): raise InvalidPercentileError(p)
-    # Flatten the array
-    x = x.flatten()
-    # remove nans if desired
-    if (np.isnan(np.min(x)))&(rmnans==True):
-        x = x[np.logical_not(np.isnan(x))]
-    elif (np.isnan(np.min(x)))&(rmnans==False):
-        raise Exception('You must not have nans in percentile calculation')
-    if (p==1): return max(x)
-    # Get number of samples
-    n = len(x)
-    # Sort
-    x = np.sort(x)
-    # Switch case functions for interpolation type
-    def one(x,p,n):
+    # Sort columns and count the valid samples of each
+    x, n, oldshape = sort_columns(x, axis, rmnans, presorted)
+    # Interpolate in double precision as is done for scalar elements.
+    x = x.astype(np.promote_types(x.dtype, np.float64))
+    if (p==1):
+        q = x[np.maximum(n - 1, 0),np.arange(x.shape[1])]
+        q[n==0] = np.nan
+        return q.reshape(oldshape)[()]
+    # Switch case functions for interpolation type. Each returns j and gamma.
+    def one(p,n):
         m = 0.
-        j = int(np.floor(p*n + m))
+        j = np.floor(p*n + m)
         g = n*p + m - j
-        if g==0:
-            gamma = 0.
-        else:
-            gamma = 1.
-        return (1. - gamma)*x[j-1] + gamma*x[j]
+        gamma = np.where(g==0, 0., 1.)
+        return j, gamma
 
-    def two(x,p,n):
+    def two(p,n):
         m = 0.
-        j = int(np.floor(p*n + m))
+        j = np.floor(p*n + m)
         g = n*p + m - j
-        if g==0:
-            gamma = 0.5
-        else:
-            gamma = 1.
-        return (1. - gamma)*x[j-1] + gamma*x[j]
+        gamma = np.where(g==0, 0.5, 1.)
+        return j, gamma
 
-    def three(x,p,n):
+    def three(p,n):
         m = -0.5
-        j = int(np.floor(p*n + m))
+        j = np.floor(p*n + m)
         g = n*p + m - j
-        if (g==0)&(j%2==0):
-            gamma = 0.
-        else:
-            gamma = 1.
-        return (1. - gamma)*x[j-1] + gamma*x[j]
+        gamma = np.where((g==0)&(j%2==0), 0., 1.)
+        return j, gamma
 
-    def four(x,p,n):
+    def four(p,n):
         m = 0.
-        j = int(np.floor(p*n + m))
+        j = np.floor(p*n + m)
         gamma = n*p + m - j
-        return (1. - gamma)*x[j-1] + gamma*x[j]
+        return j, gamma
 
-    def five(x,p,n):
+    def five(p,n):
         m = 0.5
-        j = int(np.floor(p*n + m))
+        j = np.floor(p*n + m)
         gamma = n*p + m - j
-        return (1. - gamma)*x[j-1] + gamma*x[j]
+        return j, gamma
 
-    def six(x,p,n):
+    def six(p,n):
         m = p
-        j = int(np.floor(p*n + m))
+        j = np.floor(p*n + m)
         gamma = n*p + m - j
-        return (1. - gamma)*x[j-1] + gamma*x[j]
+        return j, gamma
 
-    def seven(x,p,n):
+    def seven(p,n):
         m = 1. - p
-        j = int(np.floor(p*n + m))
+        j = np.floor(p*n + m)
         gamma = n*p + m - j
-        return (1. - gamma)*x[j-1] + gamma*x[j]
+        return j, gamma
 
-    def eight(x,p,n):
+    def eight(p,n):
         m = (p+1)/3.
-        j = int(np.floor(p*n + m))
+        j = np.floor(p*n + m)
         gamma = n*p + m - j
-        return (1. - gamma)*x[j-1] + gamma*x[j]
+        return j, gamma
 
-    def nine(x,p,n):
+    def nine(p,n):
         m = p/4. + 3./8.
-        j = int(np.floor(p*n + m))
+        j = np.floor(p*n + m)
         gamma = n*p + m - j
-        return (1. - gamma)*x[j-1] + gamma*x[j]
+        return j, gamma
 
     switcher = {1: one, 2: two, 3: three, 4: four, 5: five, 6: six,
             7: seven, 8: eight, 9: nine}
-    return switcher[itype](x,p,n)
-
-
-def quantile_zhang(y, p, fraction=False, rmnans=False):
+    j, gamma = switcher[itype](p,n)
+    j = j.astype(int)
+    # Gather x[j-1] and x[j]. Negative indices count from the last valid
+    # sample as they would for a 1D array.
+    last = np.maximum(n - 1, 0)
+    cols = np.arange(x.shape[1])
+    xlow = x[np.clip(np.where(j>0, j - 1, j - 1 + n), 0, last),cols]
+    xhigh = x[np.clip(np.where(j>=0, j, j + n), 0, last),cols]
+    q = (1. - gamma)*xlow + gamma*xhigh
+    q[n==0] = np.nan
+    return q.reshape(oldshape)[()]
+
+
+def quantile_zhang(y, p, fraction=False, rmnans=False, axis=0, presorted=False):
     """Caclulate the pth percentile value of an array y using the Zhang method.
 
     The linear interpolation method used is outlined in Zhang et al., 2005,
@@ -140,6 +143,8 @@ def quantile_zhang(y, p, fraction=False, rmnans=False):
     p -- pth percentile
     fraction -- boolean indicates if percentile is a fraction 0<p<1.
     rmnans -- boolean indicates whether or not to remove nans
+    axis -- axis along which to calculate quantiles. None flattens y.
+    presorted -- boolean indicates y is already sorted along axis
 
     Returns
     Qp -- qualtile of pth percentile
@@ -148,41 +153,21 @@ def quantile_zhang(y, p, fraction=False, rmnans=False):
     if not fraction:
         p = p/100.
     if (p>1) or (p<0): raise InvalidPercentileError(p)
-    # Flatten array
-    #y = y.flatten()
-    if (np.isnan(np.min(y)))&(rmnans==True):
-        y = y[np.logical_not(np.isnan(y))]
-    elif (np.isnan(np.min(y)))&(rmnans==False):
-        raise Exception('You must not have nans in percentile calculation')
-    n = y.shape[0]
+    # Sort columns and count the valid samples of each
+    y, n, oldshape = sort_columns(y, axis, rmnans, presorted)
     # j is the largest integer no greater than (p*(n+1))
-    j = math.floor(p*(n+1))
+    j = np.floor(p*(n+1))
     # f is the interpolation factor
     f = p*(n+1) - j
-
-    def intrpl(y,j):
-        if j>=n:
-            return y[-1]
-        elif j<1:
-            return y[0]
-        else:
-            yj = y[j-1]
-            yjp = y[j]
-            return (1-f)*yj + f*yjp
-
-    if y.ndim==1:
-        y = np.sort(y)
-        Qp = intrpl(y,j)
-    else:
-        spacedim = np.array(y.shape)[1:].prod()
-        oldshape = y.shape[1:]
-        y = y.reshape(y.shape[0], spacedim)
-        Qp = np.ones(spacedim)*np.nan
-        for lat in range(spacedim):
-            array = np.sort(y[:,lat])
-            Qp[lat] = intrpl(array,j)
-        Qp = Qp.reshape(oldshape)
-    return Qp
+    j = j.astype(int)
+    last = np.maximum(n - 1, 0)
+    cols = np.arange(y.shape[1])
+    yj = y[np.clip(j - 1, 0, last),cols]
+    yjp = y[np.clip(j, 0, last),cols]
+    Qp = np.where(j>=n, y[last,cols], np.where(j<1, y[0,cols], (1-f)*yj + f*yjp))
+    Qp = Qp.astype(np.promote_types(Qp.dtype, np.float64))
+    Qp[n==0] = np.nan
+    return Qp.reshape(oldshape)[()]
 
 
 def quantile_zhang_fast(x, q, fraction=False, rmnans=False):
@@ -205,11 +190,13 @@ def quantile_zhang_fast(x, q, fraction=False, rmnans=False):
     return np.percentile(x, q_adj, axis=0)
 
 
-def quantile_climpact(y,p,fraction=False):
+def quantile_climpact(y,p,fraction=False,axis=0,presorted=False):
     """quantile function used by climpact.
 
     Copy of the c_quantile function used in climpact.
     I have no idea where the interpolation is from.
+    Multidimensional input is sorted along axis in one call, or not at all if
+    presorted is True, and nans are removed from each column separately.
     """
     if not fraction:
         p = p/100.
@@ -218,18 +205,9 @@ def quantile_climpact(y,p,fraction=False):
     if y.ndim==1:
         return qclimpact(y,p)
     else:
-        spacedim = y.shape[1]
-        nodims = y.ndim
-        if nodims>2:
-            spacedim = np.array(y.shape)[1:].prod()
-            oldshape = y.shape[1:]
-            y = y.reshape(y.shape[0], spacedim)
-        Qp = np.ones(spacedim)*np.nan
-        for lat in range(spacedim):
-            if np.isnan(y[:,lat]).all(): continue
-            Qp[lat] = qclimpact(y[:,lat],p)
-        if nodims>2: Qp = Qp.reshape(oldshape)
-    return Qp
+        y, n, oldshape = sort_columns(y, axis, True, presorted)
+        Qp = qclimpact_sorted(y, p, n)
+    return Qp.reshape(oldshape)
 
 
 def qclimpact(y,p):
@@ -252,4 +230,52 @@ def qclimpact(y,p):
         Qp = y[left_elem]
     else:
         Qp = (1 - h)*y[left_elem] + h*y[right_elem]
-    return Qp
\ No newline at end of file
+    return Qp
+
+
+def qclimpact_sorted(y, p, n):
+    """Vectorized qclimpact for columns of y that are already sorted.
+
+    y is (sample, space) sorted along the first axis with nans at the end and
+    n is the number of valid values in each column. Columns with no valid
+    values are nan.
+    """
+    a, b = 1.0/3.0, 1.0/3.0
+    nppm = a + p*(n + 1 - a - b) - 1
+    fuzz = 4*sys.float_info.epsilon
+    j = np.floor(nppm + fuzz)
+    h = np.where(abs(nppm - j)<=fuzz, 0, nppm - j)
+    j = j.astype(int)
+    right_elem = np.maximum(0, np.minimum(j + 1, n - 1))
+    left_elem = np.maximum(0, np.minimum(j, n - 1))
+    cols = np.arange(y.shape[1])
+    yleft = y[left_elem,cols]
+    yright = y[right_elem,cols]
+    Qp = np.where(h==1, yright, np.where(h==0, yleft, (1 - h)*yleft + h*yright))
+    Qp[n==0] = np.nan
+    return Qp
+
+
+def sort_columns(x, axis=0, rmnans=False, presorted=False):
+    """Sort x along axis and count the valid samples in each column.
+
+    Returns the sorted samples as a (sample, space) array with nans at the
+    end of each column, the number of valid samples in each column and the
+    shape of the space dimensions. If axis is None x is flattened to one
+    column and the shape is (), so results can be indexed with [()] to give
+    a scalar.
+    """
+    x = np.asarray(x)
+    if axis is None:
+        x = x.reshape(-1, 1)
+        oldshape = ()
+    else:
+        x = np.moveaxis(x, axis, 0)
+        oldshape = x.shape[1:]
+        x = x.reshape(x.shape[0], -1)
+    valid = np.logical_not(np.isnan(x))
+    if (not rmnans)&(not valid.all()):
+        raise Exception('You must not have nans in percentile calculation')
+    n = valid.sum(axis=0)
+    if not presorted: x = np.sort(x, axis=0)
+    return x, n, oldshape
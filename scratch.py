@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+scratch.py allocates the large (time, space) intermediate arrays of the
+heatwave calculation, such as EHF, the EHIs, the exceedances and the heatwave
+indicators.
+
+By default they are ordinary arrays in memory. When directory is set, with
+--scratch, arrays of at least minbytes are memory mapped files in that
+directory instead, so the operating system can page them out to disk and
+series longer than memory can be calculated. Each file is removed as soon as
+it is mapped, so its space is freed with the array, even if the run is killed.
+"""
+import os
+import tempfile
+import numpy as np
+
+
+directory = None # directory of memory mapped arrays, or None to keep them in memory
+minbytes = 2**24 # smaller arrays are always kept in memory
+
+
+def empty(shape, dtype=np.float64):
+    """empty returns an uninitialised array, which is memory mapped if
+    directory is set and it is at least minbytes."""
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape))*dtype.itemsize
+    if (directory is None) or (nbytes==0) or (nbytes<minbytes):
+        return np.empty(shape, dtype=dtype)
+    if not os.path.isdir(directory): os.makedirs(directory)
+    handle, filename = tempfile.mkstemp(prefix='ehfheatwaves_', suffix='.dat', dir=directory)
+    try:
+        array = np.memmap(filename, dtype=dtype, mode='w+', shape=shape)
+    finally:
+        os.close(handle)
+        os.remove(filename)
+    return array
+
+
+def zeros(shape, dtype=np.float64):
+    """zeros returns an array of zeros like empty."""
+    array = empty(shape, dtype)
+    # New memory mapped files are already zero.
+    if not isinstance(array, np.memmap): array[...] = 0
+    return array
+
+
+def full(shape, fill_value, dtype=np.float64):
+    """full returns an array filled with fill_value like empty."""
+    array = empty(shape, dtype)
+    array[...] = fill_value
+    return array
@@ -0,0 +1,242 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+sweep.py runs a sweep of heatwave calculations described by a job file, as a
+graph of stages that are each run once and checkpointed, so an interrupted
+sweep continues from the stages that had not finished.
+
+The job file is JSON, or YAML if PyYAML is installed, for example:
+
+{"models": [{"name": "ACCESS1-0", "tmax": "tasmax_ACCESS1-0.nc",
+             "tmin": "tasmin_ACCESS1-0.nc"}],
+ "definitions": ["EHF", "tx90pct", "tn90pct"],
+ "daily": true,
+ "ehi": true,
+ "seasons": ["summer", "winter"],
+ "methods": ["new", "old"],
+ "options": ["-m", "sftlf.nc", "--base=1961-1990"],
+ "output": "heatwaves"}
+
+models are jobs like those of a batch.py manifest. For each model the first
+stage reads the temperature data and calculates the thresholds, the EHF and
+exceedances, the daily output and EHIs and the yearly output of the first
+season and method, and saves the series with --store. Each other season and
+method is a stage that calculates its yearly output --from-store. The output
+of each model, season and method is saved in a NAME/SEASON_METHOD directory of
+output, as output files are named by the model attributes of the inputs and
+yearly files by season only. Model names must be unique. Models with the same
+base period share thresholds as in batch.py.
+
+Stages are identified by a hash of their arguments and input files, so
+identical stages are run once. Finished stages are recorded in the state file
+of the checkpoint directory, which also holds the stores and the threshold
+cache, unless --cache is given. Running the sweep again skips finished stages.
+
+Usage: sweep.py [--jobs N] [--checkpoints DIR] JOBFILE [ehfheatwaves.py options]
+"""
+import sys
+import os
+import time
+import json
+import hashlib
+import warnings
+import concurrent.futures
+try:
+    modulename = 'optparse'
+    from optparse import OptionParser
+except ImportError:
+    print(modulename, " is missing. Please install missing packages.")
+    sys.exit(2)
+try:
+    import yaml
+except ImportError:
+    yaml = None
+import getoptions
+import tcache
+import batch
+
+
+def read_jobfile(filename):
+    """read_jobfile reads a JSON or YAML job file."""
+    with open(filename, 'r') as jobfile:
+        if filename.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                print("yaml is missing. Please install missing packages or use a JSON job file.")
+                sys.exit(2)
+            return yaml.safe_load(jobfile)
+        return json.load(jobfile)
+
+
+def input_identity(options):
+    """input_identity returns the identity of the input files of options."""
+    files = [options.tmaxfile, options.tminfile, options.bpfx, options.bpfn, options.maskfile]
+    return [tcache.file_identity(name) for name in files if name]
+
+
+def stage_key(description):
+    """stage_key returns the hash that identifies a stage."""
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def variant_arguments(name, season, method, output='.'):
+    """variant_arguments returns the arguments of a season and method of the
+    model called name, which are saved in their own directory of output."""
+    arguments = ['--season=%s'%(season), '--output-dir=%s'%(os.path.join(output, name, '%s_%s'%(season, method)))]
+    if method=='old': arguments.append('--old-method')
+    return arguments
+
+
+def expand(sweep, common=[], checkpoints='.', cachedir=None):
+    """expand expands a sweep into its stages.
+
+    Returns a dictionary of stages by key, in the order they are listed, and
+    a list of (name, error) of the models whose arguments are invalid or
+    whose name is used by a different model, as they would write the same
+    output files. Each
+    stage is a dictionary of its name, the number of its model, arguments,
+    the keys of the stages whose store it needs in after, the keys of the
+    stages whose thresholds it waits for in waits and, for the first stage of
+    a model, its store file.
+    """
+    definitions = sweep.get('definitions', ['EHF'])
+    yearly = []
+    if 'EHF' not in definitions: yearly.append('--noehf')
+    if 'tx90pct' in definitions: yearly.append('--tx90pc')
+    if 'tn90pct' in definitions: yearly.append('--tn90pc')
+    daily = []
+    if sweep.get('daily'):
+        if 'EHF' in definitions: daily.append('--daily')
+        if 'tx90pct' in definitions: daily.append('--tx90pc-daily')
+        if 'tn90pct' in definitions: daily.append('--tn90pc-daily')
+    if sweep.get('ehi'): daily.append('--ehi')
+    output = sweep.get('output', '.')
+    variants = [(season, method) for season in sweep.get('seasons', ['summer'])
+            for method in sweep.get('methods', ['new'])]
+    common = list(sweep.get('options', []))+list(common)
+    if cachedir: common = common+['--cache=%s'%(cachedir)]
+    stages = {}
+    failed = []
+    groups = {}
+    names = {}
+    for number, model in enumerate(sweep['models']):
+        name = batch.job_name(model)
+        arguments = batch.job_arguments(model, common+yearly+daily+variant_arguments(name, variants[0][0], variants[0][1], output))
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                options = getoptions.parse_arguments(arguments)
+            key = stage_key({'arguments': arguments, 'inputs': input_identity(options)})
+            thresholds = batch.threshold_key(options)
+        except (Exception, SystemExit) as error:
+            failed.append((name, repr(error)))
+            continue
+        if key in stages: continue
+        if name in names:
+            failed.append((name, "the output directory of model %s is used by model %s"%(number, names[name])))
+            continue
+        names[name] = number
+        store = os.path.join(checkpoints, key+'.nc')
+        # Models with the same thresholds wait for the first to calculate them
+        waits = []
+        if thresholds in groups: waits.append(groups[thresholds])
+        else: groups[thresholds] = key
+        stages[key] = {'name': '%s %s %s'%((name,)+variants[0]), 'model': number, 'after': [],
+                'waits': waits, 'arguments': arguments+['--store=%s'%(store)], 'store': store}
+        for season, method in variants[1:]:
+            arguments = common+yearly+variant_arguments(name, season, method, output)
+            yearlykey = stage_key({'series': key, 'arguments': arguments})
+            stages[yearlykey] = {'name': '%s %s %s'%(name, season, method), 'model': number, 'after': [key],
+                    'waits': [], 'arguments': arguments+['--from-store=%s'%(store)]}
+    return stages, failed
+
+
+def load_state(statefile):
+    """load_state returns the finished stages recorded in statefile."""
+    if not os.path.exists(statefile): return {}
+    with open(statefile, 'r') as state:
+        return json.load(state)
+
+
+def save_state(statefile, finished):
+    """save_state records the finished stages in statefile. The file is
+    replaced at once, so it is never left half written."""
+    with open(statefile+'.tmp', 'w') as state:
+        json.dump(finished, state, indent=1, sort_keys=True)
+    os.replace(statefile+'.tmp', statefile)
+
+
+def pending_stages(stages, finished):
+    """pending_stages returns the keys of the stages that still need to run.
+    A finished first stage of a model runs again if its store is gone and a
+    stage that needs the store has not finished."""
+    pending = set([key for key in stages if key not in finished])
+    for key in list(pending):
+        for before in stages[key]['after']:
+            if not os.path.exists(stages[before]['store']): pending.add(before)
+    return pending
+
+
+def run_stages(stages, finished, statefile, njobs=1):
+    """run_stages runs the pending stages in order of their dependencies with
+    njobs worker processes, recording each stage in the state file as soon as
+    it finishes. Stages that need the store of a failed stage are skipped, and
+    stages that wait for its thresholds calculate their own.
+
+    Returns a list of (name, model number, seconds, gridcell days, error) for
+    the stages in the order they finished.
+    """
+    pending = pending_stages(stages, finished)
+    summary = []
+    failed = set()
+    running = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, njobs)) as pool:
+        while pending or running:
+            for key in [key for key in stages if key in pending]:
+                after = stages[key]['after']
+                if any([before in failed for before in after]):
+                    pending.discard(key)
+                    failed.add(key)
+                    summary.append((stages[key]['name'], stages[key]['model'], 0., 0, 'skipped'))
+                elif not any([before in pending or before in running.values() for before in after+stages[key]['waits']]):
+                    pending.discard(key)
+                    running[pool.submit(batch.run_job, stages[key]['arguments'])] = key
+            if not running: continue
+            done, waiting = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                key = running.pop(future)
+                seconds, size, error = future.result()
+                summary.append((stages[key]['name'], stages[key]['model'], seconds, size, error))
+                if error:
+                    failed.add(key)
+                    continue
+                finished[key] = {'name': stages[key]['name'], 'seconds': seconds}
+                save_state(statefile, finished)
+    return summary
+
+
+if __name__=='__main__':
+    parser = OptionParser(usage="usage: %prog [--jobs N] [--checkpoints DIR] JOBFILE [ehfheatwaves.py options]")
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1, help='number of stages to run at a time. Default 1', metavar='N')
+    parser.add_option('--checkpoints', dest='checkpoints', help='directory of the state, stores and thresholds of the sweep. Default JOBFILE.checkpoints', metavar='DIR')
+    parser.disable_interspersed_args()
+    sweepoptions, args = parser.parse_args(sys.argv[1:])
+    if not args: parser.error("Please specify a job file.")
+    sweep = read_jobfile(args[0])
+    common = args[1:]
+    checkpoints = sweepoptions.checkpoints or args[0]+'.checkpoints'
+    if not os.path.isdir(checkpoints): os.makedirs(checkpoints)
+
+    # Thresholds are kept with the checkpoints unless a cache is given
+    cachedir = None
+    if not any([argument=='--cache' or argument.startswith('--cache=') for argument in common]):
+        cachedir = os.path.join(checkpoints, 'thresholds')
+    start = time.time()
+    stages, failed = expand(sweep, common, checkpoints, cachedir)
+    statefile = os.path.join(checkpoints, 'state.json')
+    finished = load_state(statefile)
+    pending = pending_stages(stages, finished)
+    print("%d stages, %d already finished"%(len(stages), len(stages)-len(pending)))
+    summary = run_stages(stages, finished, statefile, sweepoptions.jobs)
+    summary += [(name, -1, 0., 0, error) for name, error in failed]
+    batch.print_summary(summary, time.time()-start)
+    if any([entry[4] for entry in summary]): sys.exit(1)
@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+tcache.py stores percentile thresholds on disk so that runs with the same base
+period inputs do not have to reload the base period and recalculate them.
+
+Entries are addressed by a hash of everything the thresholds depend on: the
+identity (path, size and modification time) of the input files, the variable
+name, base period, percentile, quantile method, calendar, window size and
+land-sea mask. The cache is bounded in size and the least recently used
+entries are evicted first.
+
+Usage: tcache.py -c DIR [--list] [--purge [KEY ...]] [--max-size MB]
+"""
+import sys
+import os
+import glob
+import json
+import pickle
+import hashlib
+import datetime as dt
+try:
+    modulename = 'optparse'
+    from optparse import OptionParser
+except ImportError:
+    print(modulename, " is missing. Please install missing packages.")
+    sys.exit(2)
+import numpy as np
+
+
+# Increment when the thresholds calculation changes so old entries miss.
+cacheversion = 1
+
+
+def file_identity(files):
+    """Return the (path, size, mtime) of every file matched by files."""
+    if any([(wildcard in files) for wildcard in ['*','?','[']]):
+        paths = sorted(glob.glob(files))
+    else:
+        paths = [files]
+    identity = []
+    for path in paths:
+        stat = os.stat(path)
+        identity.append((os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+    return identity
+
+
+def cache_key(options, timedata, variable, mask=None, wsize=15, rows=None):
+    """cache_key returns the hash that identifies the thresholds of variable
+    ('tave', 'tmax' or 'tmin') for these options. rows is the slice of
+    latitude rows of a band of the grid, or None for the whole grid.
+    """
+    inputs = []
+    if variable in ('tave', 'tmax'):
+        inputs.append(('tmax', file_identity(options.bpfx or options.tmaxfile), options.tmaxvname))
+    if variable in ('tave', 'tmin'):
+        inputs.append(('tmin', file_identity(options.bpfn or options.tminfile), options.tminvname))
+    if mask is None:
+        maskhash = None
+    else:
+        maskhash = hashlib.sha1(np.ascontiguousarray(mask).tobytes()).hexdigest()+str(mask.shape)
+    description = {'version': cacheversion,
+            'variable': variable,
+            'inputs': inputs,
+            'base_period': [options.bpstart, options.bpend],
+            'percentile': options.pcntl,
+            'quantile_method': options.qtilemethod,
+            'calendar': timedata.calendar,
+            'daysinyear': timedata.daysinyear,
+            'window': wsize,
+            'mask': maskhash}
+    if rows is not None: description['rows'] = [rows.start, rows.stop]
+    if options.precision=='single': description['precision'] = 'single'
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def load(options, timedata, variable, mask=None, rows=None):
+    """load returns the cached thresholds of variable or None on a miss. An
+    entry that cannot be read, such as a truncated file, is removed and is a
+    miss."""
+    key = cache_key(options, timedata, variable, mask, rows=rows)
+    filename = os.path.join(options.cachedir, key+'.npy')
+    try:
+        pctl = np.load(filename)
+    except (ValueError, EOFError, pickle.UnpicklingError):
+        if options.verbose: print("Removing unreadable cached %s thresholds"%(variable))
+        for name in (filename, os.path.join(options.cachedir, key+'.json')):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+        return None
+    except IOError:
+        return None
+    # Mark the entry as recently used.
+    os.utime(filename, None)
+    if options.verbose: print("Using cached %s thresholds"%(variable))
+    return pctl
+
+
+def store(options, timedata, variable, pctl, mask=None, rows=None):
+    """store saves thresholds to the cache and evicts old entries if the
+    cache is larger than options.cachesize megabytes.
+    """
+    if not os.path.isdir(options.cachedir): os.makedirs(options.cachedir)
+    key = cache_key(options, timedata, variable, mask, rows=rows)
+    filename = os.path.join(options.cachedir, key+'.npy')
+    # Write to temporary files first so concurrent runs never read a partial entry.
+    temporary = filename+'.%d.tmp'%(os.getpid())
+    with open(temporary, 'wb') as tempfile:
+        np.save(tempfile, np.asarray(pctl))
+    os.replace(temporary, filename)
+    info = {'variable': variable,
+            'tmax_file': options.bpfx or options.tmaxfile,
+            'tmin_file': options.bpfn or options.tminfile,
+            'base_period': '%s-%s'%(options.bpstart, options.bpend),
+            'rows': None if rows is None else '%s-%s'%(rows.start, rows.stop-1),
+            'percentile': options.pcntl,
+            'quantile_method': options.qtilemethod,
+            'created': dt.datetime.today().strftime('%Y-%m-%d %H:%M:%S')}
+    infoname = os.path.join(options.cachedir, key+'.json')
+    with open(infoname+'.%d.tmp'%(os.getpid()), 'w') as infofile:
+        json.dump(info, infofile)
+    os.replace(infoname+'.%d.tmp'%(os.getpid()), infoname)
+    evict(options.cachedir, options.cachesize)
+
+
+def entries(cachedir):
+    """entries lists the cached thresholds from least to most recently used.
+
+    Returns a list of (key, size in bytes, last used time, info) tuples.
+    """
+    result = []
+    for filename in glob.glob(os.path.join(cachedir, '*.npy')):
+        key = os.path.basename(filename)[:-4]
+        stat = os.stat(filename)
+        try:
+            with open(os.path.join(cachedir, key+'.json'), 'r') as infofile:
+                info = json.load(infofile)
+        except (IOError, ValueError):
+            info = {}
+        result.append((key, stat.st_size, stat.st_mtime, info))
+    result.sort(key=lambda entry: entry[2])
+    return result
+
+
+def purge(cachedir, keys=None):
+    """purge removes the given cache entries, or all entries if keys is None."""
+    for key, size, used, info in entries(cachedir):
+        if (keys is None) or (key in keys):
+            os.remove(os.path.join(cachedir, key+'.npy'))
+            if os.path.exists(os.path.join(cachedir, key+'.json')):
+                os.remove(os.path.join(cachedir, key+'.json'))
+
+
+def evict(cachedir, maxsize):
+    """evict removes least recently used entries until the cache is no larger
+    than maxsize megabytes.
+    """
+    cached = entries(cachedir)
+    total = sum([entry[1] for entry in cached])
+    for key, size, used, info in cached:
+        if total<=maxsize*1024**2: break
+        purge(cachedir, [key])
+        total -= size
+
+
+if __name__=='__main__':
+    parser = OptionParser(usage="usage: %prog -c DIR [--list] [--purge [KEY ...]] [--max-size MB]")
+    parser.add_option('-c', '--cache', dest='cachedir', help='threshold cache directory', metavar='DIR')
+    parser.add_option('-l', '--list', action='store_true', dest='list', default=False, help='list cache entries')
+    parser.add_option('--purge', action='store_true', dest='purge', default=False, help='remove the given entries, or all entries if none are given')
+    parser.add_option('--max-size', dest='maxsize', type='float', help='evict least recently used entries down to this size', metavar='MB')
+    options, args = parser.parse_args(sys.argv[1:])
+    if not options.cachedir: parser.error('Please specify the cache directory.')
+    if options.purge: purge(options.cachedir, args or None)
+    if options.maxsize is not None: evict(options.cachedir, options.maxsize)
+    if options.list or not (options.purge or options.maxsize is not None):
+        total = 0
+        for key, size, used, info in entries(options.cachedir):
+            total += size
+            print(key, '%.1fMB'%(size/1024.**2),
+                    dt.datetime.fromtimestamp(used).strftime('%Y-%m-%d %H:%M'),
+                    info.get('variable', ''), info.get('base_period', ''),
+                    info.get('quantile_method', ''), info.get('tmax_file', ''),
+                    info.get('tmin_file', ''))
+        print('Total %.1fMB'%(total/1024.**2))
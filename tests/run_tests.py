@@ -22,6 +22,45 @@ import optparse
 import getoptions
 import qtiler
 import ncio
+import tcache
+import scratch
+import batch
+import sweep
+import tempfile
+import shutil
+
+
+def write_grid(directory, landfraction, seed, missing=None):
+    """Write a three year noleap tas.nc file of tasmax and tasmin and a
+    mask.nc file of landfraction, and return their names. missing is an
+    optional (lat, lon) point without tasmax data."""
+    landfraction = np.array(landfraction)
+    space = landfraction.shape
+    datafile = os.path.join(directory, 'tas.nc')
+    ncfile = nc.Dataset(datafile, 'w')
+    ncfile.createDimension('time', None)
+    ncfile.createDimension('lat', space[0])
+    ncfile.createDimension('lon', space[1])
+    time = ncfile.createVariable('time', 'f8', ('time',))
+    time.units = 'days since 2000-01-01'
+    time.calendar = 'noleap'
+    time[:] = np.arange(3*365)
+    ncfile.createVariable('lat', 'f4', ('lat',))[:] = np.linspace(-10, 10, space[0])
+    ncfile.createVariable('lon', 'f4', ('lon',))[:] = np.arange(space[1])
+    cycle = 10*np.cos(np.arange(3*365)*2*np.pi/365.)[:,None,None]
+    noise = np.random.RandomState(seed).normal(size=(3*365,)+space)*4
+    tasmax = np.ma.array(25 + cycle + noise)
+    if missing is not None: tasmax[(slice(None),)+tuple(missing)] = np.ma.masked
+    ncfile.createVariable('tasmax', 'f4', ('time','lat','lon'), fill_value=np.float32(1e20))[:] = tasmax
+    ncfile.createVariable('tasmin', 'f4', ('time','lat','lon'))[:] = 15 + cycle + noise/2.
+    ncfile.close()
+    maskfile = os.path.join(directory, 'mask.nc')
+    ncfile = nc.Dataset(maskfile, 'w')
+    ncfile.createDimension('lat', space[0])
+    ncfile.createDimension('lon', space[1])
+    ncfile.createVariable('sftlf', 'f4', ('lat','lon'))[:] = landfraction
+    ncfile.close()
+    return datafile, maskfile
 
 
 class TestRQtiler(unittest.TestCase):
@@ -62,6 +101,22 @@ class TestRQtiler(unittest.TestCase):
         for case in knownCases:
             self.assertAlmostEqual(qtiler.quantile_R(self.testdata,70,itype=case[0]),case[1],places=6)
 
+    def testAxis(self):
+        """Quantiles along an axis should match the quantile of each column."""
+        data = np.array([self.testdata, self.testdata[::-1]*2]).T
+        for itype in range(1,10):
+            result = qtiler.quantile_R(data,70,itype=itype,axis=0)
+            self.assertEqual(result[0], qtiler.quantile_R(data[:,0],70,itype=itype))
+            self.assertEqual(result[1], qtiler.quantile_R(data[:,1],70,itype=itype))
+
+    def testAxisNans(self):
+        """Each column should use its own number of valid samples."""
+        data = np.array([self.testdata, self.testdata*2.]).T
+        data[:4,1] = np.nan
+        result = qtiler.quantile_R(data,70,axis=0,rmnans=True)
+        self.assertEqual(result[1], qtiler.quantile_R(data[4:,1],70))
+        self.assertRaises(Exception, qtiler.quantile_R, data, 70, axis=0)
+
 
 class TestZhangQtiler(unittest.TestCase):
     """Test the Zhang quantile function."""
@@ -96,6 +151,14 @@ class TestZhangQtiler(unittest.TestCase):
         """Test a known case for corectness."""
         self.assertEqual(qtiler.quantile_zhang(self.testdata,70),7.0)
 
+    def testColumnsNans(self):
+        """2D input should match the quantile of each column without nans."""
+        data = np.array([self.testdata, self.testdata*2.]).T
+        data[:4,1] = np.nan
+        result = qtiler.quantile_zhang(data,70,rmnans=True)
+        self.assertEqual(result[0], qtiler.quantile_zhang(self.testdata,70))
+        self.assertEqual(result[1], qtiler.quantile_zhang(data[4:,1],70))
+
     # Fast verison
     def testNegativeP2(self):
         """p < 0 should return an exception error."""
@@ -159,6 +222,72 @@ class TestClimpactQtiler(unittest.TestCase):
         """Test a known case for corectness."""
         self.assertAlmostEqual(qtiler.quantile_climpact(self.testdata,70),6.8666666666666654)
 
+    def testColumns(self):
+        """2D input should match the quantile of each column, including nans."""
+        data = np.random.RandomState(0).normal(size=(20,4))
+        data[:5,1] = np.nan
+        data[:,2] = np.nan
+        result = qtiler.quantile_climpact(data,90)
+        self.assertEqual(result[0], qtiler.qclimpact(data[:,0],0.9))
+        self.assertEqual(result[1], qtiler.qclimpact(data[:,1],0.9))
+        self.assertTrue(np.isnan(result[2]))
+
+class TestWindowPercentile(unittest.TestCase):
+    """Tests for the window_percentile function."""
+
+    options = optparse.Values({'bpstart':1991, 'bpend':1995, 'pcntl':90, 'precision':'double'})
+    temp = np.random.RandomState(0).normal(size=(5*365,3)).astype(np.float32)
+
+    def loopPercentile(self, percentile, parameter, temp=None):
+        """Reference day by day calculation using a rolled window mask, of
+        the days that are not masked."""
+        if temp is None: temp = self.temp
+        window = np.zeros(365, dtype=bool)
+        window[-7:] = 1
+        window[:8] = 1
+        window = np.tile(window, 5)
+        pctl = np.ones((365,3))
+        for day in range(365):
+            for x in range(3):
+                sample = np.ma.compressed(temp[window,x])
+                if sample.size: pctl[day,x] = percentile(sample, 90, parameter)
+                else: pctl[day,x] = ehfheatwaves.missingval
+            window = np.roll(window, 1)
+        return pctl
+
+    def testClimpact(self):
+        """Should be identical to the climpact quantile of each window."""
+        self.options.qtilemethod = 'climpact'
+        result = ehfheatwaves.window_percentile(self.temp, self.options)
+        self.assertTrue((result==self.loopPercentile(qtiler.quantile_climpact, False)).all())
+
+    def testMatlab(self):
+        """Should be identical to quantile_R type 5 of each window."""
+        self.options.qtilemethod = 'matlab'
+        result = ehfheatwaves.window_percentile(self.temp, self.options, blocksize=1)
+        self.assertTrue((result==self.loopPercentile(qtiler.quantile_R, 5)).all())
+
+    def testMasked(self):
+        """Masked days should be left out of the windows of every method."""
+        temp = np.ma.array(self.temp.copy())
+        temp[[10,11,400,1000],0] = np.ma.masked
+        temp.data[temp.mask] = 1e20
+        temp[:,2] = np.ma.masked
+        references = {'python': (np.percentile, None), 'zhang': (qtiler.quantile_zhang_fast, False),
+                'matlab': (qtiler.quantile_R, 5), 'climpact': (qtiler.quantile_climpact, False)}
+        for method, (percentile, parameter) in references.items():
+            self.options.qtilemethod = method
+            result = ehfheatwaves.window_percentile(temp, self.options)
+            self.assertTrue(np.allclose(result, self.loopPercentile(percentile, parameter, temp), rtol=0, atol=1e-10))
+            self.assertTrue((result[:,1]==ehfheatwaves.window_percentile(self.temp[:,1:2], self.options)[:,0]).all())
+
+    def testShape(self):
+        """Output should be (daysinyear, space...)."""
+        self.options.qtilemethod = 'python'
+        result = ehfheatwaves.window_percentile(self.temp.reshape(5*365,3,1), self.options)
+        self.assertEqual(result.shape, (365,3,1))
+
+
 class TestCalendar360(unittest.TestCase):
     """Tests for the Calendar360 class."""
 
@@ -181,6 +310,86 @@ class TestCalendar360(unittest.TestCase):
         self.assertIs(type(self.calendar[0]), dt.datetime)
 
 
+class TestExcessHeat(unittest.TestCase):
+    """Tests for the excess_heat function."""
+
+    tave = np.ma.array(np.random.RandomState(0).normal(20, 5, size=(400,2)))
+    tpct = np.random.RandomState(1).normal(25, 1, size=(365,2))
+
+    def testLoop(self):
+        """Should match the day by day calculation of the indices."""
+        EHIsig, EHIaccl, EHF = ehfheatwaves.excess_heat(self.tave, self.tpct)
+        for i in range(32, self.tave.shape[0]):
+            accl = self.tave[i-2:i+1].sum(axis=0)/3. - self.tave[i-32:i-2].sum(axis=0)/30.
+            sig = self.tave[i-2:i+1].sum(axis=0)/3. - self.tpct[i%365]
+            self.assertTrue(np.allclose(EHIaccl[i], accl, rtol=0, atol=1e-10))
+            self.assertTrue(np.allclose(EHIsig[i], sig, rtol=0, atol=1e-10))
+            self.assertTrue(np.allclose(EHF[i], np.maximum(np.maximum(accl, 1.)*sig, 0), rtol=0, atol=1e-10))
+        self.assertTrue(np.isnan(EHF[:32]).all())
+
+    def testMissing(self):
+        """Missing days should count as zero, as in masked sums, and indices
+        should be masked only where all the days of a window are missing."""
+        tave = self.tave.copy()
+        tave[100,0] = np.ma.masked
+        tave[200:203,0] = np.ma.masked
+        EHIsig, EHIaccl, EHF = ehfheatwaves.excess_heat(tave, self.tpct)
+        for i in range(32, tave.shape[0]):
+            accl = tave[i-2:i+1].sum(axis=0)/3. - tave[i-32:i-2].sum(axis=0)/30.
+            sig = tave[i-2:i+1].sum(axis=0)/3. - self.tpct[i%365]
+            self.assertTrue(np.allclose(EHIaccl[i], accl, rtol=0, atol=1e-10))
+            self.assertTrue(np.allclose(EHIsig[i], sig, rtol=0, atol=1e-10))
+        self.assertEqual(list(np.nonzero(EHF.mask[:,0])[0]), [202])
+        self.assertEqual(list(np.nonzero(EHIsig.mask[:,0])[0]), [202])
+        self.assertFalse(EHF.mask[:,1].any())
+
+    def testGapInHeatwave(self):
+        """A missing day inside a heatwave should count as zero and break it."""
+        tave = np.ma.array(np.full((400,1), 20.))
+        tave[300:306] = 35.
+        tpct = np.full((365,1), 25.)
+        EHF = ehfheatwaves.excess_heat(tave, tpct)[2]
+        events = ehfheatwaves.identify_hw(EHF)[0]
+        self.assertTrue(events[301:307,0].all())
+        tave[302] = np.ma.masked
+        EHF = ehfheatwaves.excess_heat(tave, tpct)[2]
+        self.assertFalse(EHF.mask.any())
+        self.assertTrue(np.allclose(EHF[300:308,0], [0, 50, 0, 0, 0, 10*(35-61./3), 5*(30-125./6), 0]))
+        events = ehfheatwaves.identify_hw(EHF)[0]
+        self.assertFalse(events.any())
+
+    def testMissingThreshold(self):
+        """Days whose threshold is missing should have missing indices."""
+        tpct = self.tpct.copy()
+        tpct[150,1] = ehfheatwaves.missingval
+        EHIsig, EHIaccl, EHF = ehfheatwaves.excess_heat(self.tave, tpct)
+        for index in (EHIsig, EHIaccl, EHF):
+            self.assertEqual(list(np.nonzero(index.mask[:,1])[0]), [150])
+            self.assertFalse(index.mask[:,0].any())
+
+    def testPlain(self):
+        """heat_indices should give plain arrays that are nan where excess_heat is masked."""
+        tave = self.tave.copy()
+        tave[100,0] = np.ma.masked
+        EHF = ehfheatwaves.excess_heat(tave, self.tpct)[2]
+        plain = ehfheatwaves.heat_indices(tave, self.tpct)
+        self.assertIs(type(plain[2]), np.ndarray)
+        self.assertTrue((plain[3]==EHF.mask).all())
+        self.assertTrue(np.array_equal(plain[2], np.ma.filled(EHF, np.nan), equal_nan=True))
+
+
+class TestExceedance(unittest.TestCase):
+    """Tests for the exceedance function."""
+
+    def testKnownCase(self):
+        """Should be temp above the threshold of each day of year, zero below and nan if missing."""
+        temp = np.ma.array(np.tile([1., 5., 3.], 3).reshape(9,1))
+        temp[4] = np.ma.masked
+        pct = np.array([[2.], [4.], [2.]])
+        exceed = ehfheatwaves.exceedance(temp, pct, daysinyear=3)
+        self.assertTrue(np.array_equal(exceed[:,0], [0,5,3,0,np.nan,3,0,5,3], equal_nan=True))
+
+
 class TestIdentifyHW(unittest.TestCase):
     """Tests for the identify_hw function."""
 
@@ -212,6 +421,19 @@ class TestIdentifyHW(unittest.TestCase):
         self.assertEqual(events.shape, input_shape)
         self.assertEqual(ends.shape, input_shape)
 
+    def testGrid(self):
+        """Every column of a grid should match the single series result."""
+        ehfdata = np.ma.array(np.tile(self.ehfdata, (3,1)).T)
+        ehfdata[:,1] = np.roll(self.ehfdata, 1)
+        ehfdata[5,2] = np.ma.masked
+        events, ends = ehfheatwaves.identify_hw(ehfdata)
+        self.assertTrue((ends[:,0]==self.known_ends).all())
+        self.assertTrue((ends[:,1]==np.roll(self.known_ends, 1)).all())
+        self.assertTrue((events[:,1]==np.roll(self.known_events, 1)).all())
+        # Masking the first day leaves a two day event, which is not a heatwave.
+        self.assertTrue((ends[:,2]==[0,0,0,0,0,0,0,0,0,5,0,0,0,0,0]).all())
+        self.assertEqual(ends.dtype, np.int16)
+
 
 class TestIdentifySemiHW(unittest.TestCase):
     """Tests for the identify_semi_hw function."""
@@ -245,6 +467,290 @@ class TestIdentifySemiHW(unittest.TestCase):
         self.assertEqual(ends.shape, input_shape)
 
 
+class TestHWMagnitude(unittest.TestCase):
+    """Tests for the hw_magnitude function."""
+
+    def testLoop(self):
+        """Should match the heatwave by heatwave calculation exactly."""
+        ehf = np.ma.array(np.random.RandomState(2).normal(size=(150,20))*10 + 2)
+        ehf[ehf<0] = 0
+        duration = ehfheatwaves.identify_hw(ehf)[1]
+        HWM, HWA = ehfheatwaves.hw_magnitude(ehf, duration)
+        for x in range(ehf.shape[1]):
+            i = np.where(duration[:,x]>0)[0]
+            d = duration[i,x]
+            hw_mag = [np.nanmean(ehf[i[hw]:i[hw]+d[hw],x]) for hw in range(len(d))]
+            self.assertEqual(HWM[x], np.nanmean(hw_mag))
+            idex = np.where(hw_mag==max(hw_mag))[0][0]
+            self.assertEqual(HWA[x], ehf[i[idex]:i[idex]+d[idex],x].max())
+
+    def testNoHeatwaves(self):
+        """Columns without heatwaves should be nan."""
+        ehf = np.ma.array(np.tile(TestIdentifyHW.ehfdata, (2,1)).T)
+        ehf[:,1] = 0
+        duration = ehfheatwaves.identify_hw(ehf)[1]
+        HWM, HWA = ehfheatwaves.hw_magnitude(ehf, duration)
+        self.assertEqual(HWA[0], 30.2)
+        self.assertTrue(np.isnan(HWM[1]) and np.isnan(HWA[1]))
+
+
+class TestSeasonStack(unittest.TestCase):
+    """Tests for the season_stack function."""
+
+    def testSlices(self):
+        """Each year should be the same as slicing that year's season."""
+        ehf = np.ma.array(np.arange(365*4*3.).reshape(365*4,3))
+        ehf[400,1] = np.ma.masked
+        stack = ehfheatwaves.season_stack(ehf, 298, 171, 3)
+        self.assertEqual(stack.shape, (171,3,3))
+        for iyear in range(3):
+            season = ehf[298+365*iyear:298+365*iyear+171,...]
+            self.assertTrue((stack[:,iyear,:]==season).all())
+            self.assertTrue((stack.mask[:,iyear,:]==season.mask).all())
+
+
+class TestParallelChain(unittest.TestCase):
+    """Tests for the heatwave_chain and parallel_chain functions."""
+
+    def setUp(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self.options = getoptions.parse_arguments(['-x', 'tmax.nc', '-n', 'tmin.nc',
+                    '--base=2000-2001', '-d', '--t90pc', '--tx90pc-daily', '--workers=3'])
+        self.timedata = ncio.TimeData()
+        self.timedata.daysinyear = 365
+        self.timedata.SHS = (304,455)
+        self.timedata.SHW = (120,273)
+        self.timedata.daylast = dt.datetime(2004,12,31)
+        cycle = 10*np.cos(np.arange(5*365)*2*np.pi/365.)[:,None]
+        noise = np.random.RandomState(3).normal(size=(5*365,7))*4
+        self.tmax = np.ma.array(25 + cycle + noise)
+        self.tmin = np.ma.array(15 + cycle + noise/2.)
+        self.tmax[40,2] = np.ma.masked
+        self.south = np.array([1,1,1,0,0,1,0], dtype=bool)
+
+    def testParallel(self):
+        """Splitting the columns between processes should not change the results."""
+        data = {'tmax': self.tmax, 'tmin': self.tmin,
+                'tmax_bp': self.tmax[:730], 'tmin_bp': self.tmin[:730]}
+        serial = ehfheatwaves.heatwave_chain(self.options, self.timedata, 2000, self.south, **data)
+        parallel = ehfheatwaves.parallel_chain(self.options, self.timedata, 2000, self.south, **data)
+        self.assertEqual(sorted(serial.keys()), sorted(parallel.keys()))
+        for key in serial:
+            if isinstance(serial[key], tuple):
+                for aspect, parallel_aspect in zip(serial[key], parallel[key]):
+                    self.assertTrue((aspect==parallel_aspect).all())
+            else:
+                self.assertTrue(np.array_equal(np.ma.getdata(serial[key]),
+                        np.ma.getdata(parallel[key]), equal_nan=True))
+                self.assertTrue((np.ma.getmaskarray(serial[key])==np.ma.getmaskarray(parallel[key])).all())
+
+    def testColumnBlocks(self):
+        """Calculating the aspects in blocks of columns should not change them."""
+        ehf = ehfheatwaves.heatwave_chain(self.options, self.timedata, 2000, self.south,
+                tmax=self.tmax, tmin=self.tmin, tmax_bp=self.tmax[:730], tmin_bp=self.tmin[:730])['EHF']
+        whole = ehfheatwaves.split_hemispheres(ehf, self.south, self.options, self.timedata, 2000)
+        blocks = ehfheatwaves.split_hemispheres(ehf, self.south, self.options, self.timedata, 2000, blocksize=3*365)
+        for aspect, block_aspect in zip(whole, blocks):
+            self.assertTrue(np.array_equal(aspect, block_aspect))
+
+    def testMaskedEHI(self):
+        """EHIs should be masked in a column without data and its missing
+        thresholds should not leak into them."""
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            options = getoptions.parse_arguments(['-x', 'tmax.nc', '-n', 'tmin.nc',
+                    '--base=2000-2001', '--ehi'])
+        tmax = self.tmax.copy()
+        tmax[:,4] = np.ma.masked
+        results = ehfheatwaves.heatwave_chain(options, self.timedata, 2000, self.south,
+                tmax=tmax, tmin=self.tmin, tmax_bp=tmax[:730], tmin_bp=self.tmin[:730])
+        for key in ('EHIsig', 'EHIaccl'):
+            self.assertTrue(results[key].mask[32:,4].all())
+            self.assertFalse(results[key].mask[:,[0,1,3,5,6]].any())
+            self.assertLess(np.abs(results[key][32:]).max(), 100)
+
+    def testMaskedEHIOutput(self):
+        """The EHI file of a masked grid should be missing at a land point
+        without data and at sea, and valid at the other land points."""
+        tempdir = tempfile.mkdtemp()
+        try:
+            landfraction = [[100, 100, 0], [100, 0, 100]]
+            datafile, maskfile = write_grid(tempdir, landfraction, 8, missing=(1,2))
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                options = getoptions.parse_arguments(['-x', datafile, '-n', datafile, '-m', maskfile,
+                        '--base=2000-2001', '--ehi', '--output-dir', tempdir])
+                ehfheatwaves.HeatwavePipeline(options).run()
+            ncfile = nc.Dataset(os.path.join(tempdir, 'EHI_heatwaves____daily.nc'))
+            for key in ('EHIsig', 'EHIaccl'):
+                # Negative EHIs are outside the valid_range, so read the raw values
+                ncfile.variables[key].set_auto_mask(False)
+                index = ncfile.variables[key][32:]
+                self.assertTrue((index[:,1,2]==ehfheatwaves.missingval).all())
+                self.assertTrue((index[:,np.array(landfraction)==0]==ehfheatwaves.fillval).all())
+                land = index[:,[0,0,1],[0,1,0]]
+                self.assertTrue(np.isfinite(land).all())
+                self.assertFalse(np.isin(land, [ehfheatwaves.missingval, ehfheatwaves.fillval]).any())
+            ncfile.close()
+        finally:
+            shutil.rmtree(tempdir)
+
+    def testSinglePrecision(self):
+        """Single precision should only differ from double precision by rounding."""
+        data = {'tmax': self.tmax.astype(np.float32), 'tmin': self.tmin.astype(np.float32),
+                'tmax_bp': self.tmax[:730].astype(np.float32), 'tmin_bp': self.tmin[:730].astype(np.float32)}
+        double = ehfheatwaves.heatwave_chain(self.options, self.timedata, 2000, self.south, **data)
+        self.options.precision = 'single'
+        single = ehfheatwaves.heatwave_chain(self.options, self.timedata, 2000, self.south, **data)
+        for key in ['tpct', 'txpct', 'EHF', 'txexceed']:
+            self.assertEqual(single[key].dtype, np.float32)
+            deviation = np.nanmax(np.abs(np.ma.filled(single[key], np.nan) - np.ma.filled(double[key], np.nan)))
+            self.assertLess(deviation, 1e-4)
+        for key in ['event', 'ends', 'event_tx', 'ends_tx']:
+            self.assertTrue((single[key]==double[key]).all())
+        for aspect, double_aspect in zip(single['EHF_aspects'], double['EHF_aspects']):
+            self.assertTrue(np.allclose(aspect, double_aspect, rtol=0, atol=1e-4))
+
+
+class TestHeatwavePipeline(unittest.TestCase):
+    """Tests for driving the stages of HeatwavePipeline with arrays in memory."""
+
+    def setUp(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self.options = getoptions.parse_arguments(['-x', 'tmax.nc', '-n', 'tmin.nc',
+                    '--base=2000-2001', '--t90pc', '--ehi'])
+        self.timedata = ncio.make_time_data('noleap', dt.datetime(2000,1,1), dt.datetime(2004,12,31))
+        cycle = 10*np.cos(np.arange(5*365)*2*np.pi/365.)[:,None]
+        noise = np.random.RandomState(6).normal(size=(5*365,5))*4
+        self.tmax = np.ma.array(25 + cycle + noise)
+        self.tmin = np.ma.array(15 + cycle + noise/2.)
+        self.tmin[100,1] = np.ma.masked
+        self.south = np.array([1,0,1,0,0], dtype=bool)
+
+    def testStages(self):
+        """The stages should give the results of heatwave_chain."""
+        pipeline = ehfheatwaves.HeatwavePipeline(self.options, self.timedata, first_year=2000)
+        thresholds = pipeline.thresholds(self.tmax[:730], self.tmin[:730])
+        series = pipeline.index(thresholds, self.tmax, self.tmin)
+        aspects = pipeline.aspects(series, self.south)
+        chain = ehfheatwaves.heatwave_chain(self.options, self.timedata, 2000, self.south,
+                tmax=self.tmax, tmin=self.tmin, tmax_bp=self.tmax[:730], tmin_bp=self.tmin[:730])
+        for key in ['tpct', 'txpct', 'tnpct']:
+            self.assertTrue((thresholds[key]==chain[key]).all())
+        self.assertTrue(np.array_equal(series['EHIsig'], chain['EHIsig'].filled(np.nan), equal_nan=True))
+        self.assertTrue(np.isnan(series['tn_series'][100,1]))
+        for key in ['EHF_aspects', 'tx_aspects', 'tn_aspects']:
+            for aspect, chain_aspect in zip(aspects[key], chain[key]):
+                self.assertTrue(np.array_equal(aspect, chain_aspect))
+
+    def testProcessSettings(self):
+        """A pipeline should not inherit the scratch directory and write block
+        size of an earlier pipeline in the same process."""
+        tempdir = tempfile.mkdtemp()
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                options = getoptions.parse_arguments(['-x', 'tmax.nc', '-n', 'tmin.nc',
+                        '--scratch', tempdir, '--write-block', '0.01'])
+            ehfheatwaves.HeatwavePipeline(options, self.timedata, first_year=2000)
+            self.assertEqual(scratch.directory, tempdir)
+            self.assertEqual(ncio.writeblocksize, 10485)
+            ehfheatwaves.HeatwavePipeline(self.options, self.timedata, first_year=2000)
+            self.assertIs(scratch.directory, None)
+            self.assertEqual(ncio.writeblocksize, ncio.defaultwriteblocksize)
+        finally:
+            scratch.directory = None
+            shutil.rmtree(tempdir)
+
+    def testCachedThresholds(self):
+        """Given thresholds should be used instead of the base period."""
+        pipeline = ehfheatwaves.HeatwavePipeline(self.options, self.timedata, first_year=2000)
+        thresholds = pipeline.thresholds(self.tmax[:730], self.tmin[:730])
+        given = pipeline.thresholds(**thresholds)
+        for key in thresholds:
+            self.assertIs(given[key], thresholds[key])
+
+
+class TestTileRows(unittest.TestCase):
+    """Tests for the tile_rows function."""
+
+    options = optparse.Values({'tile':None, 'maxmemory':None, 'prefetch':0})
+
+    def testWholeGrid(self):
+        """Without --tile or --max-memory the band should be the whole grid."""
+        self.assertEqual(ehfheatwaves.tile_rows(self.options, (365,10,20)), 10)
+
+    def testMaxMemory(self):
+        """Bands should fit in the memory limit and have at least one row."""
+        options = optparse.Values({'tile':None, 'maxmemory':1, 'prefetch':0})
+        rows = ehfheatwaves.tile_rows(options, (365,100,2))
+        self.assertLessEqual(rows*365*2*ehfheatwaves.bytesperday, 1024**2)
+        self.assertGreater((rows+1)*365*2*ehfheatwaves.bytesperday, 1024**2)
+        options.maxmemory = 0.001
+        self.assertEqual(ehfheatwaves.tile_rows(options, (365,100,2)), 1)
+
+    def testPrefetch(self):
+        """Bands read ahead should share the memory limit."""
+        options = optparse.Values({'tile':None, 'maxmemory':1, 'prefetch':0})
+        rows = ehfheatwaves.tile_rows(options, (365,100,2))
+        options.prefetch = 1
+        self.assertEqual(ehfheatwaves.tile_rows(options, (365,100,2)), rows//2)
+
+    def testSeaBand(self):
+        """A band of latitude rows without land should not stop a masked run
+        and the output should be that of the whole grid."""
+        tempdir = tempfile.mkdtemp()
+        try:
+            datafile, maskfile = write_grid(tempdir, [[100, 0], [0, 0], [100, 100]], 7)
+            outputs = {}
+            for tile in ([], ['--tile', '1']):
+                outdir = os.path.join(tempdir, 'tile%d'%(len(tile)))
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    options = getoptions.parse_arguments(['-x', datafile, '-n', datafile, '-m', maskfile,
+                            '--base=2000-2001', '-d', '--t90pc', '--output-dir', outdir]+tile)
+                    ehfheatwaves.HeatwavePipeline(options).run()
+                outputs[len(tile)] = outdir
+            for name in os.listdir(outputs[0]):
+                whole = nc.Dataset(os.path.join(outputs[0], name))
+                bands = nc.Dataset(os.path.join(outputs[2], name))
+                for variable in whole.variables:
+                    self.assertTrue(np.array_equal(np.ma.filled(whole.variables[variable][:].astype(float), np.nan),
+                            np.ma.filled(bands.variables[variable][:].astype(float), np.nan), equal_nan=True))
+                whole.close()
+                bands.close()
+        finally:
+            shutil.rmtree(tempdir)
+
+
+class TestPrefetcher(unittest.TestCase):
+    """Tests for the Prefetcher background reader."""
+
+    def testOrder(self):
+        """Items should be loaded once each and given in order."""
+        for depth in [0, 1, 3]:
+            loaded = []
+            def load(item):
+                loaded.append(item)
+                return item*2
+            prefetcher = ncio.Prefetcher(load, list(range(10)), depth)
+            self.assertEqual(list(prefetcher), [(i, i*2) for i in range(10)])
+            self.assertEqual(loaded, list(range(10)))
+
+    def testError(self):
+        """Errors while loading should be raised by the iteration."""
+        def load(item):
+            if item==2: raise IOError('unreadable')
+            return item
+        prefetcher = ncio.Prefetcher(load, list(range(5)), 1)
+        items = iter(prefetcher)
+        self.assertEqual(next(items), (0, 0))
+        self.assertEqual(next(items), (1, 1))
+        self.assertRaises(IOError, next, items)
+
+
 class TestGetOptions(unittest.TestCase):
     """Tests for the getoptins module"""
 
@@ -308,6 +814,18 @@ class TestGetOptions(unittest.TestCase):
             '--base=1960-2010']
         self.assertIs(type(getoptions.parse_arguments(args)), optparse.Values)
 
+    def testChunks(self):
+        """Chunk sizes should be parsed and invalid chunks raise an exception."""
+        options = getoptions.parse_arguments(self.args+['--chunks=365,10,10'])
+        self.assertEqual(options.chunks, (365,10,10))
+        self.assertRaises(getoptions.InvalidChunksError, getoptions.parse_arguments, self.args+['--chunks=365,10'])
+        self.assertRaises(getoptions.InvalidChunksError, getoptions.parse_arguments, self.args+['--chunks=rows'])
+
+    def testFromStore(self):
+        """Should work without input files from a store, but not make daily output."""
+        self.assertIs(type(getoptions.parse_arguments(['--from-store=store.nc', '-s', 'winter'])), optparse.Values)
+        self.assertRaises(getoptions.FromStoreOptionError, getoptions.parse_arguments, ['--from-store=store.nc', '-d'])
+
 
 class TestNCIO(unittest.TestCase):
     """Test the ncio module (netCDF input/output)."""
@@ -336,6 +854,530 @@ class TestNCIO(unittest.TestCase):
         data, lats = ncio.get_all_data(self.options.tmaxfile, self.options.tmaxvname, self.options)
 
 
+class TestBasePeriodSlice(unittest.TestCase):
+    """Tests for the base_period_slice function."""
+
+    options = optparse.Values({'bpstart':1992, 'bpend':1993})
+
+    def testGregorian(self):
+        """The slice should skip leap days before the base period."""
+        timedata = ncio.TimeData()
+        timedata.calendar = 'standard'
+        timedata.dates = ncio.pd.period_range('1991-07-01', '1995-12-31')
+        timedata.noleapdates = timedata.dates[(timedata.dates.month!=2)|(timedata.dates.day!=29)]
+        self.assertEqual(ncio.base_period_slice(self.options, timedata), slice(184, 184+2*365))
+
+    def test360Day(self):
+        """360 day years should use the 360 day calendar."""
+        timedata = ncio.TimeData()
+        timedata.calendar = '360_day'
+        timedata.dates = ncio.Calendar360(dt.datetime(1990,1,1), dt.datetime(1995,12,30))
+        self.assertEqual(ncio.base_period_slice(self.options, timedata), slice(720, 1440))
+
+
+class TestReadMasked(unittest.TestCase):
+    """Tests for the read_masked function."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.ncfile = nc.Dataset(os.path.join(self.tempdir, 'tasmax.nc'), 'w')
+        self.ncfile.createDimension('time', None)
+        self.ncfile.createDimension('lat', 6)
+        self.ncfile.createDimension('lon', 5)
+        variable = self.ncfile.createVariable('tasmax', 'f4', ('time','lat','lon'),
+                chunksizes=(7,6,5), fill_value=1e20)
+        self.data = np.random.RandomState(4).normal(size=(50,6,5)).astype(np.float32)
+        variable[:] = self.data
+        variable[3,2,2] = np.ma.masked
+        self.mask = np.zeros((6,5), dtype=bool)
+        self.mask[1,3] = self.mask[2,1] = self.mask[2,2] = self.mask[4,2] = True
+        self.readblocksize = ncio.readblocksize
+
+    def tearDown(self):
+        ncio.readblocksize = self.readblocksize
+        self.ncfile.close()
+        shutil.rmtree(self.tempdir)
+
+    def testBlocks(self):
+        """Reading in blocks should give the land points of the full variable."""
+        variable = self.ncfile.variables['tasmax']
+        for blocksize in [1, 100, 1000, 2**26]:
+            ncio.readblocksize = blocksize
+            result = ncio.read_masked(variable, self.mask, slice(5,45))
+            expected = variable[5:45][:,self.mask]
+            self.assertTrue((result.data==expected.data).all())
+            self.assertTrue((result.mask==np.ma.getmaskarray(expected)).all())
+
+    def testRows(self):
+        """A band of rows should be read relative to its first row."""
+        variable = self.ncfile.variables['tasmax']
+        result = ncio.read_masked(variable, self.mask[2:], rows=slice(2,None))
+        self.assertTrue((result==variable[:,2:][:,self.mask[2:]]).all())
+        self.assertTrue(result.mask[3,1])
+
+
+class TestFileSet(unittest.TestCase):
+    """Tests for the FileSet multi-file reader."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.data = np.random.RandomState(5).normal(size=(40,6,5)).astype(np.float32)
+        # Write the second part first so the files must be sorted by time.
+        for part, (start, stop) in enumerate([(15,40), (0,15)]):
+            ncfile = nc.Dataset(os.path.join(self.tempdir, 'tasmax_%d.nc'%(part)), 'w')
+            ncfile.createDimension('time', None)
+            ncfile.createDimension('lat', 6)
+            ncfile.createDimension('lon', 5)
+            time = ncfile.createVariable('time', 'f8', ('time',))
+            time.units = 'days since 2000-01-01'
+            time.calendar = 'standard'
+            time[:] = np.arange(start, stop)
+            ncfile.createVariable('lat', 'f4', ('lat',))[:] = np.arange(6)
+            ncfile.createVariable('lon', 'f4', ('lon',))[:] = np.arange(5)
+            variable = ncfile.createVariable('tasmax', 'f4', ('time','lat','lon'), fill_value=1e20)
+            variable[:] = self.data[start:stop]
+            if part==0: variable[3,2,2] = np.ma.masked
+            ncfile.model_id = 'model%d'%(part)
+            ncfile.close()
+        self.fileset = ncio.FileSet(os.path.join(self.tempdir, 'tasmax_*.nc'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testIndex(self):
+        """The files should be ordered by time with metadata of the first."""
+        self.assertEqual(self.fileset.lengths, [15, 25])
+        self.assertEqual(self.fileset.shape('tasmax'), (40, 6, 5))
+        self.assertEqual(self.fileset.firsttime[0], 0)
+        self.assertEqual(self.fileset.lasttime[0], 39)
+        self.assertEqual(self.fileset.attributes['model_id'], 'model1')
+
+    def testRead(self):
+        """Reads across files should equal the joined series."""
+        result = self.fileset.read('tasmax', slice(10,20), slice(2,5))
+        self.assertTrue((result==self.data[10:20,2:5]).all())
+        self.assertTrue(result.mask[8,0,2])
+        self.assertEqual(result.mask.sum(), 1)
+        result = self.fileset.read('tasmax', slice(0,15))
+        self.assertFalse(np.ma.getmaskarray(result).any())
+
+    def testReadMasked(self):
+        """Masked reads should give the land points of each file."""
+        mask = np.zeros((6,5), dtype=bool)
+        mask[1,3] = mask[2,1] = mask[4,2] = True
+        result = self.fileset.read('tasmax', slice(5,40), mask=mask)
+        self.assertTrue((result.data==self.data[5:40][:,mask]).all())
+
+    def testInputMetadata(self):
+        """InputMetadata should be taken from the first file by time."""
+        options = getoptions.parse_arguments(['-x', os.path.join(self.tempdir, 'tasmax_*.nc'), '-n', 'tasmin.nc', '-m', 'mask.nc'])
+        metadata = ncio.InputMetadata(options)
+        self.assertEqual(metadata.model, 'model1')
+        self.assertEqual(metadata.experiment, '')
+        self.assertEqual(metadata.rip, '')
+        self.assertTrue((metadata.lats==np.arange(6)).all())
+        self.assertEqual(len(metadata.lons), 5)
+
+
+class TestOutputVariables(unittest.TestCase):
+    """Tests for the type, packing and chunking of output variables."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.ncfile = nc.Dataset(os.path.join(self.tempdir, 'out.nc'), 'w')
+        self.ncfile.createDimension('time', None)
+        self.ncfile.createDimension('lat', 4)
+        self.ncfile.createDimension('lon', 3)
+        self.options = optparse.Values({'outtype':'i2', 'compress':4, 'chunks':None})
+        self.data = np.random.RandomState(6).normal(scale=50., size=(10,12))
+        self.data[0,0] = np.nan
+        self.data[1,1] = ncio.missingval
+
+    def tearDown(self):
+        self.ncfile.close()
+        shutil.rmtree(self.tempdir)
+
+    def testPacked(self):
+        """Packed values should read back within half the scale_factor."""
+        variable = ncio.create_output(self.ncfile, 'EHF', (10,4,3), self.options, 0.1, (-400,400))
+        ncio.write_band(variable, self.data, None)
+        variable.set_auto_maskandscale(True)
+        result = variable[:].reshape((10,-1))
+        self.assertTrue(result.mask[0,0] and result.mask[1,1])
+        self.assertEqual(result.mask.sum(), 2)
+        self.assertLessEqual(abs(result - self.data).max(), 0.05 + 1e-6)
+        self.assertEqual(list(variable.valid_range), [-4000, 4000])
+
+    def testIndicator(self):
+        """Indicators should be small integers with fill values at sea."""
+        mask = np.zeros((4,3), dtype=bool)
+        mask[1:3] = True
+        variable = ncio.create_output(self.ncfile, 'ends', (10,4,3), self.options, indicator='i1')
+        self.assertEqual(variable.dtype, np.int8)
+        ncio.write_band(variable, np.ones((10,6)), mask)
+        raw = variable[:]
+        self.assertTrue((raw[:,mask]==1).all())
+        self.assertTrue((raw[:,~mask]==variable._FillValue).all())
+
+    def testDouble(self):
+        """The default output should be unchanged doubles."""
+        self.options.outtype = 'f8'
+        variable = ncio.create_output(self.ncfile, 'EHF', (10,4,3), self.options, 0.1, indicator='i1')
+        ncio.write_band(variable, self.data, None)
+        variable.set_auto_maskandscale(False)
+        self.assertTrue(np.array_equal(variable[:].reshape((10,-1)), self.data, equal_nan=True))
+
+    def testBlocks(self):
+        """Writing in blocks should give the same output as one write."""
+        mask = np.zeros((4,3), dtype=bool)
+        mask[0,1] = mask[2,0] = mask[3,2] = True
+        self.options.outtype = 'f8'
+        data = np.ma.array(self.data[:,:3])
+        data[4,1] = np.ma.masked
+        whole = ncio.create_output(self.ncfile, 'whole', (10,4,3), self.options)
+        ncio.write_band(whole, data, mask)
+        result = whole[:]
+        self.assertTrue(result.mask[4,2,0])
+        self.assertEqual(result.mask[:,mask].sum(), 2)
+        self.assertTrue(np.array_equal(result[:,mask].filled(np.nan)[5:], self.data[5:,:3], equal_nan=True))
+        writeblocksize = ncio.writeblocksize
+        try:
+            for blocksize, chunks in [(1, None), (200, None), (200, (4,2,2))]:
+                self.options.chunks = chunks
+                variable = ncio.create_output(self.ncfile, 'blocks%d%s'%(blocksize, chunks is None),
+                        (10,4,3), self.options)
+                ncio.writeblocksize = blocksize
+                ncio.write_band(variable, data, mask)
+                self.assertTrue(np.array_equal(variable[:].filled(np.nan), result.filled(np.nan), equal_nan=True))
+        finally:
+            ncio.writeblocksize = writeblocksize
+
+    def testChunks(self):
+        """Chunks should be limited to the shape of the variable."""
+        self.assertEqual(ncio.chunk_shape(self.options, (10,4,3)), None)
+        self.options.chunks = 'timeseries'
+        self.assertEqual(ncio.chunk_shape(self.options, (10,40,30)), (10,8,8))
+        self.options.chunks = 'map'
+        self.assertEqual(ncio.chunk_shape(self.options, (10,40,30)), (1,40,30))
+        self.options.chunks = (100,2,0)
+        self.assertEqual(ncio.chunk_shape(self.options, (10,40,30)), (10,2,1))
+
+
+class TestDailyWriter(unittest.TestCase):
+    """Tests for the DailyWriter streaming daily output writer."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.options = optparse.Values({'outtype':'f8', 'compress':0, 'chunks':None, 'maskfile':None})
+        # Runs of heat of all lengths, including one that lasts the whole series
+        self.ehf = np.random.RandomState(7).normal(size=(200,4,3))
+        self.ehf[:,0,0] = 1.
+        self.ehf[150:,1,1] = 2.
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, blocklen):
+        """Stream the EHF in blocks and return the written indicators."""
+        dailyout = nc.Dataset(os.path.join(self.tempdir, 'daily%d.nc'%(blocklen)), 'w')
+        dailyout.createDimension('time', None)
+        dailyout.createDimension('lat', 4)
+        dailyout.createDimension('lon', 3)
+        for name in ('EHF', 'event', 'ends'):
+            ncio.create_output(dailyout, name, (200,4,3), self.options)
+        writer = ncio.DailyWriter(dailyout, ehfheatwaves.identify_hw, self.options, None)
+        for start in range(0, 200, blocklen):
+            writer.append(self.ehf[start:start+blocklen])
+        writer.close()
+        event, ends = dailyout.variables['event'][:], dailyout.variables['ends'][:]
+        dailyout.close()
+        return event, ends
+
+    def testBlocks(self):
+        """Indicators should not depend on the length of the blocks."""
+        event, ends = ehfheatwaves.identify_hw(self.ehf)
+        for blocklen in [1, 2, 7, 200]:
+            streamed = self.write(blocklen)
+            self.assertTrue((streamed[0]==event).all())
+            self.assertTrue((streamed[1]==ends).all())
+        self.assertEqual(ends[0,0,0], 200)
+
+
+class TestScratch(unittest.TestCase):
+    """Tests for memory mapped intermediate arrays."""
+
+    def setUp(self):
+        self.scratchdir = tempfile.mkdtemp()
+        self.minbytes = scratch.minbytes
+        scratch.minbytes = 0
+        self.tave = np.ma.array(np.random.RandomState(0).normal(20, 5, size=(400,6)))
+        self.tave[100,0] = np.ma.masked
+        self.tpct = np.random.RandomState(1).normal(25, 1, size=(365,6))
+
+    def tearDown(self):
+        scratch.directory = None
+        scratch.minbytes = self.minbytes
+        shutil.rmtree(self.scratchdir)
+
+    def testHeatIndices(self):
+        """Memory mapped indices calculated in blocks should equal those in memory."""
+        inmemory = ehfheatwaves.heat_indices(self.tave, self.tpct)
+        scratch.directory = self.scratchdir
+        mapped = ehfheatwaves.heat_indices(self.tave, self.tpct, blocksize=50)
+        for index, mapped_index in zip(inmemory, mapped):
+            self.assertIsInstance(mapped_index, np.memmap)
+            self.assertTrue(np.array_equal(index, mapped_index, equal_nan=True))
+        # The files are removed as soon as they are mapped.
+        self.assertEqual(os.listdir(self.scratchdir), [])
+
+    def testRuns(self):
+        """Memory mapped heatwave indicators should equal those in memory."""
+        ehf = ehfheatwaves.heat_indices(self.tave, self.tpct)[2]
+        events, ends = ehfheatwaves.find_runs(ehf, minlength=3)
+        scratch.directory = self.scratchdir
+        mapped_events, mapped_ends = ehfheatwaves.find_runs(ehf, minlength=3)
+        self.assertEqual(mapped_events.dtype, bool)
+        self.assertTrue((events==mapped_events).all())
+        self.assertTrue((ends==mapped_ends).all())
+
+
+class TestStore(unittest.TestCase):
+    """Tests for the --store file of the series the yearly aspects are calculated from."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        tmaxfile = os.path.join(self.tempdir, 'tasmax.nc')
+        ncfile = nc.Dataset(tmaxfile, 'w')
+        ncfile.createDimension('time', None)
+        ncfile.createDimension('lat', 2)
+        ncfile.createDimension('lon', 4)
+        time = ncfile.createVariable('time', 'f8', ('time',))
+        time.units = 'days since 2000-01-01'
+        time.calendar = 'standard'
+        time[:] = np.arange(1827)
+        ncfile.createVariable('lat', 'f4', ('lat',))[:] = [-10, 10]
+        ncfile.createVariable('lon', 'f4', ('lon',))[:] = np.arange(4)
+        ncfile.model_id = 'model'
+        ncfile.close()
+        self.storefile = os.path.join(self.tempdir, 'store.nc')
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self.options = getoptions.parse_arguments(['-x', tmaxfile, '-n', tmaxfile, '-m', 'mask.nc',
+                    '--base=2000-2001', '--t90pc', '--store', self.storefile])
+        self.timedata = ncio.get_time_data(self.options)
+        self.mask = np.array([[1,1,0,1],[1,0,1,1]], dtype=bool)
+        self.south = np.array([1,1,1,0,0,0], dtype=bool)
+        cycle = 10*np.cos(np.arange(5*365)*2*np.pi/365.)[:,None]
+        noise = np.random.RandomState(4).normal(size=(5*365,6))*4
+        tmax = np.ma.array(25 + cycle + noise)
+        tmin = np.ma.array(15 + cycle + noise/2.)
+        tmax[40,2] = np.ma.masked
+        self.results = ehfheatwaves.heatwave_chain(self.options, self.timedata, 2000, self.south,
+                tmax=tmax, tmin=tmin, tmax_bp=tmax[:730], tmin_bp=tmin[:730])
+        store = ncio.create_store(self.options, self.timedata, (5*365,2,4), 2000,
+                metadata=ncio.InputMetadata(self.options))
+        ncio.write_store(store, self.results, self.options, self.mask)
+        store.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def testRoundTrip(self):
+        """The stored options, time data and series should be those of the run."""
+        options = getoptions.parse_arguments(['--from-store', self.storefile, '--t90pc'])
+        timedata, metadata, mask, first_year = ncio.open_store(options)
+        self.assertEqual((options.bpstart, options.bpend, options.pcntl), (2000, 2001, 90))
+        self.assertEqual(options.maskfile, 'mask.nc')
+        self.assertEqual((timedata.daysinyear, timedata.dayone.year, timedata.daylast.year), (365, 2000, 2004))
+        self.assertEqual(metadata.model, 'model')
+        self.assertEqual(first_year, 2000)
+        self.assertTrue((mask==self.mask).all())
+        loaded = ncio.read_store(options, mask)
+        for key in ['EHF_series', 'tx_series', 'tn_series', 'tpct', 'txpct', 'tnpct']:
+            self.assertTrue(np.array_equal(loaded[key], self.results[key], equal_nan=True))
+        self.assertTrue(np.isnan(loaded['tx_series'][40,2]))
+
+    def testOtherSeason(self):
+        """Aspects from the store should equal those calculated from the series."""
+        options = getoptions.parse_arguments(['--from-store', self.storefile, '--t90pc', '-s', 'winter', '--old-method'])
+        timedata, metadata, mask, first_year = ncio.open_store(options)
+        expected = ehfheatwaves.split_hemispheres(self.results['tx_series'], self.south, options, self.timedata, 2000)
+        results = ehfheatwaves.calculate_stored_region(options, timedata, first_year, mask)
+        for aspect, stored_aspect in zip(expected, results['tx_aspects']):
+            self.assertTrue(np.array_equal(aspect, stored_aspect))
+        # A band of rows holds the columns of its land points
+        results = ehfheatwaves.calculate_stored_region(options, timedata, first_year, mask, slice(1,2))
+        for aspect, stored_aspect in zip(expected, results['tx_aspects']):
+            self.assertTrue(np.array_equal(aspect[:,3:], stored_aspect))
+
+
+class TestBatch(unittest.TestCase):
+    """Tests for the batch manifest of jobs."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        for name in ('hist', 'r1', 'r2'):
+            ncfile = nc.Dataset(os.path.join(self.tempdir, name+'.nc'), 'w')
+            ncfile.createDimension('time', None)
+            ncfile.createDimension('lat', 2)
+            ncfile.createDimension('lon', 2)
+            time = ncfile.createVariable('time', 'f8', ('time',))
+            time.units = 'days since 2000-01-01'
+            time.calendar = 'noleap'
+            time[:] = np.arange(730)
+            ncfile.createVariable('lat', 'f4', ('lat',))[:] = [-10, 10]
+            ncfile.createVariable('lon', 'f4', ('lon',))[:] = [0, 1]
+            ncfile.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def job(self, member, **options):
+        """Return the manifest job of a member with the historical base period."""
+        job = {'tmax': os.path.join(self.tempdir, member+'.nc'), 'tmin': os.path.join(self.tempdir, member+'.nc'),
+                'bpfx': os.path.join(self.tempdir, 'hist.nc'), 'bpfn': os.path.join(self.tempdir, 'hist.nc'),
+                'base': '2000-2001'}
+        job.update(options)
+        return job
+
+    def testArguments(self):
+        """Job options should become long options, with flags and extra arguments."""
+        job = {'name': 'r1', 'tmax': 'a.nc', 't90pc': True, 'daily': False, 'args': ['-s', 'winter']}
+        self.assertEqual(batch.job_arguments(job, ['-v']), ['-v', '--tmax=a.nc', '--t90pc', '-s', 'winter'])
+
+    def testGroups(self):
+        """Members with the same base period and options should share thresholds."""
+        jobs = [self.job('r1'), self.job('r2', season='winter'), self.job('r2', args=['-p', '95']),
+                self.job('r1', tmax='/nonexistent.nc'),
+                {'name': 'broken', 'base': '2000'}]
+        groups, failed = batch.group_jobs(jobs, ['--t90pc'])
+        self.assertEqual([len(group) for group in groups], [2, 1])
+        self.assertEqual([name for name, arguments in groups[0]], ['r1.nc', 'r2.nc'])
+        self.assertEqual([name for name, error in failed], ['nonexistent.nc', 'broken'])
+
+
+class TestSweep(unittest.TestCase):
+    """Tests for the stages of a sweep job file."""
+
+    setUp = TestBatch.setUp
+    tearDown = TestBatch.tearDown
+    job = TestBatch.job
+
+    def testExpand(self):
+        """Each model should have a stored series stage and a yearly stage from
+        the store for every other season and method."""
+        jobfile = {'models': [self.job('r1'), self.job('r2'), self.job('r1')],
+                'definitions': ['EHF', 'tx90pct'], 'daily': True,
+                'seasons': ['summer', 'winter'], 'methods': ['new', 'old'], 'output': 'out'}
+        stages, failed = sweep.expand(jobfile, ['--base=1999-2000'], self.tempdir)
+        self.assertEqual(failed, [])
+        self.assertEqual(len(stages), 8)
+        series = [key for key in stages if 'store' in stages[key]]
+        self.assertEqual(len(series), 2)
+        self.assertEqual(stages[series[1]]['waits'], [series[0]])
+        options = getoptions.parse_arguments(stages[series[0]]['arguments'])
+        self.assertEqual(options.bpstart, 2000)
+        self.assertTrue(options.daily and options.tx90pcd and options.keeptmax)
+        self.assertEqual(options.outdir, os.path.join('out', 'r1.nc', 'summer_new'))
+        for key in stages:
+            if key in series: continue
+            options = getoptions.parse_arguments(stages[key]['arguments'])
+            self.assertEqual(options.fromstore, stages[stages[key]['after'][0]]['store'])
+            self.assertFalse(options.daily)
+
+    def testModelDirectories(self):
+        """Each model should have its own output directories, and models with
+        the same name should not share them."""
+        jobfile = {'models': [self.job('r1', name='a'), self.job('r2', name='b'), self.job('r2', name='a')],
+                'output': 'out'}
+        stages, failed = sweep.expand(jobfile, [], self.tempdir)
+        outdirs = [getoptions.parse_arguments(stage['arguments']).outdir for stage in stages.values()]
+        self.assertEqual(outdirs, [os.path.join('out', 'a', 'summer_new'), os.path.join('out', 'b', 'summer_new')])
+        self.assertEqual([name for name, error in failed], ['a'])
+
+    def testPending(self):
+        """A finished series stage should run again if a stage needs its
+        missing store."""
+        jobfile = {'models': [self.job('r1')], 'seasons': ['summer', 'winter']}
+        stages, failed = sweep.expand(jobfile, [], self.tempdir)
+        series, winter = list(stages)
+        self.assertEqual(sweep.pending_stages(stages, {series: {}, winter: {}}), set())
+        self.assertEqual(sweep.pending_stages(stages, {series: {}}), set([series, winter]))
+        statefile = os.path.join(self.tempdir, 'state.json')
+        sweep.save_state(statefile, {series: {'name': 'r1'}})
+        self.assertEqual(sweep.load_state(statefile), {series: {'name': 'r1'}})
+
+
+class TestThresholdCache(unittest.TestCase):
+    """Test the tcache module (threshold cache)."""
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.datafile = os.path.join(self.cachedir, 'tasmax.nc')
+        open(self.datafile, 'w').close()
+        self.options = optparse.Values({'cachedir':os.path.join(self.cachedir, 'cache'),
+                'cachesize':1, 'verbose':False, 'tmaxfile':self.datafile,
+                'tmaxvname':'tasmax', 'tminfile':None, 'bpfx':None, 'bpfn':None,
+                'bpstart':1961, 'bpend':1990, 'pcntl':90, 'qtilemethod':'climpact',
+                'precision':'double'})
+        self.timedata = ncio.TimeData()
+        self.timedata.calendar = 'standard'
+        self.timedata.daysinyear = 365
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def testMissThenHit(self):
+        """Should miss before storing and return the same thresholds after."""
+        self.assertIs(tcache.load(self.options, self.timedata, 'tmax'), None)
+        pctl = np.arange(365*4.).reshape(365,4)
+        tcache.store(self.options, self.timedata, 'tmax', pctl)
+        self.assertTrue((tcache.load(self.options, self.timedata, 'tmax')==pctl).all())
+
+    def testCorruptEntry(self):
+        """A truncated entry should be removed and count as a miss."""
+        pctl = np.arange(365*4.).reshape(365,4)
+        tcache.store(self.options, self.timedata, 'tmax', pctl)
+        key = tcache.cache_key(self.options, self.timedata, 'tmax')
+        filename = os.path.join(self.options.cachedir, key+'.npy')
+        with open(filename, 'r+b') as entry: entry.truncate(1000)
+        self.assertIs(tcache.load(self.options, self.timedata, 'tmax'), None)
+        self.assertFalse(os.path.exists(filename))
+        self.assertFalse(os.path.exists(os.path.join(self.options.cachedir, key+'.json')))
+        with open(filename, 'wb') as entry: entry.write(b'garbage')
+        self.assertIs(tcache.load(self.options, self.timedata, 'tmax'), None)
+        tcache.store(self.options, self.timedata, 'tmax', pctl)
+        self.assertTrue((tcache.load(self.options, self.timedata, 'tmax')==pctl).all())
+        self.assertEqual(sorted(os.listdir(self.options.cachedir)), [key+'.json', key+'.npy'])
+
+    def testKeyChanges(self):
+        """The key should depend on the percentile, mask, precision and input files."""
+        key = tcache.cache_key(self.options, self.timedata, 'tmax')
+        self.options.pcntl = 95
+        self.assertNotEqual(key, tcache.cache_key(self.options, self.timedata, 'tmax'))
+        self.options.pcntl = 90
+        mask = np.ones((2,2), dtype=bool)
+        self.assertNotEqual(key, tcache.cache_key(self.options, self.timedata, 'tmax', mask))
+        self.assertNotEqual(tcache.cache_key(self.options, self.timedata, 'tmax', mask, rows=slice(0,2)),
+                tcache.cache_key(self.options, self.timedata, 'tmax', mask, rows=slice(2,4)))
+        self.options.precision = 'single'
+        self.assertNotEqual(key, tcache.cache_key(self.options, self.timedata, 'tmax'))
+        self.options.precision = 'double'
+        with open(self.datafile, 'w') as datafile: datafile.write('modified')
+        self.assertNotEqual(key, tcache.cache_key(self.options, self.timedata, 'tmax'))
+
+    def testEviction(self):
+        """The least recently used entries should be evicted."""
+        pctl = np.zeros((365,200))
+        for pcntl in [80, 90, 95]:
+            self.options.pcntl = pcntl
+            tcache.store(self.options, self.timedata, 'tmax', pctl)
+        self.assertEqual(len(tcache.entries(self.options.cachedir)), 1)
+        self.assertIsNot(tcache.load(self.options, self.timedata, 'tmax'), None)
+        tcache.purge(self.options.cachedir)
+        self.assertEqual(len(tcache.entries(self.options.cachedir)), 0)
+
+
 if __name__=='__main__':
     # Tests that need to be added.
     # Test that it works with and without a land sea mask